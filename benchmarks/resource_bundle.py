@@ -0,0 +1,74 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures how long it takes to build, bind and validate a bundle of generated
+resources, without connecting to anything. Run it with::
+
+    python benchmarks/resource_bundle.py [count]
+"""
+
+import sys
+import time
+
+import mock
+
+from yaybu.provisioner import resource
+from yaybu.provisioner import resources  # noqa - registers the resources
+
+
+def specification(count):
+    """ ``count`` files, and a command for every tenth one that runs when it
+    changes """
+    files, commands = [], []
+    for i in range(count):
+        files.append({
+            "name": "/srv/site%d/settings.cfg" % i,
+            "owner": "www-data",
+            "mode": 0o644,
+        })
+        if i % 10 == 0:
+            commands.append({
+                "name": "reload-site%d" % i,
+                "command": "/srv/site%d/bin/reload" % i,
+                "policy": {"execute": [{
+                    "when": "apply",
+                    "on": "File[/srv/site%d/settings.cfg]" % i,
+                }]},
+            })
+    return [{"File": files}, {"Execute": commands}]
+
+
+def measure(label, func):
+    start = time.time()
+    result = func()
+    print("%-10s %8.2fs" % (label, time.time() - start))
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    context = mock.Mock()
+    context.provider_cache = None
+
+    print("%d resources" % count)
+    bundle = measure(
+        "build", lambda: resource.ResourceBundle.create_from_list(specification(count)))
+    measure("bind", bundle.bind)
+    measure("validate", lambda: [r.validate(context) for r in bundle.values()])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures the per-command overhead of running commands through the local and
+SSH transports.
+
+The SSH numbers come from an in-process paramiko server on a socket pair, so
+there is no network latency and what is left is the cost of the client's I/O
+loop. Run it with::
+
+    python benchmarks/transport_execute.py
+"""
+
+from gevent.monkey import patch_all
+patch_all(subprocess=True)
+
+import socket
+import subprocess
+import threading
+import time
+
+import mock
+import paramiko
+
+from yaybu.provisioner.transports.local import LocalExecute
+from yaybu.provisioner.transports.ssh import SSHTransport, ChannelStats
+
+
+COMMANDS = [
+    ("no output", ["true"], 50),
+    ("small output", ["echo", "hello"], 50),
+    ("10MB output", ["sh", "-c", "head -c 10000000 /dev/zero"], 5),
+    ("200k lines", ["seq", "1", "200000"], 5),
+]
+
+
+class Server(paramiko.ServerInterface):
+
+    """ Runs exec requests with subprocess and streams their output """
+
+    def get_allowed_auths(self, username):
+        return "none"
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.run, args=(channel, command)).start()
+        return True
+
+    def run(self, channel, command):
+        p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+        for block in iter(lambda: p.stdout.read(32768), ""):
+            channel.sendall(block)
+        channel.send_exit_status(p.wait())
+        channel.close()
+
+
+def ssh_connection():
+    client_sock, server_sock = socket.socketpair()
+
+    server = paramiko.Transport(server_sock)
+    server.add_server_key(paramiko.RSAKey.generate(1024))
+    server.start_server(threading.Event(), server=Server())
+
+    client = paramiko.Transport(client_sock)
+    client.start_client()
+    client.auth_none("bench")
+    return client
+
+
+def measure(run, repeat):
+    start = time.time()
+    for i in range(repeat):
+        run()
+    return (time.time() - start) / repeat * 1000
+
+
+def main():
+    local = LocalExecute()
+    local.env = None
+
+    client = ssh_connection()
+    ssh = SSHTransport(mock.Mock(user="bench"))
+
+    def run_ssh(command):
+        channel = client.open_session()
+        try:
+            return ssh._execute_channel(
+                channel, ChannelStats(-1), command, None, None, None)
+        finally:
+            channel.close()
+
+    print("%-14s %12s %12s" % ("command", "local (ms)", "ssh (ms)"))
+    for name, command, repeat in COMMANDS:
+        print("%-14s %12.2f %12.2f" % (
+            name,
+            measure(lambda: local._execute_impl(list(command)), repeat),
+            measure(lambda: run_ssh(command), repeat),
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,30 @@ from yay import ast
 
 class GraphExternalAction(ast.PythonClass):
 
+    waits_for_hosts = True
+    """ Hosts are provisioned in the background while the graph is resolved.
+    Parts that might depend on them having been provisioned wait for them
+    before they are applied, and the run stops there if any of them failed. """
+
+    def wait_for_hosts(self):
+        provisioners = getattr(self.root, "provisioners", None)
+        if self.waits_for_hosts and provisioners is not None:
+            provisioners.join()
+
+    def get_key(self, key):
+        if self.stale:
+            self.wait_for_hosts()
+        return super(GraphExternalAction, self).get_key(key)
+
+    def expand_once(self):
+        if self.stale:
+            self.wait_for_hosts()
+        return super(GraphExternalAction, self).expand_once()
+
+    def changed(self):
+        self.wait_for_hosts()
+        super(GraphExternalAction, self).changed()
+
     def test(self):
         pass
 
@@ -80,6 +80,12 @@ class Change(object):
         """ Apply the specified change. The supplied renderer will be
         instantiated as below. """
 
+    def get_paths(self):
+        """ Return a list of the paths on the target that applying this
+        change might alter. The default of None means it might alter
+        anything. """
+        return None
+
 
 class AttributeChange(Change):
 
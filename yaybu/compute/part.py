@@ -47,6 +47,10 @@ class Compute(GraphExternalAction):
 
     default_layer = CloudComputeLayer
 
+    # Provisioners need their node started, but starting one doesn't need
+    # any host to have been provisioned
+    waits_for_hosts = False
+
     @property
     @memoized
     def driver_id(self):
@@ -0,0 +1,283 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import StringIO
+import collections
+
+from yay.errors import NotModified
+
+from yaybu.util.backports import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class CachedAsset(object):
+
+    """ A copy of an asset in the cache, opened for reading. It looks like
+    the streams yay's openers return, and ``path`` is where the copy is so
+    that it can be streamed rather than read into memory. """
+
+    def __init__(self, uri, path, etag, labels=()):
+        self.uri = uri
+        self.path = path
+        self.etag = etag
+        self.labels = labels
+        self.fp = open(path, "rb")
+        self.len = os.fstat(self.fp.fileno()).st_size
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def close(self):
+        self.fp.close()
+
+
+def asset(uri, data, etag, labels):
+    """ A stream that looks like the ones yay's openers return """
+    stream = StringIO.StringIO(data)
+    stream.uri = uri
+    stream.etag = etag
+    stream.len = len(data)
+    stream.labels = labels
+    return stream
+
+
+class AssetCache(object):
+
+    """ Keeps a copy of the assets opened through it in ``directory``. Each
+    copy is named after a digest of its contents, and an index maps every URI
+    to the digest and etag it had when it was fetched.
+
+    The first time a URI is opened in a run it is revalidated by passing the
+    etag to its opener, so it is only fetched again if it has changed. After
+    that it is served from the cache for the rest of the run. Encrypted assets
+    are only ever kept in memory. When the run finishes and the index is
+    saved, the least recently used copies are thrown away until the rest fit
+    in ``size`` bytes.
+
+    Assets are copied into the cache and read back from it in chunks, so a
+    large asset doesn't have to fit in memory. """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, directory, size=256 * 1024 * 1024):
+        self.directory = directory
+        self.size = size
+        self.index = OrderedDict()
+        self.memory = {}
+        self.validated = set()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+        self.load()
+
+    @property
+    def index_file(self):
+        return os.path.join(self.directory, "index.json")
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def load(self):
+        # The index is saved as a list of pairs to keep its order
+        try:
+            with open(self.index_file) as fp:
+                self.index = OrderedDict(json.load(fp))
+        except (IOError, OSError, ValueError, TypeError):
+            self.index = OrderedDict()
+
+    def save(self):
+        """ Throw away copies to fit in ``size``, and write the index so that
+        the next run can revalidate what is in the cache rather than fetching
+        it again. """
+        self.evict()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(self.index_file + ".new", "w") as fp:
+                json.dump(self.index.items(), fp)
+            os.rename(self.index_file + ".new", self.index_file)
+        except (IOError, OSError):
+            logger.debug("Unable to save asset cache index %s" % self.index_file)
+
+    def verify(self, entry):
+        """ True if the copy of an entry is there and hasn't been damaged.
+        A copy with the size and mtime recorded in the index is trusted.
+        Otherwise it is hashed a chunk at a time, and if it is intact its new
+        mtime is recorded. """
+        path = self.path(entry["digest"])
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size != entry["size"]:
+            return False
+        if int(st.st_mtime) == entry.get("mtime"):
+            return True
+
+        h = hashlib.sha1()
+        try:
+            with open(path, "rb") as fp:
+                for chunk in iter(lambda: fp.read(self.chunk_size), ""):
+                    h.update(chunk)
+        except (IOError, OSError):
+            return False
+        if h.hexdigest() != entry["digest"]:
+            return False
+        entry["mtime"] = int(st.st_mtime)
+        return True
+
+    def write(self, fp):
+        """ Copy the stream ``fp`` into the cache a chunk at a time. Returns
+        the digest, size and mtime of the copy, or None if it couldn't be
+        made. """
+        h = hashlib.sha1()
+        size = 0
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            temp = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)
+        except (IOError, OSError):
+            return None
+        try:
+            with temp:
+                for chunk in iter(lambda: fp.read(self.chunk_size), ""):
+                    h.update(chunk)
+                    temp.write(chunk)
+                    size += len(chunk)
+            path = self.path(h.hexdigest())
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            os.rename(temp.name, path)
+            mtime = int(os.stat(path).st_mtime)
+        except (IOError, OSError):
+            if os.path.exists(temp.name):
+                os.unlink(temp.name)
+            return None
+        return h.hexdigest(), size, mtime
+
+    def open(self, openers, uri, etag=None):
+        """ Open ``uri`` with ``openers``, unless the cache already has an up
+        to date copy. Like ``openers.open``, raises ``NotModified`` if the
+        asset still has ``etag``. """
+        fp = self.get(openers, uri)
+        if etag and fp.etag == etag:
+            raise NotModified("'%s' not modified" % uri)
+        return fp
+
+    def get(self, openers, uri):
+        if uri in self.memory:
+            self.hits += 1
+            return asset(uri, *self.memory[uri])
+
+        entry = self.index.get(uri)
+        fp = None
+        if entry:
+            if uri in self.validated:
+                valid = os.path.exists(self.path(entry["digest"]))
+            else:
+                valid, fp = self.revalidate(openers, uri, entry)
+            if valid:
+                self.hits += 1
+                self.validated.add(uri)
+                # The index is kept with the most recently used last
+                self.index[uri] = self.index.pop(uri)
+                return CachedAsset(
+                    uri, self.path(entry["digest"]), entry["etag"],
+                    tuple(entry.get("labels", ())))
+
+        return self.fetch(openers, uri, fp)
+
+    def revalidate(self, openers, uri, entry):
+        """ Ask the opener whether ``uri`` has changed since it was cached.
+        Returns whether the copy is still good and, if it isn't, the stream
+        the opener returned. """
+        if not entry["etag"] or not self.verify(entry):
+            return False, None
+        try:
+            fp = openers.open(uri, entry["etag"])
+        except NotModified:
+            self.revalidated += 1
+            return True, None
+        return False, fp
+
+    def fetch(self, openers, uri, fp=None):
+        self.misses += 1
+        if fp is None:
+            fp = openers.open(uri)
+        etag = getattr(fp, "etag", None)
+        labels = tuple(getattr(fp, "labels", ()))
+
+        copied = None
+        if "secret" not in labels:
+            copied = self.write(fp)
+            if not copied:
+                # Part of the stream may have been used up
+                fp = openers.open(uri)
+
+        if not copied:
+            data = fp.read()
+            self.memory[uri] = (data, etag, labels)
+            return asset(uri, data, etag, labels)
+
+        digest, size, mtime = copied
+        self.index.pop(uri, None)
+        self.index[uri] = {
+            "digest": digest,
+            "etag": etag,
+            "size": size,
+            "mtime": mtime,
+            "labels": list(labels),
+        }
+        self.validated.add(uri)
+        return CachedAsset(uri, self.path(digest), etag, labels)
+
+    def evict(self):
+        """ Throw away the least recently used copies until the cache fits in
+        ``size`` bytes. Copies are shared by URIs with the same contents, so a
+        copy is only deleted when nothing refers to it. Copies used in this
+        run are kept until the next one, as they may still be read. """
+        sizes, references = {}, collections.defaultdict(int)
+        for entry in self.index.values():
+            sizes[entry["digest"]] = entry["size"]
+            references[entry["digest"]] += 1
+        total = sum(sizes.values())
+
+        for uri, entry in list(self.index.items()):
+            if total <= self.size:
+                break
+            if uri in self.validated:
+                # It might still be streamed from
+                continue
+            del self.index[uri]
+            self.evicted += 1
+            digest = entry["digest"]
+            references[digest] -= 1
+            if references[digest]:
+                continue
+            total -= sizes[digest]
+            try:
+                os.unlink(self.path(digest))
+            except OSError:
+                pass
+
+    def __str__(self):
+        return "asset cache: %d hits, %d misses, %d revalidated, %d evicted" % (
+            self.hits, self.misses, self.revalidated, self.evicted)
@@ -197,6 +197,8 @@ class YaybuCmd(OptionParsingCmd):
         graph.simulate = getattr(opts, "simulate", True)
         graph.resume = getattr(opts, "resume", False)
         graph.no_resume = getattr(opts, "no_resume", False)
+        graph.serial = getattr(opts, "serial", False)
+        graph.hosts = getattr(opts, "hosts", None) or graph.hosts
         if not len(self.ypath):
             self.ypath = [os.getcwd()]
         graph.ypath = self.ypath
@@ -246,6 +248,10 @@ class YaybuCmd(OptionParsingCmd):
                           help="Resume from saved events if terminated abnormally")
         parser.add_option("--no-resume", default=False, action="store_true",
                           help="Clobber saved event files if present and do not resume")
+        parser.add_option("--serial", default=False, action="store_true",
+                          help="Apply resources and provision hosts one at a time")
+        parser.add_option("--hosts", type="int",
+                          help="The most hosts to provision at the same time")
 
     def do_up(self, opts, args):
         """
@@ -331,6 +337,10 @@ class YaybuCmd(OptionParsingCmd):
                           help="Resume from saved events if terminated abnormally")
         parser.add_option("--no-resume", default=False, action="store_true",
                           help="Clobber saved event files if present and do not resume")
+        parser.add_option("--serial", default=False, action="store_true",
+                          help="Apply resources and provision hosts one at a time")
+        parser.add_option("--hosts", type="int",
+                          help="The most hosts to provision at the same time")
 
     def do_run(self, opts, args):
         """
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import os
+import logging
 
 from yay.openers.base import Openers, SearchpathFromGraph
 from yay.errors import NoMatching
@@ -22,10 +23,14 @@ from yay import ast
 from yaybu.error import ArgParseError
 from yaybu.core.util import memoized
 from yaybu.core.state import StateStorageType, SimulatedStateStorageAdaptor
+from yaybu.core.assets import AssetCache
 from yaybu.ui import TextFactory
+from yaybu.util.templates import get_template_environment
 
 from yaybu.compute import Compute
 from yaybu.provisioner import Provision
+from yaybu.provisioner.pool import ProvisionerPool
+from yaybu.provisioner.render import RenderCache
 from yaybu.loadbalancer import LoadBalancer
 from yaybu.dns import Zone
 from yaybu.static import StaticContainer
@@ -34,6 +39,9 @@ from yaybu.changesource import GitChangeSource, GitHubChangeSource
 from yaybu.printer import Printer
 
 
+logger = logging.getLogger(__name__)
+
+
 class YaybuArg:
 
     def __init__(self, name, type_='string', default=None, help=None):
@@ -147,6 +155,16 @@ class Config(BaseConfig):
 
     readonly = False
     simulate = False
+    serial = False
+
+    hosts = 10
+    """ The most hosts to provision at the same time """
+
+    provisioners = None
+
+    _templates = None
+    _assets = None
+    _renders = None
 
     default_builtins = {
         "Compute": Compute,
@@ -244,6 +262,59 @@ class Config(BaseConfig):
 
         return state
 
+    @property
+    def templates(self):
+        """ The template environment used for the whole run, so that each
+        template is only fetched and compiled once for every host. Compiled
+        templates are kept in ``~/.yaybu/templates`` between runs. """
+        if self._templates is None:
+            self._templates = get_template_environment(
+                os.path.expanduser("~/.yaybu/templates"))
+        return self._templates
+
+    @property
+    def assets(self):
+        """ The cache that files and templates are opened through, so that
+        each one is only fetched once for every host. Copies are kept in
+        ``~/.yaybu/cache`` between runs. """
+        if self._assets is None:
+            self._assets = AssetCache(os.path.expanduser("~/.yaybu/cache"))
+        return self._assets
+
+    @property
+    def renders(self):
+        """ What each file rendered to, so that files that are the same on
+        many hosts are only rendered once. """
+        if self._renders is None:
+            self._renders = RenderCache()
+        return self._renders
+
+    def resolve(self):
+        """ Resolve the whole graph. ``Provisioner`` parts found along the way
+        are run on a pool, so that consecutive ones provision their hosts at
+        the same time. Other parts wait for them before they are applied. """
+        provisioners = ProvisionerPool(self.ui, 1 if self.serial else self.hosts)
+        self.provisioners = provisioners
+        try:
+            resolved = super(Config, self).resolve()
+            provisioners.join()
+        finally:
+            self.provisioners = None
+            # Don't leave hosts half provisioned
+            provisioners.wait()
+            provisioners.summary()
+            self.finish()
+        return resolved
+
+    def finish(self):
+        """ Called once every host has been provisioned. Saves the asset
+        cache and logs how well the caches did. """
+        if self._assets is not None:
+            self._assets.save()
+            logger.debug(str(self._assets))
+        if self._renders is not None:
+            logger.debug(str(self._renders))
+
     def changed(self, changed=True):
         self._changed = self._changed or changed
 
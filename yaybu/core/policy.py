@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import posixpath
+import time
+
 from yaybu import error
+from yaybu.util.paths import paths_overlap
 from yay import errors
 
 
@@ -76,13 +80,26 @@ class Policy(object):
 
     def get_provider(self, context):
         """ Get the one and only one provider that is valid for this resource,
-        policy and overall context """
+        policy and overall context. If the context has a ``provider_cache``
+        the provider is only looked up once. """
+        cache = getattr(context, "provider_cache", None)
+        if cache is not None:
+            return cache.get(self, context)
+        return self.select_provider(context)
+
+    def select_provider(self, context):
+        """ Ask every provider of this policy whether it is valid. Some
+        providers look at the target to decide, so this can be slow. """
         valid = [p.isvalid(self, self.resource, context)
                  for p in self.providers]
         if valid.count(True) > 1:
-            raise error.TooManyProviders()
+            raise error.TooManyProviders(
+                "More than one provider can apply the '%s' policy of %s" %
+                (self.name, self.resource))
         if valid.count(True) == 0:
-            raise error.NoSuitableProviders()
+            raise error.NoSuitableProviders(
+                "There is no provider that can apply the '%s' policy of %s" %
+                (self.name, self.resource))
         return self.providers[valid.index(True)]
 
 
@@ -90,6 +107,119 @@ class NullPolicy(Policy):
     pass
 
 
+class ProviderCache(object):
+
+    """ Remembers the provider selected for each policy of each resource, so
+    that testing, validating and applying a resource only selects it once.
+    Some providers look at the target to decide whether they are valid, so
+    the paths they look at are noted and a selection is forgotten when a
+    change touches one of them. """
+
+    def __init__(self):
+        self.providers = {}
+        self.lookups = 0
+        self.selections = 0
+        self.probes = 0
+        self.saved = 0
+        self.forgotten = 0
+        self.elapsed = 0.0
+
+    def get(self, policy, context):
+        self.lookups += 1
+        key = (policy.__class__, policy.resource.id)
+        if key in self.providers:
+            provider, paths, probes = self.providers[key]
+            self.saved += probes
+            return provider
+
+        recorder = ProbeRecorder(context)
+        started = time.time()
+        try:
+            provider = policy.select_provider(recorder)
+        finally:
+            self.selections += 1
+            self.probes += recorder.probes
+            self.elapsed += time.time() - started
+        self.providers[key] = (provider, recorder.paths, recorder.probes)
+        return provider
+
+    def invalidate(self, paths=None):
+        """ Forget the selections that looked at any of ``paths`` on the
+        target. The default of None means anything might have changed, so
+        every selection that looked at the target is forgotten. """
+        if paths is not None:
+            paths = [posixpath.normpath(p) for p in paths if p]
+        for key, (provider, probed, probes) in self.providers.items():
+            if not probes:
+                continue
+            if paths is not None and probed is not None:
+                if not any(paths_overlap(a, b) for a in paths for b in probed):
+                    continue
+            del self.providers[key]
+            self.forgotten += 1
+
+    def __str__(self):
+        return (
+            "provider selection: %d lookups, %d selections, "
+            "%d target lookups made and %d saved, %d forgotten after changes, "
+            "%.3fs selecting" % (
+                self.lookups, self.selections, self.probes, self.saved,
+                self.forgotten, self.elapsed))
+
+
+class ProbeRecorder(object):
+
+    """ Stands in for the context while a provider is selected, and notes
+    which paths on the target are looked at. Anything other than looking at
+    a path (such as running a command) means the selection could depend on
+    anything, and ``paths`` becomes None. """
+
+    path_methods = frozenset((
+        "exists", "lexists", "isfile", "isdir", "islink", "stat", "lstat",
+        "readlink",
+    ))
+
+    def __init__(self, context):
+        self.context = context
+        self.paths = set()
+        self.probes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    @property
+    def transport(self):
+        return TransportRecorder(self, self.context.transport)
+
+    def record(self, name, args):
+        self.probes += 1
+        if self.paths is None:
+            return
+        if name in self.path_methods and args:
+            self.paths.add(posixpath.normpath(args[0]))
+        elif name == "probe" and args:
+            self.paths.update(posixpath.normpath(p) for p in args[0])
+        else:
+            self.paths = None
+
+
+class TransportRecorder(object):
+
+    def __init__(self, recorder, transport):
+        self.recorder = recorder
+        self.transport = transport
+
+    def __getattr__(self, name):
+        attr = getattr(self.transport, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.recorder.record(name, args)
+            return attr(*args, **kwargs)
+        return call
+
+
 class ArgumentAssertion(object):
 
     """ An assertion of the state of an argument """
@@ -171,10 +301,10 @@ class XOR(ArgumentAssertion):
         self.args = args
 
     def test(self, resource):
-        l = [1 for a in self.args if a.test(resource)]
-        if len(l) == 0:
+        passed = [1 for a in self.args if a.test(resource)]
+        if len(passed) == 0:
             return False
-        elif len(l) == 1:
+        elif len(passed) == 1:
             return True
         else:
             return False
@@ -193,8 +323,8 @@ class OR(ArgumentAssertion):
         self.args = args
 
     def test(self, resource):
-        l = [1 for a in self.args if a.test(resource)]
-        if len(l) == 0:
+        passed = [1 for a in self.args if a.test(resource)]
+        if len(passed) == 0:
             return False
         else:
             return True
@@ -14,12 +14,13 @@
 
 from .execute import ShellCommand
 from .attributes import AttributeChanger
-from .file import EnsureFile
+from .file import EnsureFile, FileContents
 from .directory import EnsureDirectory
 
 __all__ = [
     "ShellCommand",
     "AttributeChanger",
     "EnsureFile",
+    "FileContents",
     "EnsureDirectory",
 ]
@@ -29,6 +29,9 @@ class AttributeChanger(changes.Change):
         self.mode = mode
         self.changed = False
 
+    def get_paths(self):
+        return [self.filename]
+
     def apply(self, context, renderer):
         """ Apply the changes """
 
@@ -37,8 +40,8 @@ class AttributeChanger(changes.Change):
         gid = None
         mode = None
 
-        if transport.exists(self.filename):
-            st = transport.stat(self.filename)
+        st = transport.probe([self.filename])[0].stat
+        if st is not None:
             uid = st.st_uid
             gid = st.st_gid
             mode = stat.S_IMODE(st.st_mode)
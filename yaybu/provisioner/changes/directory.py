@@ -26,6 +26,9 @@ class EnsureDirectory(changes.Change):
         self.mode = mode
         self.recursive = recursive
 
+    def get_paths(self):
+        return [self.path]
+
     def apply(self, context, renderer):
         self.changed = False
         if not context.transport.exists(self.path):
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import difflib
+import hashlib
+import os
 import string
 
 from yaybu import changes
@@ -22,22 +24,135 @@ from .attributes import AttributeChanger
 
 def binary_buffers(*buffers):
     """ Check all of the passed buffers to see if any of them are binary. If
-    any of them are binary this will return True. """
-    check = lambda buff: len(buff) == sum(
-        1 for c in buff if c in string.printable)
+    any of them are binary this will return True.
+
+    A buffer with a NUL near the start is binary. Otherwise it is binary if
+    it has anything that isn't in ``string.printable``, which is checked with
+    ``translate`` rather than a character at a time. """
     for buff in buffers:
-        if buff and not check(buff):
+        if not buff:
+            continue
+        if "\0" in buff[:8192]:
+            return True
+        if isinstance(buff, unicode):
+            try:
+                buff = buff.encode("ascii")
+            except UnicodeEncodeError:
+                return True
+        if buff.translate(None, string.printable):
             return True
     return False
 
 
+class FileContents(object):
+
+    """ The contents of a file that are on local disk, such as a copy in the
+    asset cache. They are streamed from there when they are needed rather
+    than being kept in memory, and digests are worked out a chunk at a
+    time. """
+
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.digests = {}
+
+    def open(self):
+        return open(self.path, "rb")
+
+    def read(self):
+        with self.open() as fp:
+            return fp.read()
+
+    def hexdigest(self, algorithm):
+        if algorithm not in self.digests:
+            h = hashlib.new(algorithm)
+            with self.open() as fp:
+                for chunk in iter(lambda: fp.read(self.chunk_size), ""):
+                    h.update(chunk)
+            self.digests[algorithm] = h.hexdigest()
+        return self.digests[algorithm]
+
+
+def digest(contents, algorithm="sha1"):
+    """ A hex digest of some file contents, which can be a string or
+    ``FileContents`` """
+    if isinstance(contents, FileContents):
+        return contents.hexdigest(algorithm)
+    if isinstance(contents, unicode):
+        contents = contents.encode("utf-8")
+    return hashlib.new(algorithm, contents).hexdigest()
+
+
+def size(contents):
+    if isinstance(contents, FileContents):
+        return contents.size
+    return len(contents)
+
+
+def text(contents):
+    """ File contents as a string, reading them into memory if need be """
+    if isinstance(contents, FileContents):
+        return contents.read()
+    return contents
+
+
+def common_prefix(a, b):
+    """ The length of the longest common prefix of two strings. Slices are
+    compared rather than characters, so that the work is done in C. """
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def common_suffix(a, b, limit):
+    """ The length of the longest common suffix of two strings, up to
+    ``limit`` """
+    low, high = 0, min(len(a), len(b), limit)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def changed_lines(previous, replacement):
+    """ Count the lines that only appear in one of two versions of a file.
+    Lines at the start and end that are the same in both are skipped
+    without being split up. """
+    start = common_prefix(previous, replacement)
+    start = previous.rfind("\n", 0, start) + 1
+
+    end = common_suffix(previous, replacement, min(len(previous), len(replacement)) - start)
+    newline = previous.find("\n", len(previous) - end)
+    end = len(previous) - newline - 1 if newline != -1 else 0
+
+    counts = {}
+    for line in previous[start:len(previous) - end].splitlines():
+        counts[line] = counts.get(line, 0) + 1
+    for line in replacement[start:len(replacement) - end].splitlines():
+        counts[line] = counts.get(line, 0) - 1
+    return sum(abs(count) for count in counts.values())
+
+
 class EnsureFile(changes.Change):
 
     """ Apply a content change to a file in a managed way. Simulation mode is
     catered for. Additionally the minimum changes required to the contents are
-    applied, and logs of the changes made are recorded. """
+    applied, and logs of the changes made are recorded.
+
+    ``contents`` can be ``FileContents``, which are compared by digest and
+    streamed to the target. """
 
-    def __init__(self, filename, contents, user, group, mode, sensitive):
+    def __init__(self, filename, contents, user, group, mode, sensitive, delta=False):
         self.filename = filename
         self.current = ""
         self.contents = contents
@@ -47,6 +162,10 @@ class EnsureFile(changes.Change):
         self.changed = False
         self.renderer = None
         self.sensitive = sensitive
+        self.delta = delta
+
+    def get_paths(self):
+        return [self.filename]
 
     def empty_file(self, context):
         """ Write an empty file """
@@ -62,21 +181,50 @@ class EnsureFile(changes.Change):
                     ShellCommand(["cp", "/dev/null", self.filename]))
                 self.changed = True
 
+    def show_diff(self, context):
+        """ Whether the previous contents are needed to log a diff """
+        if self.sensitive or context.verbose < 2:
+            return False
+        if size(self.contents) > FileChangeTextRenderer.diff_limit:
+            return False
+        # A diff isn't shown if either side is binary
+        if binary_buffers(text(self.contents)):
+            return False
+        # Don't fetch the current contents if they are too big to diff
+        st = context.transport.stat(self.filename)
+        return st.st_size <= FileChangeTextRenderer.diff_limit
+
+    def send(self, put):
+        """ Send the contents with ``put``, as a stream if they are
+        ``FileContents`` """
+        if isinstance(self.contents, FileContents):
+            with self.contents.open() as fp:
+                put(self.filename, fp, self.mode)
+        else:
+            put(self.filename, self.contents, self.mode)
+
     def overwrite_existing_file(self, context):
-        """ Change the content of an existing file """
-        self.current = context.transport.get(self.filename)
-        if self.current != self.contents:
+        """ Change the content of an existing file. The current contents are
+        compared by checksum on the target, and only transferred if they are
+        needed for the diff. """
+        if context.transport.checksum(self.filename, "sha256") != digest(self.contents, "sha256"):
+            self.current = None
+            if self.show_diff(context):
+                self.current = context.transport.get(self.filename)
             self.renderer.changed_file(
                 self.filename, self.current, self.contents, self.sensitive)
             if not context.simulate:
-                context.transport.put(self.filename, self.contents, self.mode)
+                if self.delta:
+                    self.send(context.transport.put_delta)
+                else:
+                    self.send(context.transport.put)
             self.changed = True
 
     def write_new_file(self, context):
         """ Write contents to a new file. """
         self.renderer.new_file(self.filename, self.contents, self.sensitive)
         if not context.simulate:
-            context.transport.put(self.filename, self.contents, self.mode)
+            self.send(context.transport.put)
         self.changed = True
 
     def write_file(self, context):
@@ -104,6 +252,14 @@ class EnsureFile(changes.Change):
 class FileChangeTextRenderer(changes.TextRenderer):
     renderer_for = EnsureFile
 
+    diff_limit = 1024 * 1024
+    """ Files bigger than this many bytes are summarised rather than diffed """
+
+    diff_lines = 10000
+    """ Files with more lines than this are summarised rather than diffed.
+    The time difflib takes grows with the square of the number of lines, and
+    at this size it is under a second even for the worst cases. """
+
     def empty_file(self, filename):
         self.logger.notice("Emptied file %s" % filename)
 
@@ -114,14 +270,38 @@ class FileChangeTextRenderer(changes.TextRenderer):
 
     def changed_file(self, filename, previous, replacement, sensitive):
         self.logger.notice("Changed file %s" % filename)
-        if not sensitive:
+        if not sensitive and previous is not None:
             self.diff(previous, replacement)
 
     def diff(self, previous, replacement):
-        if not binary_buffers(previous, replacement):
-            diff = "".join(difflib.unified_diff(
-                previous.splitlines(1), replacement.splitlines(1)))
-            for l in diff.splitlines():
-                self.logger.info("    %s" % l)
-        else:
+        if size(replacement) > self.diff_limit:
+            self.summary(previous, replacement)
+            return
+        replacement = text(replacement)
+
+        if binary_buffers(previous, replacement):
             self.logger.notice("Binary contents; not showing delta")
+            return
+
+        if max(len(previous), len(replacement)) > self.diff_limit:
+            self.summary(previous, replacement)
+            return
+
+        if max(previous.count("\n"), replacement.count("\n")) > self.diff_lines:
+            self.summary(previous, replacement)
+            return
+
+        diff = "".join(difflib.unified_diff(
+            previous.splitlines(1), replacement.splitlines(1)))
+        for l in diff.splitlines():
+            self.logger.info("    %s" % l)
+
+    def summary(self, previous, replacement):
+        """ Log how many lines changed instead of a diff. Contents that are
+        only on disk aren't read in to count them. """
+        if isinstance(replacement, FileContents):
+            self.logger.notice("%d bytes, digest %s -> %s" % (
+                replacement.size, digest(previous), digest(replacement)))
+            return
+        self.logger.notice("%d lines changed, digest %s -> %s" % (
+            changed_lines(previous, replacement), digest(previous), digest(replacement)))
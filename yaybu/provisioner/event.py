@@ -13,11 +13,25 @@
 # limitations under the License.
 
 import json
+import time
+
+from gevent.lock import RLock
 
 
 class EventState(object):
 
-    """ Represents the current state of events """
+    """ Represents the current state of events
+
+    The overrides are saved as a journal. The first line of ``save_file`` is
+    a snapshot of the overrides, and every override that is set or cleared
+    afterwards is appended as a line of its own, so each event only needs a
+    small write. Replaying the journal ignores a line that was only partly
+    written, so an interrupted run can always be resumed. ``compact``
+    replaces the journal with a new snapshot.
+
+    The journal also has a checkpoint for each resource that has been
+    applied. They are written in batches, at most every
+    ``checkpoint_interval`` seconds, and when the run fails. """
 
     save_file = "events.saved"
     """ The file to save to.  This is touched by the runner. """
@@ -26,28 +40,70 @@ class EventState(object):
     """ A mapping of resource ids to the overridden policy name for that
     resource, if there is one. """
 
+    checkpoints = {}
+    """ A mapping of resource ids to the digest they had when they were
+    applied, for every resource applied by the run being resumed and this
+    one. """
+
+    checkpoint_interval = 30
+
     def __init__(self, load=False):
         self.loaded = not load
         self.overrides = {}
+        self.checkpoints = {}
+        self.pending = []
+        self.flushed = time.time()
         self.simulate = False
+        self.journaled = False
+        self.lock = RLock()
 
     def load(self):
         if self.loaded:
             return
         if self.transport.exists(self.save_file):
-            self.overrides = json.loads(self.transport.get(self.save_file))
+            self.replay(self.transport.get(self.save_file))
         self.loaded = True
 
+    def replay(self, journal):
+        """ Rebuild the overrides and checkpoints from the contents of
+        ``save_file``. """
+        self.overrides = {}
+        self.checkpoints = {}
+        for line in journal.splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # An entry is incomplete if Yaybu was interrupted while it was
+                # being written. Anything after it is from a resumed run.
+                continue
+            if isinstance(entry, dict):
+                self.overrides = entry
+            elif len(entry) == 3:
+                self.checkpoints[entry[1]] = entry[2]
+            elif entry[1] is None:
+                self.overrides.pop(entry[0], None)
+            else:
+                self.overrides[entry[0]] = entry[1]
+
+    def saved_overrides(self):
+        """ Return the overrides in ``save_file`` that still need handling,
+        without loading its checkpoints. """
+        saved = EventState()
+        saved.replay(self.transport.get(self.save_file))
+        return saved.overrides
+
     def override(self, resource, policy):
         self.load()
         self.overrides[resource.id] = policy
-        self.save()
+        self.record(resource.id, policy)
 
     def clear_override(self, resource):
         self.load()
         if resource.id in self.overrides:
             del self.overrides[resource.id]
-            self.save()
+            self.record(resource.id, None)
 
     def overridden_policy(self, resource):
         """ Return the policy class for this resource, or None if there is not
@@ -59,7 +115,46 @@ class EventState(object):
         else:
             return None
 
-    def save(self):
-        if not self.simulate:
-            data = json.dumps(self.overrides)
-            self.transport.put(self.save_file, data)
+    def checkpoint(self, resource, digest):
+        """ Remember that ``resource`` has been applied. """
+        with self.lock:
+            self.checkpoints[resource.id] = digest
+            self.pending.append(["checkpoint", resource.id, digest])
+            if time.time() - self.flushed >= self.checkpoint_interval:
+                self.record()
+
+    def completed(self, resource, digest):
+        """ True if ``resource`` was applied by the run being resumed, and
+        nothing has changed what applying it would do. """
+        self.load()
+        return self.checkpoints.get(resource.id) == digest
+
+    def record(self, resource_id=None, policy=None):
+        """ Append a change to the journal, along with any checkpoints that
+        haven't been written yet. A policy of None clears the override. """
+        with self.lock:
+            entries = self.pending
+            if resource_id is not None:
+                entries.append([resource_id, policy])
+            self.pending = []
+            self.flushed = time.time()
+            if entries and not self.simulate:
+                # Resources applied at the same time can record at once, so
+                # make sure each entry is written whole
+                self.transport.append(
+                    self.save_file, "".join("\n" + json.dumps(e) for e in entries))
+                self.journaled = True
+
+    def compact(self):
+        """ Replace the journal with a snapshot of the current overrides and
+        checkpoints. The snapshot is written next to the journal and then
+        moved over it, so one of them is always complete. """
+        with self.lock:
+            if self.simulate or not (self.journaled or self.pending):
+                return
+            compacted = self.save_file + ".compact"
+            self.transport.put(compacted, json.dumps(self.overrides) + "".join(
+                "\n" + json.dumps(["checkpoint", k, v]) for k, v in sorted(self.checkpoints.items())))
+            self.transport.rename(compacted, self.save_file)
+            self.pending = []
+            self.journaled = False
@@ -0,0 +1,153 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import time
+
+
+def digest(*parts):
+    """ Return a hex digest of some JSON serializable values """
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str)).hexdigest()
+
+
+def resolve_arguments(resource):
+    """ Return the resolved value of every argument of a resource, apart from
+    its policy """
+    arguments = {}
+    for name in resource.get_argument_names():
+        if name != "policy":
+            arguments[name] = getattr(resource, name).resolve()
+    return arguments
+
+
+def stat_fingerprint(info):
+    """ The parts of a ``probe_result`` that change when a path is touched """
+    fingerprint = []
+    for st in (info.stat, info.lstat):
+        if st is None:
+            fingerprint.append(None)
+        else:
+            fingerprint.append((
+                st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime))
+    return fingerprint
+
+
+class FingerprintState(object):
+
+    """ Remembers a fingerprint for each resource that was applied, so that a
+    later run can skip resources whose fingerprint hasn't changed.
+
+    A fingerprint combines what the provider would do (its arguments and
+    anything rendered from them) with the state of the resource's paths on
+    the target. Every ``verify_every`` seconds every resource is applied
+    anyway.
+
+    The paths of every resource are looked at together before any are
+    applied. Once a resource has changed something, the paths of the
+    resources that haven't been reached yet are looked at again. """
+
+    save_file = "fingerprints.saved"
+    """ The file to save to. This is set by the runner. """
+
+    def __init__(self, transport, verify_every=86400):
+        self.transport = transport
+        self.verify_every = verify_every
+        self.simulate = False
+        self.fingerprints = {}
+        self.verified = 0
+        self.full = True
+        self.resources = []
+        self.remote = {}
+        self.generation = 0
+        self.pending = {}
+
+    def load(self):
+        if self.transport.exists(self.save_file):
+            data = json.loads(self.transport.get(self.save_file))
+            self.fingerprints = data["fingerprints"]
+            self.verified = data["verified"]
+        self.full = time.time() - self.verified >= self.verify_every
+
+    def save(self):
+        if not self.simulate:
+            data = json.dumps({
+                "fingerprints": self.fingerprints,
+                "verified": self.verified,
+            })
+            self.transport.put(self.save_file, data)
+
+    def probe(self, resources):
+        """ Look at the paths of all of ``resources`` with a single ``probe``.
+        Returns a mapping of resource id to remote fingerprint. """
+        paths = {}
+        for resource in resources:
+            paths[resource.id] = [p for p in resource.get_paths() or [] if p]
+
+        infos = {}
+        everything = sorted(set(p for v in paths.values() for p in v))
+        if everything:
+            for info in self.transport.probe(everything):
+                infos[info.path] = stat_fingerprint(info)
+
+        return dict(
+            (rid, [infos[p] for p in v]) for rid, v in paths.items())
+
+    def start(self, resources):
+        """ Called before ``resources`` are applied """
+        self.resources = list(resources)
+        self.remote = self.probe(self.resources)
+
+    def unchanged(self, resource, local):
+        """ True if ``resource`` can be skipped. Either way, its fingerprint is
+        updated once the run finishes. """
+        if self.full:
+            self.pending[resource.id] = local
+            return False
+
+        remote = self.remote
+        if resource.id not in remote:
+            generation = self.generation
+            remote = self.probe(
+                [r for r in self.resources if r.id not in self.pending] + [resource])
+            # Don't keep it if something changed while it was being fetched
+            if generation == self.generation:
+                self.remote = remote
+
+        self.pending[resource.id] = local
+        return self.fingerprints.get(resource.id) == digest(
+            local, remote.get(resource.id))
+
+    def applied(self, resource, changed):
+        """ Called once ``resource`` has been applied. If it changed anything,
+        or might have changed anything at all, what was seen of the other
+        resources' paths is thrown away. """
+        if changed or resource.get_paths() is None:
+            self.remote = {}
+            self.generation += 1
+
+    def finish(self, resources):
+        """ Called once all of ``resources`` have been applied (or skipped).
+        Records their fingerprints and saves them. If nothing was skipped this
+        counts as a verification sweep. """
+        fingerprints = {}
+        pending = [r for r in resources if r.id in self.pending]
+        for rid, remote in self.probe(pending).items():
+            fingerprints[rid] = digest(self.pending[rid], remote)
+        self.fingerprints = fingerprints
+        self.pending = {}
+
+        if self.full:
+            self.verified = time.time()
+        self.save()
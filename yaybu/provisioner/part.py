@@ -13,20 +13,23 @@
 # limitations under the License.
 
 import os
+import sys
 import logging
 import getpass
 import urlparse
 
+import gevent.local
 import yay
 from yay.errors import NotFound, NotModified
 
+from yaybu.core.policy import ProviderCache
 from yaybu.provisioner import resource
 from yaybu.changes import TextRenderer
 from yaybu import error
 from yaybu.error import MissingAsset, UnmodifiedAsset
 from yaybu import base
 
-from . import event, transports
+from . import event, fingerprint, transports
 
 
 logger = logging.getLogger(__name__)
@@ -48,6 +51,9 @@ class Provision(base.GraphExternalAction):
         "ssh": transports.SSHTransport,
     }
 
+    # Consecutive Provisioners are run at the same time
+    waits_for_hosts = False
+
     def apply(self):
         if self.root.readonly:
             return
@@ -62,6 +68,12 @@ class Provision(base.GraphExternalAction):
         self.port = self.params.server.port.as_int(default=22)
         self.password = self.params.server.password.as_string(default="")
         self.private_key = self.params.server.private_key.as_string(default="")
+        self.helper = self.params.server.helper.as_bool(default=False)
+        self.channels = self.params.server.channels.as_int(default=4)
+        self.sessions = self.params.server.sessions.as_bool(default=True)
+        self.parallel = self.params.server.parallel.as_int(default=4)
+        self.fast = self.params.server.fast.as_bool(default=False)
+        self.verify_every = self.params.server.verify_every.as_int(default=24)
 
         root = self.root
         self.ypath = root.ypath
@@ -70,6 +82,13 @@ class Provision(base.GraphExternalAction):
         self.simulate = root.simulate
         self.verbose = root.verbose
 
+        if root.serial:
+            self.parallel = 1
+
+        # Resources can be applied at the same time, so each greenlet has its
+        # own output section
+        self.outputs = gevent.local.local()
+
         self.options = {}
         if os.path.exists("/etc/yaybu"):
             self.options = yay.load_uri("/etc/yaybu")
@@ -86,7 +105,18 @@ class Provision(base.GraphExternalAction):
             simulate=root.simulate,
         )
 
-        with root.ui.throbber("Connect to '%s'" % hostname):
+        # When the whole graph is being resolved, hosts are provisioned in
+        # the background until a part that has to wait for them is reached
+        provisioners = getattr(root, "provisioners", None)
+        if provisioners is not None:
+            provisioners.spawn(hostname, self.provision)
+        else:
+            self.provision()
+
+    def provision(self):
+        """ Connect to the host and apply the resources to it. Returns True
+        if anything changed. """
+        with self.root.ui.throbber("Connect to '%s'" % self.host):
             self.transport.connect()
 
         if not self.simulate and not self.transport.exists(self.get_data_path()):
@@ -108,7 +138,9 @@ class Provision(base.GraphExternalAction):
         if self.transport.exists(self.state.save_file):
             if self.resume:
                 self.state.loaded = False
-            elif self.no_resume:
+            elif self.no_resume or not self.state.saved_overrides():
+                # Checkpoints on their own are only used by --resume, so a
+                # normal run just starts afresh
                 if not self.simulate:
                     self.transport.unlink(self.state.save_file)
                 self.state.loaded = True
@@ -116,30 +148,86 @@ class Provision(base.GraphExternalAction):
                 raise error.SavedEventsAndNoInstruction(
                     "There is a saved events file - you need to specify --resume or --no-resume")
 
+        self.provider_cache = ProviderCache()
+
+        self.fingerprints = None
+        if self.fast:
+            self.fingerprints = fingerprint.FingerprintState(
+                self.transport, self.verify_every * 3600)
+            self.fingerprints.save_file = self.get_data_path("fingerprints.saved")
+            self.fingerprints.simulate = self.simulate
+            self.fingerprints.load()
+
         # Actually apply the configuration
         bundle = resource.ResourceBundle.create_from_yay_expression(
             self.params.resources, verbose_errors=self.verbose > 2)
         bundle.bind()
 
-        with self.root.ui.throbber("Provision %s" % self.host) as throbber:
-            changed = bundle.apply(self, throbber)
+        try:
+            with self.root.ui.throbber("Provision %s" % self.host) as throbber:
+                changed = bundle.apply(self, throbber)
+        except Exception:
+            # Leave the events that still need handling in one piece for
+            # --resume
+            exc_info = sys.exc_info()
+            try:
+                self.state.compact()
+            except Exception:
+                # The journal can still be replayed, so don't hide the error
+                # that stopped the run
+                logger.exception("Unable to compact %s" % self.state.save_file)
+            raise exc_info[0], exc_info[1], exc_info[2]
         self.root.changed(changed)
 
+        logger.debug("%s: %s" % (self.host, self.provider_cache))
+        if hasattr(type(self.transport), "channel_stats"):
+            for stats in self.transport.channel_stats():
+                logger.debug("%s: %s" % (self.host, stats))
+
         if not self.simulate and self.transport.exists(self.state.save_file):
             self.transport.unlink(self.state.save_file)
 
+        return changed
+
     def test(self):
+        self.provider_cache = ProviderCache()
         bundle = resource.ResourceBundle.create_from_yay_expression(
             self.params.resources)
         bundle.bind()
         bundle.test(self)
 
+    @property
+    def current_output(self):
+        return getattr(self.outputs, "current", None)
+
+    @current_output.setter
+    def current_output(self, output):
+        self.outputs.current = output
+
     def change(self, change):
         renderer = TextRenderer.get(change, self.current_output)
-        return change.apply(self, renderer)
+        try:
+            return change.apply(self, renderer)
+        finally:
+            # The change might make a different provider valid
+            if getattr(change, "changed", True):
+                self.provider_cache.invalidate(change.get_paths())
+
+    @property
+    def templates(self):
+        """ The template environment shared by every host in this run """
+        return getattr(self.root, "templates", None)
+
+    @property
+    def renders(self):
+        """ What files rendered to, shared by every host in this run """
+        return getattr(self.root, "renders", None)
 
     def get_file(self, filename, etag=None):
+        assets = getattr(self.root, "assets", None)
         try:
+            if assets is not None:
+                return assets.open(self.root.openers, filename, etag)
             return self.root.openers.open(filename, etag)
         except NotModified as e:
             raise UnmodifiedAsset(str(e))
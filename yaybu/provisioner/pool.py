@@ -0,0 +1,91 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import time
+
+import gevent.pool
+
+
+class HostResult(object):
+
+    """ How provisioning a single host went """
+
+    def __init__(self, host):
+        self.host = host
+        self.changed = False
+        self.exc_info = None
+        self.duration = 0
+
+    def run(self, provision):
+        started = time.time()
+        try:
+            self.changed = provision()
+        except Exception:
+            self.exc_info = sys.exc_info()
+        finally:
+            self.duration = time.time() - started
+
+    def __str__(self):
+        if self.exc_info:
+            status = "failed: %s" % (self.exc_info[1], )
+        elif self.changed:
+            status = "changed"
+        else:
+            status = "no changes"
+        return "%s: %s (%.1fs)" % (self.host, status, self.duration)
+
+
+class ProvisionerPool(object):
+
+    """ Provisions up to ``size`` hosts at the same time. Each host's output
+    goes in its own section, and a summary of every host can be shown when
+    they have all finished. Once a host has failed no more are started. """
+
+    def __init__(self, ui, size):
+        self.ui = ui
+        self.pool = gevent.pool.Pool(size)
+        self.results = []
+
+    def spawn(self, host, provision):
+        self.check()
+        result = HostResult(host)
+        self.results.append(result)
+        self.pool.spawn(result.run, provision)
+
+    def wait(self):
+        """ Wait for every host to finish """
+        self.pool.join()
+
+    def check(self):
+        """ Raise the first error if any of the hosts has failed """
+        for result in self.results:
+            if result.exc_info:
+                exc_info = result.exc_info
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+    def join(self):
+        """ Wait for every host to finish, then raise the first error if any
+        of them failed. """
+        self.wait()
+        self.check()
+
+    def summary(self):
+        """ Show how each host went, if there was more than one """
+        if len(self.results) < 2:
+            return
+        with self.ui.throbber("Provisioned %d hosts" % len(self.results)) as task:
+            with task.section("Summary") as output:
+                for result in self.results:
+                    output.notice(str(result))
@@ -17,6 +17,7 @@
 from abc import ABCMeta, abstractmethod
 
 from yaybu.core import policy
+from yaybu.provisioner import fingerprint
 
 
 class ProviderType(ABCMeta):
@@ -40,6 +41,18 @@ class Provider(object):
     # these policies should all be for the same resource
     policies = []
 
+    # Bump this when a change to apply means resources need applying again
+    version = 1
+
+    # Whether fast runs can skip resources using this provider when their
+    # fingerprint hasn't changed. Only set this if everything apply does is
+    # decided by the resource's arguments and the state of its paths.
+    fingerprinted = False
+
+    # Whether consecutive resources using this provider can be applied
+    # together with apply_batch
+    batched = False
+
     def __init__(self, resource):
         self.resource = resource
 
@@ -56,6 +69,28 @@ class Provider(object):
         """ Checks as much as possible is valid - allowing the config to fail
         early """
 
+    def fingerprint(self, context):
+        """ Returns a digest of everything apart from the state of the target
+        that affects what ``apply`` would do, or None if this provider can't
+        be skipped. """
+        if not self.fingerprinted:
+            return None
+        return fingerprint.digest(
+            self.__class__.__name__,
+            self.version,
+            fingerprint.resolve_arguments(self.resource),
+        )
+
+    def checkpoint(self, context):
+        """ Returns a digest of what ``apply`` would do. Resuming an
+        interrupted run skips resources that it already applied with the same
+        digest. """
+        return self.fingerprint(context) or fingerprint.digest(
+            self.__class__.__name__,
+            self.version,
+            fingerprint.resolve_arguments(self.resource),
+        )
+
     @abstractmethod
     def apply(self, shell):
         """ Execute this provider using the supplied shell object. This base
@@ -64,6 +99,12 @@ class Provider(object):
         the Resource was already in the state the policy ensures). """
         return False
 
+    def apply_batch(self, context, output, batch):
+        """ Apply every resource in ``batch`` at once. Returns a mapping of
+        resource id to whether it changed anything. Resources that are left
+        out of the mapping are applied one at a time instead. """
+        raise NotImplementedError(self.apply_batch)
+
 
 class NullProvider(Provider):
     policies = [policy.NullPolicy]
@@ -18,42 +18,26 @@ from yaybu.provisioner import resources
 from yaybu.provisioner.changes import ShellCommand
 
 
-def is_installed(context, resource):
-    # work out if the package is already installed
-    command = ["dpkg-query", "-W", "-f='${Status}'", resource.name.as_string()]
-
-    try:
-        rc, stdout, stderr = context.transport.execute(command)
-    except error.SystemError as exc:
-        if exc.returncode == 1:
-            return False
-        # if the return code is anything but zero or one, we have a problem
-        raise error.DpkgError(
-            "%s search failed with return code %s" % (resource, exc.returncode))
-
-    # if the return code is 0, dpkg is aware of the package
-    if "install ok installed" in stdout:
-        return True
-
-    return False
+def is_installed(context, name):
+    """ True if dpkg says the package ``name`` is installed. Packages can be
+    given with an architecture, as in ``libc6:i386``, and otherwise are for
+    the native architecture. """
+    status = context.transport.packages().get(name)
+    return status is not None and status.installed
 
 
 class AptInstall(provider.Provider):
 
     policies = (resources.package.PackageInstallPolicy,)
 
-    def apply(self, context, output):
-        if is_installed(context, self.resource):
-            return False
+    batched = True
 
+    def install(self, context, names, what):
         env = {
             "DEBIAN_FRONTEND": "noninteractive",
         }
 
-        # the search returned 1, package is not installed, continue and install
-        # it
-        command = ["apt-get", "install", "-q",
-                   "-y", self.resource.name.as_string()]
+        command = ["apt-get", "install", "-q", "-y"] + names
 
         try:
             context.change(ShellCommand(command, env=env))
@@ -66,21 +50,55 @@ class AptInstall(provider.Provider):
                 except error.SystemError as exc:
                     raise error.AptError(
                         "%s with what looked like a recoverable error, but it wasn't (return code %d)" %
-                        (self.resource, exc.returncode))
+                        (what, exc.returncode))
             else:
                 raise error.AptError(
                     "%s failed with return code %d" %
-                    (self.resource, exc.returncode))
+                    (what, exc.returncode))
+
+    def apply(self, context, output):
+        if is_installed(context, self.resource.name.as_string()):
+            return False
 
+        # the search returned 1, package is not installed, continue and install
+        # it
+        self.install(
+            context, [self.resource.name.as_string()], str(self.resource))
         return True
 
+    def apply_batch(self, context, output, batch):
+        """ Install the packages in ``batch`` that are missing with a single
+        ``apt-get``. If that fails, the packages
+        are installed one at a time so the error is reported against the
+        right one. """
+        # Anything a trigger has changed the policy of isn't installed here
+        batch = [r for r in batch if not context.state.overridden_policy(r)]
+
+        names = dict((r.id, r.name.as_string()) for r in batch)
+        installed = set(
+            name for name in names.values() if is_installed(context, name))
+
+        missing = []
+        for resource in batch:
+            if names[resource.id] not in installed and names[resource.id] not in missing:
+                missing.append(names[resource.id])
+
+        if missing:
+            try:
+                self.install(context, missing, "Installing %s" % ", ".join(missing))
+            except error.AptError:
+                return {}
+
+        return dict(
+            (rid, name not in installed) for rid, name in names.items())
+
 
 class AptUninstall(provider.Provider):
 
     policies = (resources.package.PackageUninstallPolicy,)
 
     def apply(self, context, output):
-        if not is_installed(context, self.resource):
+        if not is_installed(context, self.resource.name.as_string()):
             return False
 
         env = {
@@ -17,8 +17,9 @@ import json
 
 from yaybu import error
 from yaybu.provisioner import resources
-from yaybu.provisioner import provider
-from yaybu.provisioner.changes import ShellCommand, EnsureFile
+from yaybu.provisioner import provider, fingerprint
+from yaybu.provisioner.changes import ShellCommand, EnsureFile, FileContents
+from yaybu.provisioner.changes.file import digest
 from yaybu.util import render_template
 
 
@@ -28,17 +29,22 @@ class File(provider.Provider):
 
     policies = (resources.file.FileApplyPolicy,)
 
+    fingerprinted = True
+    rendered = None
+
     def check_path(self, ctx, directory, simulate):
-        if ctx.transport.isdir(directory):
-            return
         frags = directory.split("/")
+        paths = []
         path = "/"
         for i in frags:
             path = os.path.join(path, i)
-            if not ctx.transport.exists(path):  # FIXME
+            paths.append(path)
+        for info in ctx.transport.probe(paths):
+            path = info.path
+            if not info.exists:  # FIXME
                 if not simulate:
                     raise error.PathComponentMissing("Directory '%s' is missing" % path)
-            elif not ctx.transport.isdir(path):
+            elif not info.isdir:
                 raise error.PathComponentNotDirectory("Path '%s' is not a directory" % path)
 
     def render_json(self, context):
@@ -77,8 +83,13 @@ class File(provider.Provider):
                 raise error.NoMatching("You must specify a 'source'")
 
         fp = context.get_file(source)
-        contents = fp.read()
         sensitive = "secret" in fp.labels
+        path = getattr(fp, "path", None)
+        if path:
+            # A copy in the asset cache is streamed rather than read in
+            fp.close()
+            return FileContents(path), sensitive
+        contents = fp.read()
         return contents, sensitive
 
     def render_empty(self, context):
@@ -97,7 +108,30 @@ class File(provider.Provider):
 
         return self.render_empty(context)
 
+    def render_key(self):
+        """ A digest of every argument that ``render`` uses. Files with the
+        same key render the same way, whichever host they are for. Whether
+        the arguments are secret is part of the key, as it decides whether
+        the rendered contents are sensitive. """
+        parts = []
+        for name in ("renderer", "source", "static", "template", "args", "template_args"):
+            argument = getattr(self.resource, name)
+            try:
+                parts.append((argument.resolve(), argument.contains_secrets()))
+            except error.NoMatching:
+                parts.append(None)
+        return fingerprint.digest(*parts)
+
     def render(self, context):
+        """ Returns the contents of the file and whether they are sensitive.
+        Files that have been rendered for another host are not rendered
+        again. """
+        renders = getattr(context, "renders", None)
+        if renders is None:
+            return self.render_contents(context)
+        return renders.get(self.render_key(), lambda: self.render_contents(context))
+
+    def render_contents(self, context):
         renderer = self.resource.renderer.as_string(default='guess')
         func_name = 'render_%s' % renderer
         if not hasattr(self, func_name):
@@ -108,12 +142,21 @@ class File(provider.Provider):
         with context.root.ui.throbber("Checking '%s can be rendered" % self.resource):
             self.render(context)
 
+    def fingerprint(self, context):
+        # The rendered contents are kept for apply
+        self.rendered = self.render(context)
+        contents = self.rendered[0]
+        return fingerprint.digest(
+            super(File, self).fingerprint(context),
+            contents and digest(contents),
+        )
+
     def apply(self, context, output):
         name = self.resource.name.as_string()
 
         self.check_path(context, os.path.dirname(name), context.simulate)
 
-        contents, sensitive = self.render(context)
+        contents, sensitive = self.rendered or self.render(context)
 
         fc = EnsureFile(
             name,
@@ -121,7 +164,8 @@ class File(provider.Provider):
             self.resource.owner.as_string(),
             self.resource.group.as_string(),
             self.resource.mode.resolve(),
-            sensitive)
+            sensitive,
+            delta=self.resource.delta.resolve())
         context.change(fc)
 
         return fc.changed
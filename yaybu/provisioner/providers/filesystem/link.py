@@ -24,6 +24,8 @@ class Link(provider.Provider):
 
     policies = (resources.link.LinkAppliedPolicy,)
 
+    fingerprinted = True
+
     def _get_owner(self, context):
         """ Return the uid for the resource owner, or None if no owner is
         specified. """
@@ -25,23 +25,23 @@ class Mount(provider.Provider):
     policies = (resources.mount.MountPolicy,)
 
     def check_path(self, context, directory):
-        if context.transport.isdir(directory):
-            return
-
         simulate = context.simulate
         transport = context.transport
         frags = directory.split("/")
+        paths = []
         path = "/"
         for i in frags:
             path = os.path.join(path, i)
-            if not transport.exists(path):
+            paths.append(path)
+        for info in transport.probe(paths):
+            if not info.exists:
                 if self.resource.parents.resolve():
                     return
                 if simulate:
                     return
-                raise error.PathComponentMissing(path)
-            if not transport.isdir(path):
-                raise error.PathComponentNotDirectory(path)
+                raise error.PathComponentMissing(info.path)
+            if not info.isdir:
+                raise error.PathComponentNotDirectory(info.path)
 
     def get_all_active_mounts(self, context):
         path = context.transport.get("/proc/mounts")
@@ -28,16 +28,18 @@ class Patch(provider.Provider):
     policies = (resources.patch.PatchApplyPolicy,)
 
     def check_path(self, ctx, directory, simulate):
-        if ctx.transport.isdir(directory):
-            return
         frags = directory.split("/")
+        paths = []
         path = "/"
         for i in frags:
             path = os.path.join(path, i)
-            if not ctx.transport.exists(path):  # FIXME
+            paths.append(path)
+        for info in ctx.transport.probe(paths):
+            path = info.path
+            if not info.exists:  # FIXME
                 if not simulate:
                     raise error.PathComponentMissing(path)
-            elif not ctx.transport.isdir(path):
+            elif not info.isdir:
                 raise error.PathComponentNotDirectory(path)
 
     def get_patch(self, context):
@@ -0,0 +1,39 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+class RenderCache(object):
+
+    """ Remembers what files rendered to, so that a file that renders the
+    same on many hosts is only rendered once. It is shared by every host in a
+    run. Templates and other assets can't change during a run, so a key only
+    needs to cover the arguments a file is rendered from. """
+
+    def __init__(self):
+        self.renders = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, render):
+        """ Return what ``render()`` returned the first time it was called
+        with ``key`` """
+        if key in self.renders:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.renders[key] = render()
+        return self.renders[key]
+
+    def __str__(self):
+        return "rendering: %d hits, %d misses" % (self.hits, self.misses)
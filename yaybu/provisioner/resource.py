@@ -16,7 +16,13 @@ from yaybu.core.argument import Property, List, PolicyArgument, String
 from yaybu.core import policy
 from yaybu import error
 import collections
+import posixpath
+import sys
 from yaybu.util.backports import OrderedDict
+from yaybu.util.paths import paths_overlap, parent_paths
+
+import gevent
+import gevent.pool
 
 from yay import errors
 from yay.ast import bind, PythonicWrapper
@@ -27,13 +33,33 @@ from yay.errors import LanguageError
 class ResourceType(type):
 
     """ Keeps a registry of resources as they are created, and provides some
-    simple access to their arguments. """
+    simple access to their arguments.
+
+    The ``Property`` declarations of each resource are collected into its
+    ``schema`` when the class is created, and each argument gets a slot on
+    the instances rather than living in a ``__dict__``. """
 
     resources = {}
 
     def __new__(meta, class_name, bases, new_attrs):
+        schema = {}
+        for base in reversed(bases):
+            schema.update(getattr(base, "schema", {}))
+
+        properties = dict(
+            (k, v) for k, v in new_attrs.items() if isinstance(v, Property))
+        for k in properties:
+            del new_attrs[k]
+
+        slots = list(new_attrs.get("__slots__", ()))
+        slots.extend(sorted(k for k in properties if k not in schema))
+        new_attrs["__slots__"] = tuple(slots)
+
+        schema.update(properties)
+
         cls = type.__new__(meta, class_name, bases, new_attrs)
 
+        cls.schema = OrderedDict(sorted(schema.items()))
         cls.policies = AvailableResourcePolicies()
 
         if class_name != 'Resource':
@@ -78,6 +104,12 @@ class Resource(object):
 
     __metaclass__ = ResourceType
 
+    __slots__ = ("inner", "observers", "batch", "_id", "_original_hash")
+
+    schema = OrderedDict()
+    """ The ``Property`` of each argument of this resource, by name. This is
+    worked out when the class is created. """
+
     policies = AvailableResourcePolicies()
     """ A dictionary of policy names mapped to policy classes (not objects).
 
@@ -123,27 +155,31 @@ class Resource(object):
                   on: File[/var/local/sites/foobar/apache/apache.cfg]
     """
 
+    lock = None
+    """ Resources with the same lock are never applied at the same time, for
+    example because the tools they use lock a system database. """
+
     def __init__(self, inner):
         """ Takes a reference to a Yay AST node """
         self.inner = PythonicWrapper(inner)
         self.inner.parent = inner.parent
         self.observers = collections.defaultdict(list)
 
-        for k in dir(self):
-            prop = getattr(self, k)
-            if isinstance(prop, Property):
-                i = getattr(self.inner, k)
-                i.inner.parent = inner.parent
-                i.parent = inner.parent
-                p = prop.klass(self, i, **prop.kwargs)
-                setattr(self, k, p)
+        # The Batch this resource is applied with, if its provider can apply
+        # it together with its neighbours
+        self.batch = None
+        self._id = None
+
+        for k, prop in self.schema.items():
+            i = getattr(self.inner, k)
+            i.inner.parent = inner.parent
+            i.parent = inner.parent
+            p = prop.klass(self, i, **prop.kwargs)
+            setattr(self, k, p)
 
     @classmethod
     def get_argument_names(klass):
-        for k in dir(klass):
-            attr = getattr(klass, k)
-            if isinstance(attr, Property):
-                yield k
+        return klass.schema.keys()
 
     def get_argument_values(self):
         """ Return all argument names and values in a dictionary. If an
@@ -153,6 +189,7 @@ class Resource(object):
         retval = {}
         for key in self.get_argument_names():
             retval[key] = getattr(self, key, None)
+        return retval
 
     def register_observer(self, when, resource, policy):
         self.observers[when].append((resource, policy))
@@ -179,7 +216,7 @@ class Resource(object):
 
         # Only allow keys that are in the schema
         for key in self.inner.keys():
-            if key not in self.get_argument_names():
+            if key not in self.schema:
                 raise error.ParseError(
                     "'%s' is not a valid option for resource %s" % (key, self),
                     self.inner.anchor)
@@ -211,8 +248,29 @@ class Resource(object):
             pol = pol_class(self)
         prov_class = pol.get_provider(context)
         prov = prov_class(self)
-        changed = prov.apply(context, output)
+
+        fingerprints = getattr(context, "fingerprints", None)
+        checkpoint = prov.checkpoint(context)
+        if policy is None and not context.state.overridden_policy(self):
+            # Resuming skips resources the interrupted run already applied
+            if context.state.completed(self, checkpoint):
+                return False
+
+            # Fast runs skip resources that haven't changed since last time,
+            # as long as no event has changed what they should do
+            if fingerprints:
+                local = prov.fingerprint(context)
+                if local is not None and fingerprints.unchanged(self, local):
+                    return False
+
+        if self.batch and getattr(prov, "batched", False):
+            changed = self.batch.apply(self, prov, context, output)
+        else:
+            changed = prov.apply(context, output)
+        if fingerprints:
+            fingerprints.applied(self, changed)
         context.state.clear_override(self)
+        context.state.checkpoint(self, checkpoint)
         if changed:
             self.fire_event(context, pol.name)
         return changed
@@ -233,6 +291,28 @@ class Resource(object):
                 bound.append(trigger.bind(resources, self))
         return bound
 
+    def get_paths(self):
+        """ Return a list of the paths on the target that applying this
+        resource might change. Resources that touch different paths can be
+        applied at the same time. The default of None means the resource might
+        change anything, so it is applied on its own. """
+        return None
+
+    def get_references(self):
+        """ Return the ids of other resources this resource refers to, such
+        as the ``User`` that owns a file. """
+        return []
+
+    def get_selected_provider(self, context):
+        """ Return the provider class this resource would be applied with,
+        ignoring any policy overridden by an event. """
+        policy = self.policy.resolve()
+        if policy:
+            selected = policy.literal_policy(self)
+        else:
+            selected = self.policies.default()
+        return selected(self).get_provider(context)
+
     def get_potential_policies(self):
         policy = self.policy.resolve()
         if policy:
@@ -253,13 +333,66 @@ class Resource(object):
 
     @property
     def id(self):
-        classname = getattr(self, '__resource_name__', self.__class__.__name__)
-        return "%s[%s]" % (classname, self.inner.name.as_string())
+        if self._id is None:
+            classname = getattr(self, '__resource_name__', self.__class__.__name__)
+            self._id = "%s[%s]" % (classname, self.inner.name.as_string())
+        return self._id
 
     def __repr__(self):
         return self.id
 
 
+class Footprint(object):
+
+    """ What applying a resource might touch. Resources whose footprints
+    conflict are applied in the order they are declared. """
+
+    def __init__(self, resource):
+        self.id = resource.id
+        self.lock = resource.lock
+
+        paths = resource.get_paths()
+        self.everything = paths is None
+        self.paths = [posixpath.normpath(p) for p in (paths or []) if p]
+        self.paths.extend(posixpath.normpath(p) for p in resource.watch.resolve())
+
+        self.references = set(resource.get_references())
+        for observers in resource.observers.values():
+            self.references.update(r.id for r, policy in observers)
+
+    def conflicts(self, other):
+        if self.everything or other.everything:
+            return True
+        if self.lock and self.lock == other.lock:
+            return True
+        if self.id in other.references or other.id in self.references:
+            return True
+        for a in self.paths:
+            for b in other.paths:
+                if paths_overlap(a, b):
+                    return True
+        return False
+
+
+class Batch(object):
+
+    """ A run of consecutive resources whose provider can apply them all at
+    once. The first member to be applied applies the whole batch, and the
+    rest just pick up their result. """
+
+    def __init__(self, resources):
+        self.resources = resources
+        self.results = None
+
+    def apply(self, resource, prov, context, output):
+        if self.results is None:
+            self.results = prov.apply_batch(context, output, self.resources)
+        if resource.id in self.results:
+            return self.results[resource.id]
+        # Anything the batch didn't deal with is applied on its own
+        return prov.apply(context, output)
+
+
 class ResourceBundle(OrderedDict):
 
     """ An ordered, indexed collection of resources. Pass in a specification
@@ -366,22 +499,137 @@ class ResourceBundle(OrderedDict):
 
     def bind(self):
         """ Bind all the resources so they can observe each others for policy
-        triggers. """
+        triggers. A resource can only be triggered by resources declared
+        before it, which also rules out cycles. """
+        position = dict((rid, i) for i, rid in enumerate(self.keys()))
+
+        triggered_by = {}
+        for resource in self.values():
+            triggered_by[resource.id] = [b.id for b in resource.bind(self)]
+
         for i, resource in enumerate(self.values()):
-            for bound in resource.bind(self):
-                if bound == resource:
+            for bound in triggered_by[resource.id]:
+                if bound == resource.id:
                     raise error.BindingError(
-                        "Attempt to bind %r to itself!" % resource)
-                j = self.values().index(bound)
-                if j > i:
+                        "Attempt to bind %r to itself!" % resource,
+                        anchor=resource.name.anchor)
+                if position[bound] > i:
                     raise error.BindingError(
-                        "Attempt to bind forwards on %r" % resource)
+                        self.describe_forward_binding(resource.id, bound, triggered_by),
+                        anchor=resource.name.anchor)
+
+    def describe_forward_binding(self, rid, bound, triggered_by):
+        """ Explain why ``rid`` can't be triggered by ``bound``, which is
+        declared after it. If ``bound`` is itself triggered by ``rid`` (maybe
+        indirectly) the whole cycle is described. """
+        previous = {bound: None}
+        queue = collections.deque([bound])
+        while queue and rid not in previous:
+            current = queue.popleft()
+            for next in triggered_by[current]:
+                if next not in previous:
+                    previous[next] = current
+                    queue.append(next)
+
+        if rid not in previous:
+            return "Attempt to bind forwards on %s: it is triggered by %s, which is declared after it" % (
+                rid, bound)
+
+        chain, current = [], rid
+        while current is not None:
+            chain.append(current)
+            current = previous[current]
+        path = [rid] + list(reversed(chain))
+        return "Attempt to bind forwards on %s: triggers form a cycle: %s" % (
+            rid, " is triggered by ".join(path))
 
     def test(self, ctx):
         for resource in self.values():
             resource.validate(ctx)
             resource.test(ctx)
 
+    def dependencies(self):
+        """ Return a mapping of each resource id to the resources declared
+        before it that must be applied before it can start.
+
+        The earlier footprints are indexed as the resources are walked, so
+        this doesn't compare every pair of resources. A resource only waits
+        for the most recent of a chain of resources that conflict with each
+        other, as that one can't start until the rest have finished. """
+        position = {}
+        dependencies = {}
+
+        everything, since_everything = None, []
+        locks = {}
+        ids = {}
+        referenced_by = collections.defaultdict(list)
+        # The last resource to touch exactly a path, and every resource that
+        # touched something inside a path since the last one to touch it
+        at = {}
+        under = collections.defaultdict(list)
+
+        for i, resource in enumerate(self.values()):
+            position[resource] = i
+            footprint = Footprint(resource)
+            found = set()
+
+            if footprint.everything:
+                found.update(since_everything)
+            if everything is not None:
+                found.add(everything)
+            if footprint.lock and footprint.lock in locks:
+                found.add(locks[footprint.lock])
+            found.update(ids[ref] for ref in footprint.references if ref in ids)
+            found.update(referenced_by.pop(footprint.id, []))
+            for path in footprint.paths:
+                found.update(under[path])
+                found.update(at[a] for a in parent_paths(path) if a in at)
+
+            dependencies[resource.id] = sorted(found, key=position.get)
+
+            if footprint.everything:
+                everything, since_everything = resource, []
+            else:
+                since_everything.append(resource)
+            if footprint.lock:
+                locks[footprint.lock] = resource
+            ids[footprint.id] = resource
+            for ref in footprint.references:
+                referenced_by[ref].append(resource)
+            for path in footprint.paths:
+                at[path] = resource
+                under[path] = [resource]
+                for a in parent_paths(path):
+                    under[a].append(resource)
+
+        return dependencies
+
+    def batch(self, ctx):
+        """ Group runs of consecutive resources with the same batched provider
+        so they can be applied together. Resources whose policy can be changed
+        by a trigger are always applied on their own. """
+        batches = []
+        run, run_provider = [], None
+        for resource in self.values():
+            provider = None
+            policy = resource.policy.resolve()
+            if not (policy and policy.triggers):
+                provider = resource.get_selected_provider(ctx)
+                if not getattr(provider, "batched", False):
+                    provider = None
+            if provider is None or provider is not run_provider:
+                batches.append(run)
+                run, run_provider = [], provider
+            if provider is not None:
+                run.append(resource)
+        batches.append(run)
+
+        for resources in batches:
+            if len(resources) > 1:
+                batch = Batch(resources)
+                for resource in resources:
+                    resource.batch = batch
+
     def apply(self, ctx, throbber):
         """ Apply the resources to the system, using the provided context and
         overall configuration. """
@@ -390,7 +638,28 @@ class ResourceBundle(OrderedDict):
             if hasattr(resource, "_original_hash"):
                 resource._original_hash = resource.hash(ctx)
 
+        self.batch(ctx)
+
         throbber.set_upper(len(self.values()))
+
+        fingerprints = getattr(ctx, "fingerprints", None)
+        if fingerprints:
+            fingerprints.start(self.values())
+
+        parallel = getattr(ctx, "parallel", 1)
+        if parallel > 1:
+            something_changed = self.apply_parallel(ctx, throbber, parallel)
+        else:
+            something_changed = self.apply_serial(ctx, throbber)
+
+        if fingerprints:
+            fingerprints.finish(self.values())
+
+        return something_changed
+
+    def apply_serial(self, ctx, throbber):
+        """ Apply the resources one at a time, in the order they are
+        declared. """
         something_changed = False
         for i, resource in enumerate(self.values(), start=1):
             with throbber.section(resource.id) as output:
@@ -401,3 +670,52 @@ class ResourceBundle(OrderedDict):
             throbber.set_current(i)
 
         return something_changed
+
+    def apply_parallel(self, ctx, throbber, size):
+        """ Apply up to ``size`` resources at a time. Resources are started in
+        the order they are declared, each one as soon as the resources it
+        depends on have finished, so output appears in the same order as a
+        serial run. If a resource fails no more are started, and the first
+        failure is raised once the others have finished. """
+        dependencies = self.dependencies()
+        pool = gevent.pool.Pool(size)
+        greenlets = OrderedDict()
+        finished = []
+        failed = []
+
+        def apply(resource, section):
+            with section as output:
+                ctx.current_output = output
+                try:
+                    return resource.apply(ctx, output), None
+                except Exception:
+                    failed.append(resource)
+                    return False, sys.exc_info()
+                finally:
+                    ctx.current_output = None
+                    finished.append(resource)
+                    throbber.set_current(len(finished))
+
+        try:
+            for resource in self.values():
+                for dependency in dependencies[resource.id]:
+                    greenlets[dependency.id].join()
+                if failed:
+                    break
+                section = throbber.section(resource.id)
+                greenlets[resource.id] = pool.spawn(apply, resource, section)
+
+            pool.join()
+        finally:
+            # If the run is killed, stop everything it started
+            pool.kill()
+
+        something_changed = False
+        for g in greenlets.values():
+            if isinstance(g.value, gevent.GreenletExit):
+                raise g.value
+            changed, exc_info = g.value
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            something_changed = something_changed or changed
+        return something_changed
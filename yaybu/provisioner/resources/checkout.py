@@ -70,6 +70,15 @@ class Checkout(Resource):
     you like, but this is not required. DO NOT use yaml Octal representation
     (0o666), this will NOT work."""
 
+    def get_paths(self):
+        return [self.name.as_string()]
+
+    def get_references(self):
+        return [
+            "User[%s]" % self.user.as_string(),
+            "Group[%s]" % self.group.as_string(),
+        ]
+
 
 class CheckoutSyncPolicy(Policy):
 
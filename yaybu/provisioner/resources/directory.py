@@ -15,6 +15,7 @@
 """ Resources dealing with filesystem objects other than files. """
 
 from yaybu.provisioner.resource import Resource
+from yaybu.util.paths import parent_paths
 from yaybu.core.policy import (Policy,
                                Absent,
                                Present,
@@ -59,6 +60,20 @@ class Directory(Resource):
     """ Create parent directories as needed, using the same ownership and
     permissions, this is False by default. """
 
+    def get_paths(self):
+        name = self.name.as_string()
+        paths = [name]
+        if self.parents.resolve():
+            # Any missing parent is created too. The root always exists.
+            paths.extend(p for p in parent_paths(name) if p != "/")
+        return paths
+
+    def get_references(self):
+        return [
+            "User[%s]" % self.owner.as_string(),
+            "Group[%s]" % self.group.as_string(),
+        ]
+
 
 class DirectoryAppliedPolicy(Policy):
 
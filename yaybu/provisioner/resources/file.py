@@ -16,7 +16,6 @@
 both the metadata associated with the file (for example owner and permission)
 and the contents of the files themselves. """
 
-import hashlib
 
 from yaybu.provisioner.resource import Resource
 from yaybu.core.policy import (Policy,
@@ -31,6 +30,7 @@ from yaybu.core.argument import (
     Octal,
     File,
     Dict,
+    Boolean,
 )
 
 
@@ -93,6 +93,11 @@ class File(Resource):
     args = Property(Dict, default={})
     """ The arguments passed to the renderer."""
 
+    delta = Property(Boolean, default=False)
+    """ If this is true and the file already exists, only the parts of it that
+    have changed are sent to the server. This needs the SSH ``helper``; without
+    it the whole file is sent as normal. """
+
     static = Property(File)
     """ DEPRECATED: A static file to copy into this resource. The file is
     located on the yaybu path, so can be colocated with your recipes."""
@@ -105,11 +110,20 @@ class File(Resource):
     template_args = Property(Dict, default={})
     """ DEPRECATED: The arguments passed to the template."""
 
+    def get_paths(self):
+        return [self.name.as_string()]
+
+    def get_references(self):
+        return [
+            "User[%s]" % self.owner.as_string(),
+            "Group[%s]" % self.group.as_string(),
+        ]
+
     def hash(self, ctx):
         name = self.name.as_string()
         if not ctx.transport.exists(name):
             return ""
-        return hashlib.sha1(ctx.transport.get(name)).hexdigest() + \
+        return ctx.transport.checksum(name, "sha1") + \
             str(ctx.transport.stat(name).st_mtime)
 
 
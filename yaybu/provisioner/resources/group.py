@@ -51,6 +51,11 @@ class Group(Resource):
     password = Property(String)
     """ The password for the group, if required """
 
+    lock = "identity"
+
+    def get_paths(self):
+        return []
+
 
 class GroupApplyPolicy(Policy):
 
@@ -60,6 +60,15 @@ class Link(Resource):
     """ The pathname to which to link the symlink. Dangling symlinks ARE
     considered errors in Yaybu. """
 
+    def get_paths(self):
+        return [self.name.as_string(), self.to.as_string()]
+
+    def get_references(self):
+        return [
+            "User[%s]" % self.owner.as_string(),
+            "Group[%s]" % self.group.as_string(),
+        ]
+
 
 class LinkAppliedPolicy(Policy):
     resource = Link
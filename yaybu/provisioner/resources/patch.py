@@ -70,6 +70,15 @@ class Patch(Resource):
     template_args = Property(Dict, default={})
     """The arguments passed to the template."""
 
+    def get_paths(self):
+        return [self.name.as_string(), self.source.as_string()]
+
+    def get_references(self):
+        return [
+            "User[%s]" % self.owner.as_string(),
+            "Group[%s]" % self.group.as_string(),
+        ]
+
 
 class PatchApplyPolicy(Policy):
 
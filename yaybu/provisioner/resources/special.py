@@ -65,6 +65,15 @@ class Special(Resource):
     """ The minor number for the special file. If the type of the special file
     is block or character, then this must be specified. """
 
+    def get_paths(self):
+        return [self.name.as_string()]
+
+    def get_references(self):
+        return [
+            "User[%s]" % self.owner.as_string(),
+            "Group[%s]" % self.group.as_string(),
+        ]
+
 
 class SpecialAppliedPolicy(Policy):
 
@@ -86,6 +86,17 @@ class User(Resource):
     disabled_login = Property(Boolean, default=False)
     """ A boolean for whether this entire account is locked or not. """
 
+    lock = "identity"
+
+    def get_paths(self):
+        # useradd -m creates the home directory
+        home = self.home.as_string(default='')
+        return [home or "/home/%s" % self.name.as_string()]
+
+    def get_references(self):
+        groups = [self.group.as_string()] + list(self.groups.resolve() or [])
+        return ["Group[%s]" % group for group in groups if group]
+
 
 class UserApplyPolicy(Policy):
 
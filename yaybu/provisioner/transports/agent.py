@@ -0,0 +1,329 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A mixin for transports that can start a long-lived helper process on the
+remote host and send it all of their primitives over a single channel, rather
+than spawning a new process for every call.
+"""
+
+import functools
+import hashlib
+import os
+import pkgutil
+
+import gevent
+from gevent.lock import RLock
+from gevent.queue import Queue
+
+from yaybu import error
+from . import agent_server, delta
+from .base import probe_result
+from .remote import stat_result, struct_passwd, struct_group, struct_spwd, identity_files
+
+
+# Python one-liner that reads the agent source from stdin and runs it
+BOOTSTRAP = (
+    'import sys; f = getattr(sys.stdin, "buffer", sys.stdin); '
+    'exec(f.read(int(f.readline())))'
+)
+
+errors = {
+    "OSError": OSError,
+    "KeyError": KeyError,
+}
+
+
+def get_agent_source():
+    return pkgutil.get_data(__name__.rsplit(".", 1)[0], "agent_server.py")
+
+
+class Agent(object):
+
+    """ The client side of a running agent. ``stdin`` and ``stdout`` are
+    file-like objects connected to the agent process.
+
+    Any number of requests can be in flight at once. Each one takes the lock
+    just long enough to send its frame, and a single reader hands every
+    response frame to the request it belongs to. """
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.lock = RLock()
+        self.pending = {}
+        self.last_id = 0
+        self.reader = None
+        self.closed = False
+
+    def bootstrap(self):
+        source = get_agent_source()
+        self.stdin.write("%d\n" % len(source))
+        self.stdin.write(source)
+        self.stdin.flush()
+        if self.request("ping") != "pong":
+            raise error.ConnectionError("Remote helper did not start")
+
+    def request(self, op, stdout=None, stderr=None, **kwargs):
+        callbacks = {"stdout": stdout, "stderr": stderr}
+        if self.closed:
+            raise error.ConnectionError("Remote helper exited unexpectedly")
+
+        self.last_id += 1
+        kwargs["op"] = op
+        kwargs["id"] = rid = self.last_id
+        responses = self.pending[rid] = Queue()
+        try:
+            with self.lock:
+                agent_server.write_frame(self.stdin, kwargs)
+            if self.reader is None:
+                self.reader = gevent.spawn(self.read)
+
+            while True:
+                response = responses.get()
+                if response is None:
+                    raise error.ConnectionError("Remote helper exited unexpectedly")
+
+                for stream, callback in callbacks.items():
+                    if stream in response and callback:
+                        callback(agent_server.decode(response[stream]))
+
+                if "error" in response:
+                    exc = errors.get(response["error"])
+                    if exc is OSError:
+                        raise OSError(response["errno"], response["message"])
+                    elif exc:
+                        raise exc(response["message"])
+                    raise error.OperationFailed(
+                        "Remote helper failed with %s: %s" % (response["error"], response["message"]))
+
+                if "result" in response:
+                    return response["result"]
+        finally:
+            del self.pending[rid]
+
+    def read(self):
+        """ Hand each response frame to the request it belongs to, until the
+        agent goes away. """
+        try:
+            while True:
+                response = agent_server.read_frame(self.stdout)
+                if response is None:
+                    break
+                responses = self.pending.get(response.get("id"))
+                if responses is not None:
+                    responses.put(response)
+        finally:
+            self.closed = True
+            for responses in self.pending.values():
+                responses.put(None)
+
+    def close(self):
+        self.stdin.close()
+
+
+def via_agent(func):
+    """ Use the decorated implementation when an agent is running and fall
+    back to the normal implementation of the transport when it isn't. """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not self._agent:
+            return getattr(super(AgentTransport, self), name)(*args, **kwargs)
+        return func(self, *args, **kwargs)
+    return wrapper
+
+
+def _stat_result(st):
+    if st is None:
+        return None
+    return stat_result(*st)
+
+
+def _size(contents):
+    """ The size of a string or file, or None if it can't be found out """
+    if not hasattr(contents, "read"):
+        return len(contents)
+    try:
+        return os.fstat(contents.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class AgentTransport(object):
+
+    _agent = None
+
+    # Size of the blocks compared by put_delta
+    delta_block_size = 8192
+
+    # put_delta sends files outside of these sizes whole
+    delta_min_size = 64 * 1024
+    delta_max_size = 256 * 1024 * 1024
+
+    def start_agent(self, stdin, stdout):
+        agent = Agent(stdin, stdout)
+        agent.bootstrap()
+        self._agent = agent
+        return agent
+
+    def agent_command(self):
+        command = []
+        if self.context.user != "root":
+            command.extend(["sudo", "-n"])
+        command.extend([
+            "sh", "-c",
+            'exec "$(command -v python3 || command -v python)" -u -c "$0"',
+            BOOTSTRAP,
+        ])
+        return command
+
+    @via_agent
+    def probe(self, paths):
+        results = self._agent.request("probe", paths=list(paths))
+        return [probe_result(p, _stat_result(st), _stat_result(lst)) for (p, st, lst) in results]
+
+    @via_agent
+    def exists(self, path):
+        return self.probe([path])[0].exists
+
+    @via_agent
+    def isfile(self, path):
+        return self.probe([path])[0].isfile
+
+    @via_agent
+    def isdir(self, path):
+        return self.probe([path])[0].isdir
+
+    @via_agent
+    def islink(self, path):
+        return self.probe([path])[0].islink
+
+    @via_agent
+    def lexists(self, path):
+        return self.probe([path])[0].lexists
+
+    @via_agent
+    def stat(self, path):
+        st = self.probe([path])[0].stat
+        if st is None:
+            raise OSError
+        return st
+
+    @via_agent
+    def lstat(self, path):
+        st = self.probe([path])[0].lstat
+        if st is None:
+            raise OSError
+        return st
+
+    @via_agent
+    def readlink(self, path):
+        return self._agent.request("readlink", path=path)
+
+    @via_agent
+    def get(self, path):
+        return agent_server.decode(self._agent.request("get", path=path))
+
+    @via_agent
+    def checksum(self, path, algo="sha256"):
+        return self._agent.request("checksum", path=path, algo=algo)
+
+    @via_agent
+    def put(self, path, contents, chmod=0o644):
+        if hasattr(contents, "read"):
+            contents = contents.read()
+        if path in identity_files:
+            self.invalidate_identities()
+        self._agent.request("put", path=path, data=agent_server.encode(contents), mode=chmod)
+
+    @via_agent
+    def put_delta(self, path, contents, chmod=0o644):
+        size = _size(contents)
+        if size is not None and not self.delta_min_size <= size <= self.delta_max_size:
+            # Small files are cheaper to send whole, and large ones are
+            # slower to compare than to send
+            return self.put(path, contents, chmod)
+        if path in identity_files:
+            self.invalidate_identities()
+        try:
+            signature = self._agent.request(
+                "signature", path=path, block_size=self.delta_block_size)
+            digest = hashlib.sha256()
+            ops = delta.compute_delta(signature, contents, self.delta_block_size, digest)
+            self._agent.request(
+                "patch",
+                path=path,
+                block_size=self.delta_block_size,
+                ops=[op if isinstance(op, int) else agent_server.encode(op) for op in ops],
+                digest=digest.hexdigest(),
+            )
+        except (OSError, error.OperationFailed):
+            # The file went away or didn't come out right - send all of it
+            if hasattr(contents, "seek"):
+                contents.seek(0)
+            self.put(path, contents, chmod)
+
+    @via_agent
+    def makedirs(self, path):
+        self._agent.request("makedirs", path=path)
+
+    @via_agent
+    def unlink(self, path):
+        self._agent.request("unlink", path=path)
+
+    @via_agent
+    def rename(self, source, destination):
+        self._agent.request("rename", source=source, destination=destination)
+
+    @via_agent
+    def _getpwall(self):
+        return [struct_passwd(*p) for p in self._agent.request("getpwall")]
+
+    @via_agent
+    def _getgrall(self):
+        return [struct_group(*g) for g in self._agent.request("getgrall")]
+
+    @via_agent
+    def _getspall(self):
+        return [struct_spwd(*s) for s in self._agent.request("getspall")]
+
+    def _execute_as(self, user, group, command, stdin, stdout, stderr):
+        if not self._agent:
+            return super(AgentTransport, self)._execute_as(user, group, command, stdin, stdout, stderr)
+
+        stdout_buffer = []
+        stderr_buffer = []
+
+        def collect(buffer, callback):
+            def _(data):
+                if callback:
+                    callback(data)
+                buffer.append(data)
+            return _
+
+        # The agent runs as root, so it is always told who to run as rather
+        # than skipping sudo for the user we logged in as
+        returncode = self._agent.request(
+            "execute",
+            command=command,
+            stdin=agent_server.encode(stdin) if stdin else None,
+            user=user,
+            group=group,
+            stdout=collect(stdout_buffer, stdout),
+            stderr=collect(stderr_buffer, stderr),
+        )
+
+        return returncode, ''.join(stdout_buffer), ''.join(stderr_buffer)
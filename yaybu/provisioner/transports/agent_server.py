@@ -0,0 +1,322 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The remote half of the helper agent.
+
+This file is sent to the remote host as source and run by whatever python is
+available there, so it must not import anything from yaybu and must work on
+both python 2 and python 3.
+
+Requests and responses are JSON objects, each framed by a line containing the
+length of the payload in bytes. While a command is executing the agent sends
+``stdout`` and ``stderr`` frames before the final ``result`` frame.
+
+Each request is handled in its own thread, so a slow command doesn't hold up
+anything else. Every frame sent back carries the ``id`` of the request it
+belongs to.
+"""
+
+import base64
+import errno
+import hashlib
+import json
+import os
+import select
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+
+try:
+    import pwd
+    import grp
+except ImportError:  # pragma: no cover
+    pwd = grp = None
+
+try:
+    import spwd
+except ImportError:  # pragma: no cover
+    spwd = None
+
+
+def read_frame(fp):
+    header = fp.readline()
+    if not header:
+        return None
+    return json.loads(fp.read(int(header)).decode("utf-8"))
+
+
+def write_frame(fp, obj):
+    payload = json.dumps(obj).encode("utf-8")
+    fp.write(("%d\n" % len(payload)).encode("ascii"))
+    fp.write(payload)
+    fp.flush()
+
+
+def encode(data):
+    return base64.b64encode(data).decode("ascii")
+
+
+def decode(data):
+    return base64.b64decode(data.encode("ascii"))
+
+
+def weak_checksum(data):
+    """ The weak checksum used for delta transfers. It is adler32, which the
+    sending side can roll along its data a byte at a time. """
+    return zlib.adler32(data) & 0xffffffff
+
+
+def strong_checksum(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def _stat(st):
+    if st is None:
+        return None
+    return [st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid,
+            st.st_gid, st.st_size, int(st.st_atime), int(st.st_mtime),
+            int(st.st_ctime)]
+
+
+def _try_stat(func, path):
+    try:
+        return func(path)
+    except OSError:
+        return None
+
+
+def do_ping(send):
+    return "pong"
+
+
+def do_probe(send, paths):
+    return [[p, _stat(_try_stat(os.stat, p)), _stat(_try_stat(os.lstat, p))] for p in paths]
+
+
+def do_readlink(send, path):
+    return os.readlink(path)
+
+
+def do_get(send, path):
+    with open(path, "rb") as fp:
+        return encode(fp.read())
+
+
+def do_checksum(send, path, algo):
+    h = hashlib.new(algo)
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(65536), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def do_signature(send, path, block_size):
+    blocks = []
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(block_size), b""):
+            blocks.append([weak_checksum(block), strong_checksum(block)])
+    return blocks
+
+
+def do_patch(send, path, block_size, ops, digest):
+    # Rebuild the file into a temporary file first, so that nothing is
+    # changed unless the result is exactly what the other side expected
+    h = hashlib.sha256()
+    tmp = tempfile.TemporaryFile()
+    try:
+        with open(path, "rb") as old:
+            for op in ops:
+                if isinstance(op, int):
+                    old.seek(op * block_size)
+                    data = old.read(block_size)
+                else:
+                    data = decode(op)
+                h.update(data)
+                tmp.write(data)
+
+        if h.hexdigest() != digest:
+            raise ValueError("Checksum mismatch after patching %s" % path)
+
+        # Copy back over the original rather than renaming, so that the
+        # owner, mode and any links to the file are preserved
+        tmp.seek(0)
+        with open(path, "r+b") as fp:
+            fp.truncate()
+            for block in iter(lambda: tmp.read(65536), b""):
+                fp.write(block)
+    finally:
+        tmp.close()
+
+
+def do_put(send, path, data, mode):
+    # Same semantics as 'umask && tee': the mode only applies to new files.
+    # The umask is shared by every thread, so set the mode explicitly.
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+        os.fchmod(fd, mode)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        fd = os.open(path, os.O_WRONLY | os.O_TRUNC)
+    try:
+        data = decode(data)
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+
+def do_makedirs(send, path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def do_unlink(send, path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def do_rename(send, source, destination):
+    os.rename(source, destination)
+
+
+def do_getpwall(send):
+    return [list(p) for p in pwd.getpwall()]
+
+
+def do_getgrall(send):
+    return [list(g) for g in grp.getgrall()]
+
+
+def do_getspall(send):
+    return [list(s) for s in spwd.getspall()]
+
+
+def _become(user, group):
+    """ Return a function that switches the process to ``user`` and
+    ``group``, or None if it is already running as them. The agent is
+    normally root, so commands must always be run as the user they are for -
+    even the one we logged in as. """
+    pw = pwd.getpwnam(user)
+    gid = grp.getgrnam(group).gr_gid if group else pw.pw_gid
+    if pw.pw_uid == os.getuid() and gid == os.getgid():
+        return None
+
+    groups = [g.gr_gid for g in grp.getgrall() if user in g.gr_mem]
+    if gid not in groups:
+        groups.append(gid)
+
+    def become():
+        os.setgroups(groups)
+        os.setgid(gid)
+        os.setuid(pw.pw_uid)
+    return become
+
+
+def do_execute(send, command, stdin=None, user=None, group=None):
+    p = subprocess.Popen(command,
+                         stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE,
+                         cwd="/",
+                         # Other requests are running commands at the same
+                         # time, and mustn't hold each other's pipes open
+                         close_fds=True,
+                         preexec_fn=_become(user, group) if user else None,
+                         )
+
+    def feed(data):
+        try:
+            if data:
+                p.stdin.write(data)
+        finally:
+            p.stdin.close()
+
+    feeder = threading.Thread(target=feed, args=(decode(stdin) if stdin else None, ))
+    feeder.daemon = True
+    feeder.start()
+
+    streams = {p.stdout.fileno(): "stdout", p.stderr.fileno(): "stderr"}
+    readlist = list(streams)
+    while readlist:
+        rlist, wlist, xlist = select.select(readlist, [], [], 1)
+        # See LocalExecute.communicate - a daemon can keep our pipes open
+        if not rlist and p.poll() is not None:
+            break
+        for fd in rlist:
+            data = os.read(fd, 65536)
+            if not data:
+                readlist.remove(fd)
+                continue
+            send(streams[fd], data)
+
+    feeder.join()
+    return p.wait()
+
+
+handlers = dict((k[3:], v) for (k, v) in list(globals().items()) if k.startswith("do_"))
+
+
+def handle(write, request):
+    rid = request.pop("id", None)
+
+    def send(stream, data):
+        write({"id": rid, stream: encode(data)})
+
+    handler = handlers.get(request.pop("op", None))
+    if not handler:
+        write({"id": rid, "error": "ValueError", "message": "Unknown operation"})
+        return
+
+    try:
+        result = handler(send, **request)
+    except (OSError, IOError) as e:
+        write({"id": rid, "error": "OSError", "errno": e.errno, "message": str(e)})
+    except KeyError as e:
+        write({"id": rid, "error": "KeyError", "message": str(e)})
+    except Exception as e:
+        write({"id": rid, "error": e.__class__.__name__, "message": str(e)})
+    else:
+        write({"id": rid, "result": result})
+
+
+def serve(stdin, stdout):
+    lock = threading.Lock()
+
+    def write(obj):
+        with lock:
+            write_frame(stdout, obj)
+
+    while True:
+        request = read_frame(stdin)
+        if request is None:
+            break
+
+        worker = threading.Thread(target=handle, args=(write, request))
+        worker.daemon = True
+        worker.start()
+
+
+def main():
+    serve(getattr(sys.stdin, "buffer", sys.stdin), getattr(sys.stdout, "buffer", sys.stdout))
+
+
+if __name__ == "__main__":
+    main()
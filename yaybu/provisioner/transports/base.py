@@ -13,9 +13,56 @@
 # limitations under the License.
 
 import os
+import posixpath
+import stat
+import collections
 from pipes import quote
 from yay.ast import AST
 
+from yaybu import error
+
+
+class probe_result(collections.namedtuple("probe_result", ("path", "stat", "lstat"))):
+
+    """ The result of probing a single path with ``Transport.probe``. ``stat``
+    and ``lstat`` are ``None`` if the path (or the link itself) does not
+    exist. """
+
+    __slots__ = ()
+
+    @property
+    def exists(self):
+        return self.stat is not None
+
+    @property
+    def lexists(self):
+        return self.lstat is not None
+
+    @property
+    def isfile(self):
+        return self.exists and stat.S_ISREG(self.stat.st_mode)
+
+    @property
+    def isdir(self):
+        return self.exists and stat.S_ISDIR(self.stat.st_mode)
+
+    @property
+    def islink(self):
+        return self.lexists and stat.S_ISLNK(self.lstat.st_mode)
+
+
+class package_status(collections.namedtuple("package_status", ("name", "status", "version"))):
+
+    """ What dpkg knows about a single package, as returned by
+    ``Transport.packages``. ``status`` is dpkg's want, error and status flags,
+    for example ``install ok installed``. """
+
+    __slots__ = ()
+
+    @property
+    def installed(self):
+        return self.status == "install ok installed"
+
 
 class Transport(object):
 
@@ -25,6 +72,40 @@ class Transport(object):
     env = None
     env_passthrough = []
 
+    # Facts about the target gathered when connecting, such as "distro" and
+    # "init". Transports that don't gather any leave this empty.
+    facts = {}
+
+    # Commands that can't add or remove users, groups or packages. Running
+    # anything else with ``execute``, including any shell script, throws away
+    # the cached identity and package lookups, as there's no telling what it
+    # did.
+    query_commands = frozenset([
+        "cat",
+        "chgrp",
+        "chmod",
+        "chown",
+        "dpkg-query",
+        "getent",
+        "id",
+        "kill",
+        "ls",
+        "md5sum",
+        "mkdir",
+        "readlink",
+        "rmdir",
+        "sha1sum",
+        "sha256sum",
+        "stat",
+        "status",
+        "test",
+        "touch",
+        "whoami",
+    ])
+
+    # Cached package index - see invalidate_packages
+    _packages = None
+
     def __init__(self, context, verbose=0, simulate=False):
         self.simulate = simulate
         self.verbose = verbose
@@ -43,22 +124,9 @@ class Transport(object):
         expected=0,
         stdout=None,
             stderr=None):
-        # No need to change user if we are already the right one
         if not user:
             user = self.whoami()
 
-        changeuser = (user != self.whoami())
-
-        full_command = []
-        if changeuser or group:
-            full_command.append('sudo')
-        if changeuser:
-            full_command.extend(['-u', user])
-        if group:
-            full_command.extend(['-g', group])
-        if changeuser or group:
-            full_command.append("--")
-
         if isinstance(command, list):
             command = command[:]
             for i, segment in enumerate(command):
@@ -88,7 +156,7 @@ class Transport(object):
         if env:
             newenv.update(env)
 
-        full_command.extend(["env", "-i"])
+        full_command = ["env", "-i"]
         for k, v in newenv.items():
             full_command.append("%s=%s" % (k, v))
 
@@ -102,6 +170,88 @@ class Transport(object):
         ])
 
         full_command.extend(["sh", "-c", "; ".join(parts)])
-        return self._execute_impl(full_command, stdin, stdout, stderr)
+        return self._execute_as(user, group, full_command, stdin, stdout, stderr)
+
+    def execute(self, command, *args, **kwargs):
+        """ Run ``command`` on the target. Unless it is one of
+        ``query_commands`` any cached lookups are thrown away afterwards. The
+        transport's own queries use ``_execute`` directly. """
+        try:
+            return self._execute(command, *args, **kwargs)
+        finally:
+            if isinstance(command, list):
+                program = command[0]
+                if isinstance(program, AST):
+                    program = program.as_string()
+            else:
+                program = command.split(" ", 1)[0]
+            if posixpath.basename(program) not in self.query_commands:
+                self.invalidate_identities()
+                self.invalidate_packages()
+
+    def _execute_as(self, user, group, command, stdin, stdout, stderr):
+        return self._execute_impl(self._sudo(user, group) + command, stdin, stdout, stderr)
+
+    def _sudo(self, user, group):
+        """ The prefix needed to run a command as ``user`` and ``group`` """
+        # No need to change user if we are already the right one
+        changeuser = (user != self.whoami())
+
+        prefix = []
+        if changeuser or group:
+            prefix.append('sudo')
+        if changeuser:
+            prefix.extend(['-u', user])
+        if group:
+            prefix.extend(['-g', group])
+        if changeuser or group:
+            prefix.append("--")
+        return prefix
+
+    def put_delta(self, path, contents, chmod=0o644):
+        """ Replace the contents of the existing file ``path`` by sending only
+        the parts that have changed. Transports that can't do that just
+        ``put`` the whole file. """
+        return self.put(path, contents, chmod)
+
+    def invalidate_identities(self):
+        """ Forget any cached passwd, group and shadow entries. This happens
+        automatically when anything but one of ``query_commands`` is run. """
+        self._identities = None
+
+    def packages(self):
+        """ Return a dictionary mapping every package dpkg knows about to its
+        ``package_status``. Each package is listed as ``name:arch``, and
+        packages for the native architecture (or for all of them) are also
+        listed under their bare name. The index is built with a single
+        command the first time it is needed, and thrown away when anything
+        but one of ``query_commands`` is run. """
+        if self._packages is None:
+            command = "dpkg --print-architecture && dpkg-query -W %s" % quote(
+                "-f=${Package} ${Architecture} ${Status} ${Version}\\n")
+            rc, stdout, stderr = self._execute(command)
+            # dpkg-query returns 1 if it doesn't know about any packages
+            if rc not in (0, 1):
+                raise error.DpkgError(
+                    "Package search failed with return code %s" % rc)
+
+            lines = stdout.splitlines()
+            native = lines[0].strip() if lines else ""
+            packages = {}
+            for line in lines[1:]:
+                parts = line.split(" ", 5)
+                if len(parts) < 5:
+                    continue
+                name, arch = parts[0], parts[1] or native
+                status = package_status(
+                    name, " ".join(parts[2:5]), parts[5] if len(parts) > 5 else "")
+                packages["%s:%s" % (name, arch)] = status
+                if arch in (native, "all"):
+                    packages[name] = status
+            self._packages = packages
+        return self._packages
 
-    execute = _execute
+    def invalidate_packages(self):
+        """ Forget the cached package index. This happens automatically when
+        anything but one of ``query_commands`` is run. """
+        self._packages = None
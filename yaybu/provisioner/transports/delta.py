@@ -0,0 +1,114 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+The sending half of an rsync style delta transfer.
+
+The remote side splits its copy of a file into fixed size blocks and returns a
+weak and a strong checksum for each one (see ``agent_server.do_signature``).
+This module slides a window along the new contents looking for those blocks,
+and produces a list of operations that rebuild the new contents from the old
+file: an ``int`` copies that block from the old file and a string is literal
+data.
+"""
+
+import zlib
+
+from .agent_server import strong_checksum
+
+
+# adler32 works modulo the largest prime below 2**16
+MOD = 65521
+
+
+def _chunks(contents, chunk_size):
+    if hasattr(contents, "read"):
+        return iter(lambda: contents.read(chunk_size), b"")
+    return (contents[i:i + chunk_size] for i in range(0, len(contents), chunk_size))
+
+
+def compute_delta(signature, contents, block_size, digest=None, chunk_size=65536):
+    """ Returns the operations that turn the file described by ``signature``
+    into ``contents``, which can be a string or a file-like object. It is read
+    ``chunk_size`` bytes at a time, and each chunk is passed to the hash object
+    ``digest`` if there is one.
+
+    Blocks are looked up with ``zlib.adler32`` wherever the last block
+    matched. The checksum is only rolled along a byte at a time after a miss,
+    until the new contents line up with a block again. """
+    blocks = {}
+    for i, (weak, strong) in enumerate(signature):
+        blocks.setdefault(weak, {}).setdefault(strong, i)
+
+    chunks = _chunks(contents, max(chunk_size, block_size))
+    buf = b""
+    data = bytearray()
+    eof = False
+    ops = []
+    literal_start = 0
+    offset = 0
+    rolling = False
+    a = b = 0
+
+    while True:
+        if not eof and offset + block_size >= len(buf):
+            # Drop what has been dealt with and top the buffer up. A rolling
+            # checksum needs the byte after the window, hence the >=
+            if literal_start < offset:
+                ops.append(buf[literal_start:offset])
+            buf = buf[offset:]
+            literal_start = offset = 0
+            while not eof and len(buf) <= block_size:
+                chunk = next(chunks, b"")
+                if not chunk:
+                    eof = True
+                    break
+                if digest is not None:
+                    digest.update(chunk)
+                buf += chunk
+            data = bytearray(buf)
+
+        if offset + block_size > len(buf):
+            break
+
+        if rolling:
+            weak = (b << 16) | a
+        else:
+            weak = zlib.adler32(buf[offset:offset + block_size]) & 0xffffffff
+
+        matches = blocks.get(weak)
+        if matches:
+            index = matches.get(strong_checksum(buf[offset:offset + block_size]))
+            if index is not None:
+                if literal_start < offset:
+                    ops.append(buf[literal_start:offset])
+                ops.append(index)
+                offset += block_size
+                literal_start = offset
+                rolling = False
+                continue
+
+        if offset + block_size < len(buf):
+            if not rolling:
+                a, b = weak & 0xffff, weak >> 16
+                rolling = True
+            out, new = data[offset], data[offset + block_size]
+            a = (a - out + new) % MOD
+            b = (b - block_size * out + a - 1) % MOD
+        offset += 1
+
+    if literal_start < len(buf):
+        ops.append(buf[literal_start:])
+
+    return ops
@@ -12,9 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import subprocess
 import os
-import select
+import shutil
+from gevent import select
 import errno
 try:
     import pwd
@@ -34,6 +36,9 @@ from . import base
 
 class Handle(object):
 
+    # The most to read from a pipe at once
+    read_size = 65536
+
     def __init__(self, handle, callback=None):
         self.handle = handle
         self.callback = callback
@@ -43,7 +48,7 @@ class Handle(object):
         return self.handle.fileno()
 
     def read(self):
-        data = os.read(self.fileno(), 1024)
+        data = os.read(self.fileno(), self.read_size)
         if data == "":
             self.handle.close()
             return False
@@ -84,7 +89,8 @@ class LocalExecute(object):
             try:
                 # Wait for data on stdout or stderr handles, but timeout after
                 # one second so that we can poll (below) and check the process
-                # hasn't disappeared.
+                # hasn't disappeared. This is gevent's select, so other
+                # greenlets carry on while we wait.
                 rlist, wlist, xlist = select.select(readlist, [], [], 1)
             except select.error as e:
                 if e.args[0] == errno.EINTR:
@@ -156,11 +162,50 @@ class LocalTransport(LocalExecute, base.Transport):
     def lstat(self, path):
         return os.lstat(path)
 
+    def probe(self, paths):
+        results = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            try:
+                lst = os.lstat(path)
+            except OSError:
+                lst = None
+            results.append(base.probe_result(path, st, lst))
+        return results
+
     def get(self, path):
         return open(path).read()
 
+    def checksum(self, path, algo="sha256"):
+        h = hashlib.new(algo)
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(65536), ""):
+                h.update(block)
+        return h.hexdigest()
+
+    def open(self, path, mode="rb", chmod=0o644):
+        if "r" in mode:
+            return open(path, mode)
+        fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_SYNC, chmod)
+        return os.fdopen(fd, mode)
+
     def put(self, path, contents, chmod=0o644):
-        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_SYNC, chmod)
+        if hasattr(contents, "read"):
+            with self.open(path, "wb", chmod) as fp:
+                shutil.copyfileobj(contents, fp)
+            return
+        fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_SYNC, chmod)
+        os.write(fd, contents)
+        os.close(fd)
+
+    def append(self, path, contents):
+        fd = os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_SYNC, 0o644)
         os.write(fd, contents)
         os.close(fd)
 
@@ -170,6 +215,9 @@ class LocalTransport(LocalExecute, base.Transport):
     def unlink(self, path):
         os.unlink(path)
 
+    def rename(self, source, destination):
+        os.rename(source, destination)
+
     def getgrall(self):
         return list(grp.getgrall())
 
@@ -18,6 +18,9 @@ for example, ssh or fakechroot
 """
 
 import collections
+import io
+
+from .base import probe_result
 
 
 stat_result = collections.namedtuple("stat_result",
@@ -36,8 +39,121 @@ struct_spwd = collections.namedtuple("struct_spwd",
                                       "sp_inact", "sp_expire", "sp_flag", ))
 
 
+# Prints an lstat and a stat line for each path passed to it, or a "-" if the
+# path doesn't exist. The fields are in the same order as ``stat_result``.
+probe_format = "%f %i %D %h %u %g %s %X %Y %Z"
+probe_script = (
+    'for p; do '
+    'stat -c "$0" -- "$p" 2>/dev/null || echo -; '
+    'stat -L -c "$0" -- "$p" 2>/dev/null || echo -; '
+    'done'
+)
+
+
+# Files that back the passwd, group and shadow databases. Writing to any of
+# them invalidates the cached copies.
+identity_files = frozenset([
+    "/etc/passwd",
+    "/etc/group",
+    "/etc/shadow",
+    "/etc/gshadow",
+])
+
+# Algorithms that ``checksum`` supports. Each has a coreutils ``<algo>sum``
+# command and a hashlib constructor of the same name.
+checksum_algorithms = frozenset([
+    "md5",
+    "sha1",
+    "sha224",
+    "sha256",
+    "sha384",
+    "sha512",
+])
+
+# The loader, name field and id field of each cached database
+identity_databases = {
+    "passwd": ("_getpwall", "pw_name", "pw_uid"),
+    "group": ("_getgrall", "gr_name", "gr_gid"),
+    "shadow": ("_getspall", "sp_nam", None),
+}
+
+
+class IdentityDatabase(object):
+
+    """ The entries of a passwd, group or shadow database, indexed by name
+    and (except for shadow) by id. Where a name or id appears more than once
+    the first entry wins, just like a linear search of the file. """
+
+    def __init__(self, entries, name_field, id_field=None):
+        self.entries = list(entries)
+        self.by_name = {}
+        self.by_id = {}
+        for entry in self.entries:
+            self.by_name.setdefault(getattr(entry, name_field), entry)
+            if id_field:
+                self.by_id.setdefault(getattr(entry, id_field), entry)
+
+
+class PutOnClose(io.BytesIO):
+
+    """ A file-like object that is written to a transport with ``put`` when
+    it is closed """
+
+    def __init__(self, transport, path, chmod):
+        io.BytesIO.__init__(self)
+        self.transport = transport
+        self.path = path
+        self.chmod = chmod
+
+    def close(self):
+        if not self.closed:
+            self.transport.put(self.path, self.getvalue(), self.chmod)
+        io.BytesIO.close(self)
+
+
+def parse_probe_line(line):
+    if line == "-":
+        return None
+    data = line.split(" ")
+    return stat_result(
+        int(data[0], 16),  # st_mode
+        int(data[1]),  # st_ino
+        int(data[2], 16),  # st_dev
+        int(data[3]),  # st_nlink
+        int(data[4]),  # st_uid
+        int(data[5]),  # st_gid
+        int(data[6]),  # st_size
+        int(data[7]),  # st_atime
+        int(data[8]),  # st_mtime
+        int(data[9]),  # st_ctime
+    )
+
+
 class RemoteTransport(object):
 
+    # Cached IdentityDatabase objects - see invalidate_identities
+    _identities = None
+
+    def probe(self, paths):
+        """ Stat and lstat all of ``paths`` with a single remote command.
+        Returns a list of ``probe_result`` in the same order as ``paths``. """
+        paths = list(paths)
+        if not paths:
+            return []
+        returncode, stdout, stderr = self._execute(
+            ["sh", "-c", probe_script, probe_format] + paths)
+        lines = stdout.split("\n")
+        if returncode != 0 or len(lines) < len(paths) * 2:
+            raise OSError("Unable to probe %s" % ", ".join(paths))
+        results = []
+        for i, path in enumerate(paths):
+            results.append(probe_result(
+                path,
+                parse_probe_line(lines[i * 2 + 1].strip()),
+                parse_probe_line(lines[i * 2].strip()),
+            ))
+        return results
+
     def exists(self, path):
         return self._execute(["test", "-e", path])[0] == 0
 
@@ -100,7 +216,29 @@ class RemoteTransport(object):
         return self._execute(["cat", path])[1]
     get = _get
 
+    def checksum(self, path, algo="sha256"):
+        """ Returns the hex digest of the contents of ``path``, calculated on
+        the remote host so the file doesn't have to be transferred """
+        if algo not in checksum_algorithms:
+            raise ValueError("Unsupported checksum algorithm '%s'" % algo)
+        returncode, stdout, stderr = self._execute(["%ssum" % algo, path])
+        if returncode != 0:
+            raise OSError
+        return stdout.split(" ", 1)[0].strip()
+
+    def open(self, path, mode="rb", chmod=0o644):
+        """ Returns a file-like object for reading or writing ``path``.
+        ``chmod`` is only used when writing a new file. This implementation
+        buffers the whole file in memory. """
+        if "r" in mode:
+            return io.BytesIO(self.get(path))
+        return PutOnClose(self, path, chmod)
+
     def put(self, path, contents, chmod=0o644):
+        if hasattr(contents, "read"):
+            contents = contents.read()
+        if path in identity_files:
+            self._identities = None
         umask = 0o777 - chmod
         return (
             self._execute(
@@ -108,14 +246,24 @@ class RemoteTransport(object):
                 (umask, path), stdin=contents)
         )
 
+    def append(self, path, contents):
+        """ Add ``contents`` to the end of ``path``, creating it if it doesn't
+        exist. """
+        if path in identity_files:
+            self._identities = None
+        return self._execute("tee -a %s > /dev/null" % path, stdin=contents)
+
     def makedirs(self, path):
         return self._execute(["mkdir", "-p", path])
 
     def unlink(self, path):
         return self._execute(["rm", "-f", path])
 
+    def rename(self, source, destination):
+        return self._execute(["mv", source, destination])
+
     def _getgrall(self):
-        groups = self._get("/etc/group")
+        groups = self.get("/etc/group")
         for line in groups.split("\n"):
             if not line.strip():
                 continue
@@ -127,23 +275,8 @@ class RemoteTransport(object):
                 tup[3].split(","),
             )
 
-    def getgrall(self):
-        return list(self._getgrall())
-
-    def getgrnam(self, name):
-        for group in self._getgrall():
-            if group.gr_name == name:
-                return group
-        raise KeyError(name)
-
-    def getgrgid(self, gid):
-        for group in self._getgrall():
-            if group.gr_gid == gid:
-                return group
-        raise KeyError(gid)
-
     def _getpwall(self):
-        users = self._get("/etc/passwd")
+        users = self.get("/etc/passwd")
         for line in users.split("\n"):
             if not line.strip():
                 continue
@@ -158,33 +291,44 @@ class RemoteTransport(object):
                 tup[6]
             )
 
-    def getpwall(self):
-        return list(self._getpwall())
-
-    def getpwnam(self, name):
-        for user in self._getpwall():
-            if user.pw_name == name:
-                return user
-        raise KeyError(name)
-
-    def getpwuid(self, uid):
-        for user in self._getpwall():
-            if user.pw_uid == uid:
-                return user
-        raise KeyError(uid)
-
     def _getspall(self):
-        susers = self._get("/etc/shadow")
+        susers = self.get("/etc/shadow")
         for line in susers.split("\n"):
             if not line.strip():
                 continue
             yield struct_spwd(*line.split(":"))
 
+    def _identity(self, database):
+        """ Returns the cached ``IdentityDatabase`` for ``database``, loading
+        it if this is the first lookup since it was last invalidated """
+        if self._identities is None:
+            self._identities = {}
+        if database not in self._identities:
+            loader, name_field, id_field = identity_databases[database]
+            self._identities[database] = IdentityDatabase(
+                getattr(self, loader)(), name_field, id_field)
+        return self._identities[database]
+
+    def getgrall(self):
+        return list(self._identity("group").entries)
+
+    def getgrnam(self, name):
+        return self._identity("group").by_name[name]
+
+    def getgrgid(self, gid):
+        return self._identity("group").by_id[gid]
+
+    def getpwall(self):
+        return list(self._identity("passwd").entries)
+
+    def getpwnam(self, name):
+        return self._identity("passwd").by_name[name]
+
+    def getpwuid(self, uid):
+        return self._identity("passwd").by_id[uid]
+
     def getspall(self):
-        return list(self._getspall())
+        return list(self._identity("shadow").entries)
 
     def getspnam(self, name):
-        for suser in self._getspall():
-            if suser.sp_nam == name:
-                return suser
-        raise KeyError(name)
+        return self._identity("shadow").by_name[name]
@@ -12,28 +12,298 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import pipes
-import select
+import shutil
 import socket
 import time
+import uuid
 import paramiko
 from paramiko.ssh_exception import SSHException
 from paramiko.rsakey import RSAKey
 from paramiko.dsskey import DSSKey
 import StringIO
 import gevent
+import gevent.queue
+from gevent.lock import RLock
 
 from yaybu import error
-from . import remote, base
-
-
-class SSHTransport(base.Transport, remote.RemoteTransport):
+from . import remote, base, agent
+
+
+# Checks that the connection is usable and gathers some facts about the host,
+# all in one command. Each result is printed as a key=value line. The script
+# exits with a known, non-zero code to prove exit codes make it back to us.
+handshake_returncode = 3
+handshake_script = (
+    'echo "user=$(whoami)"; '
+    'true; echo "true=$?"; '
+    'false; echo "false=$?"; '
+    'echo "sudo_user=$(sudo -n whoami 2>/dev/null)"; '
+    'echo "kernel=$(uname -s)"; '
+    'echo "release=$(uname -r)"; '
+    'echo "machine=$(uname -m)"; '
+    'if [ -r /etc/os-release ]; then '
+    '(. /etc/os-release; echo "distro=$ID"; echo "distro_version=$VERSION_ID"); '
+    'fi; '
+    'if [ -d /run/systemd/system ]; then echo init=systemd; '
+    'elif /sbin/initctl version 2>/dev/null | grep -q upstart; then echo init=upstart; '
+    'else echo init=sysv; fi; '
+    'exit %d' % handshake_returncode
+)
+
+
+class ChannelStats(object):
+
+    """ Usage statistics for one slot of a ``ChannelPool`` """
+
+    def __init__(self, slot):
+        self.slot = slot
+        self.commands = 0
+        self.failures = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+
+    def as_dict(self):
+        return dict(
+            slot=self.slot,
+            commands=self.commands,
+            failures=self.failures,
+            bytes_sent=self.bytes_sent,
+            bytes_received=self.bytes_received,
+            busy_time=self.busy_time,
+            wait_time=self.wait_time,
+        )
+
+    def __str__(self):
+        return (
+            "channel %(slot)d: %(commands)d commands, %(failures)d failures, "
+            "%(bytes_sent)d bytes sent, %(bytes_received)d bytes received, "
+            "%(busy_time).2fs busy, %(wait_time).2fs waiting" % self.as_dict())
+
+
+class ChannelPool(object):
+
+    """ Limits the number of session channels that are open on a single SSH
+    connection at once.
+
+    A session channel can only run one command, so rather than holding on to
+    channels this hands out a bounded number of slots. Each slot opens a fresh
+    channel on the shared connection, so the pool ``size`` should be no larger
+    than the ``MaxSessions`` setting of the remote sshd.
+
+    Long-lived channels, such as a ``ShellSession``'s, hold on to a slot until
+    it is given back with ``release``. """
+
+    def __init__(self, transport, size):
+        self.transport = transport
+        self.size = size
+        self.reserved = 0
+        self.stats = [ChannelStats(i) for i in range(size)]
+        self.slots = gevent.queue.Queue()
+        for stats in self.stats:
+            self.slots.put(stats)
+
+    @contextlib.contextmanager
+    def channel(self):
+        started = time.time()
+        stats = self.slots.get()
+        acquired = time.time()
+        stats.wait_time += acquired - started
+        try:
+            channel = self.transport.open_session()
+            try:
+                yield stats, channel
+            finally:
+                channel.close()
+        except Exception:
+            stats.failures += 1
+            raise
+        finally:
+            stats.commands += 1
+            stats.busy_time += time.time() - acquired
+            self.slots.put(stats)
+
+    def reserve(self):
+        """ Take a slot and open a channel to keep. One slot is always left
+        for other commands, so this returns None if there isn't one to
+        spare. """
+        if self.reserved >= self.size - 1:
+            return None
+        self.reserved += 1
+        stats = self.slots.get()
+        try:
+            return stats, self.transport.open_session()
+        except Exception:
+            stats.failures += 1
+            self.release(stats)
+            raise
+
+    def release(self, stats):
+        """ Give back a slot taken by ``reserve`` """
+        self.reserved -= 1
+        self.slots.put(stats)
+
+
+class ShellSession(object):
+
+    """ A long-lived shell on its own channel that runs commands one after
+    another, so that starting each one doesn't pay for sudo, PAM and a new
+    channel.
+
+    After each command the shell prints a marker line containing a random
+    token to stderr, and then another containing the exit code to stdout. The
+    token is new for every command, so the end of one command's output can
+    never be taken for the end of another's. Commands run with stdin from
+    /dev/null so that they can't read the next command.
+
+    If anything goes wrong while a command is running, there may be output
+    left unread, so the session is closed and can't be used again. """
+
+    def __init__(self, channel, read_size=65536, stats=None):
+        self.channel = channel
+        self.read_size = read_size
+        self.stats = stats or ChannelStats(-1)
+        self.lock = RLock()
+        self.closed = False
+
+    def run(self, command, stdout=None, stderr=None):
+        token = uuid.uuid4().hex
+        script = (
+            "%s < /dev/null; rc=$?; "
+            "printf '\\n%%s \\n' %s >&2; "
+            "printf '\\n%%s %%d\\n' %s $rc\n"
+        ) % (' '.join([pipes.quote(c) for c in command]), token, token)
+        marker = "\n%s " % token
+
+        with self.lock:
+            if self.closed:
+                raise error.ConnectionError("Shell session has been closed")
+            started = time.time()
+            readers = []
+            try:
+                self.channel.sendall(script)
+                readers.append(gevent.spawn(self.read, self.channel.recv, stdout, marker))
+                readers.append(gevent.spawn(self.read, self.channel.recv_stderr, stderr, marker))
+                gevent.joinall(readers, raise_error=True)
+            except:
+                # Don't leave a reader behind to swallow the next command's
+                # output
+                gevent.killall(readers)
+                self.close()
+                raise
+            finally:
+                self.stats.commands += 1
+                self.stats.busy_time += time.time() - started
+
+        out, err = readers
+
+        stdout_data, returncode = out.value
+        stderr_data, _ = err.value
+        return int(returncode), stdout_data, stderr_data
+
+    def read(self, recv, callback, marker):
+        """ Read from one stream up to the end of the next marker line.
+        Returns the output before the marker and the rest of the marker line.
+        Output is passed to ``callback`` as it arrives, but anything that
+        might be the start of the marker is held back until it is known not to
+        be. """
+        output = []
+        pending = ""
+        while True:
+            data = recv(self.read_size)
+            if not data:
+                raise error.ConnectionError("Shell session exited unexpectedly")
+            pending += data
+
+            index = pending.find(marker)
+            if index == -1:
+                safe = max(0, len(pending) - len(marker) + 1)
+            else:
+                end = pending.find("\n", index + len(marker))
+                if end != -1:
+                    self._emit(pending[:index], output, callback)
+                    return "".join(output), pending[index + len(marker):end]
+                safe = index
+
+            self._emit(pending[:safe], output, callback)
+            pending = pending[safe:]
+
+    def _emit(self, data, output, callback):
+        if not data:
+            return
+        output.append(data)
+        if callback:
+            callback(data)
+
+    def close(self):
+        self.closed = True
+        self.channel.close()
+
+
+class LockedFile(object):
+
+    """ A file that holds ``lock`` until it is closed """
+
+    def __init__(self, fp, lock):
+        self.fp = fp
+        self.lock = lock
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def __iter__(self):
+        return iter(self.fp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.lock is None:
+            return
+        try:
+            self.fp.close()
+        finally:
+            self.lock.release()
+            self.lock = None
+
+
+class SSHTransport(agent.AgentTransport, base.Transport, remote.RemoteTransport):
 
     connection_attempts = 20
     missing_host_key_policy = paramiko.AutoAddPolicy()
     _client = None
+    _pool = None
+    _sftp = None
+    _sftp_lock = None
     _allocate_pty = False
 
+    # Size of each SFTP read or write request
+    chunk_size = 32768
+
+    # Used to start an SFTP server as root when we log in as someone else
+    sftp_server_command = (
+        'for p in /usr/lib/openssh/sftp-server /usr/libexec/openssh/sftp-server '
+        '/usr/lib/ssh/sftp-server /usr/libexec/sftp-server; do '
+        'if [ -x "$p" ]; then exec "$p"; fi; done; exit 127'
+    )
+
+    # How many channels can be open at once - see ChannelPool
+    channels = 4
+
+    # The most to read from a channel at once
+    read_size = 65536
+
+    # Whether to run commands in a ShellSession for each user and group
+    sessions = True
+    _sessions = None
+    _session_lock = None
+
     def get_private_key(self, data):
         for KeyClass in (RSAKey, DSSKey):
             try:
@@ -86,87 +356,280 @@ class SSHTransport(base.Transport, remote.RemoteTransport):
             raise error.ConnectionError(
                 "Connection refused %d times, giving up." % self.connection_attempts)
 
+        self._pool = ChannelPool(
+            client.get_transport(),
+            getattr(self.context, "channels", None) or self.channels,
+        )
+
         self.verify_transport(client.get_transport())
 
         self._client = client
+
+        # The agent speaks a binary protocol, so can't be used if sudo needs
+        # a tty.
+        if getattr(self.context, "helper", False) and not self._allocate_pty:
+            self.start_helper(client.get_transport())
+
         return client
 
+    def start_helper(self, transport):
+        channel = transport.open_session()
+        channel.exec_command(' '.join([pipes.quote(c) for c in self.agent_command()]))
+        try:
+            self.start_agent(channel.makefile("wb"), channel.makefile("rb"))
+        except (error.ConnectionError, socket.error, EOFError):
+            # Not fatal - we just fall back to running a command for each
+            # operation
+            channel.close()
+
     def verify_transport(self, transport):
-        ret, out, err = self._execute_impl(["whoami"], None, None, None, transport=transport)
-        if ret != 0:
+        returncode, stdout, stderr = self._execute_impl(
+            ["sh", "-c", handshake_script], None, None, None, transport=transport)
+
+        facts = {}
+        for line in stdout.splitlines():
+            if "=" in line:
+                key, value = line.split("=", 1)
+                facts[key] = value.strip()
+
+        if not facts.get("user"):
             raise error.ConnectionError(
                 "Got unusable SSH connection: 'whoami' failed")
 
-        if out.strip() != self.context.user:
+        if facts["user"] != self.context.user:
             raise error.ConnectionError(
-                "Got unusable SSH connection: Expected %s, but 'whoami' returned: %s" % (self.context.user, out.strip()))
+                "Got unusable SSH connection: Expected %s, but 'whoami' returned: %s" % (self.context.user, facts["user"]))
 
-        ret, out, err = self._execute_impl(["false"], None, None, None, transport=transport)
-        if ret == 0:
+        if returncode != handshake_returncode or facts.get("false", "0") == "0":
             raise error.ConnectionError(
                 "Got unusable SSH connection: 'false' has exit code 0, same as 'true'!")
 
-        ret, out, err = self._execute_impl(["true"], None, None, None, transport=transport)
-        if ret != 0:
+        if facts.get("true") != "0":
             raise error.ConnectionError(
-                "Got unusable SSH connection: 'true' has exit code %d!" % ret)
+                "Got unusable SSH connection: 'true' has exit code %s!" % facts.get("true"))
 
-        ret, out, err = self._execute_impl(["sudo", "whoami"], None, None, None, transport=transport)
-        if ret != 0:
+        facts["sudo"] = "nopasswd"
+        if facts.pop("sudo_user", None) != "root":
             self._allocate_pty = True
+            facts["sudo"] = "tty"
             ret, out, err = self._execute_impl(["sudo", "whoami"], None, None, None, transport=transport)
             if ret != 0:
                 raise error.ConnectionError(
                     "Got unusable SSH connection: Can't become root")
 
+        self.facts = facts
+
     def whoami(self):
         return self.connect().get_transport().get_username()
 
-    def _execute_impl(self, command, stdin, stdout, stderr, transport=None):
-        transport = transport or self.connect().get_transport()
+    def channel_stats(self):
+        if not self._pool:
+            return []
+        return self._pool.stats
 
+    @contextlib.contextmanager
+    def _channel(self, transport):
+        if self._pool and transport in (None, self._pool.transport):
+            with self._pool.channel() as (stats, channel):
+                yield stats, channel
+            return
+
+        transport = transport or self.connect().get_transport()
         channel = transport.open_session()
+        try:
+            yield ChannelStats(-1), channel
+        finally:
+            channel.close()
+
+    def _execute_as(self, user, group, command, stdin, stdout, stderr):
+        # Commands that need stdin, or a tty for sudo, are run the normal way
+        if stdin or self._allocate_pty or self._agent or not self._use_sessions():
+            return super(SSHTransport, self)._execute_as(user, group, command, stdin, stdout, stderr)
+
+        session = self._session(user, group)
+        if session is None:
+            return super(SSHTransport, self)._execute_as(user, group, command, stdin, stdout, stderr)
+
+        try:
+            return session.run(command, stdout, stderr)
+        except:
+            # The shell has gone or has output left unread, so start a new
+            # one next time
+            if self._sessions.get((user, group)) is session:
+                del self._sessions[(user, group)]
+                session.close()
+                self._pool.release(session.stats)
+            raise
+
+    def _use_sessions(self):
+        return getattr(self.context, "sessions", self.sessions)
+
+    def _session(self, user, group):
+        """ Return the shell for ``user`` and ``group``, starting it the first
+        time it is needed. Its channel comes from the channel pool, so this
+        returns None if the pool can't spare one. """
+        key = (user, group)
+        if self._sessions and key in self._sessions:
+            return self._sessions[key]
+
+        if self._session_lock is None:
+            self._session_lock = RLock()
+        with self._session_lock:
+            if self._sessions is None:
+                self._sessions = {}
+            if key not in self._sessions:
+                self.connect()
+                reserved = self._pool.reserve()
+                if reserved is None:
+                    return None
+                stats, channel = reserved
+                try:
+                    channel.exec_command(' '.join([pipes.quote(c) for c in self._sudo(user, group) + ["sh"]]))
+                except Exception:
+                    channel.close()
+                    self._pool.release(stats)
+                    raise
+                self._sessions[key] = ShellSession(channel, self.read_size, stats)
+            return self._sessions[key]
 
+    def _execute_impl(self, command, stdin, stdout, stderr, transport=None):
+        if not transport:
+            self.connect()
+
+        with self._channel(transport) as (stats, channel):
+            return self._execute_channel(channel, stats, command, stdin, stdout, stderr)
+
+    def _execute_channel(self, channel, stats, command, stdin, stdout, stderr):
         if self._allocate_pty:
             channel.get_pty()
 
         channel.exec_command(' '.join([pipes.quote(c) for c in command]))
 
-        if stdin:
+        def sender():
             channel.sendall(stdin)
             channel.shutdown_write()
-
-        def recvr(ready, recv, cb, buffer):
-            while ready():
-                data = recv(1024)
-                if data:
-                    if cb:
-                        cb(data)
-                    buffer.append(data)
-            gevent.sleep()
+            stats.bytes_sent += len(stdin)
+
+        def receiver(recv, cb, buffer):
+            # recv blocks until there is data, and returns an empty string
+            # once the remote end has closed the stream
+            while True:
+                data = recv(self.read_size)
+                if not data:
+                    break
+                stats.bytes_received += len(data)
+                if cb:
+                    cb(data)
+                buffer.append(data)
 
         stdout_buffer = []
         stderr_buffer = []
-        while not channel.exit_status_ready():
-            rlist, wlist, xlist = select.select([channel], [], [], 1)
-            if not rlist:
-                continue
-
-            recvr(channel.recv_ready, channel.recv, stdout, stdout_buffer)
-            recvr(channel.recv_stderr_ready,
-                  channel.recv_stderr, stderr, stderr_buffer)
-
-        while not channel.eof_received:
-            recvr(channel.recv_ready, channel.recv, stdout, stdout_buffer)
-            recvr(channel.recv_stderr_ready,
-                  channel.recv_stderr, stderr, stderr_buffer)
-
-        recvr(channel.recv_ready, channel.recv, stdout, stdout_buffer)
-        recvr(channel.recv_stderr_ready,
-              channel.recv_stderr, stderr, stderr_buffer)
+        greenlets = [
+            gevent.spawn(receiver, channel.recv, stdout, stdout_buffer),
+            gevent.spawn(receiver, channel.recv_stderr, stderr, stderr_buffer),
+        ]
+        if stdin:
+            greenlets.append(gevent.spawn(sender))
+        gevent.joinall(greenlets, raise_error=True)
 
         returncode = channel.recv_exit_status()
 
-        channel.close()
-
         return returncode, ''.join(stdout_buffer), ''.join(stderr_buffer)
+
+    @property
+    def sftp_lock(self):
+        """ paramiko's SFTPClient throws away responses to requests made by
+        another greenlet, so it is only used by one greenlet at a time """
+        if self._sftp_lock is None:
+            self._sftp_lock = RLock()
+        return self._sftp_lock
+
+    def sftp(self):
+        """ Returns an SFTP client that can access files as root, or None if
+        one isn't available """
+        with self.sftp_lock:
+            client = self.connect()
+            if self._sftp is None:
+                self._sftp = self._open_sftp(client) or False
+            return self._sftp or None
+
+    def _open_sftp(self, client):
+        # The helper already handles files, and if sudo needs a tty we can't
+        # start an SFTP server through it
+        if self._agent or self._allocate_pty:
+            return None
+
+        try:
+            if self.context.user == "root":
+                return client.open_sftp()
+
+            channel = client.get_transport().open_session()
+            channel.exec_command(' '.join([pipes.quote(c) for c in [
+                "sudo", "-n", "sh", "-c", self.sftp_server_command]]))
+            return paramiko.SFTPClient(channel)
+        except (SSHException, EOFError, socket.error):
+            return None
+
+    def open(self, path, mode="rb", chmod=0o644):
+        sftp = self.sftp()
+        if not sftp:
+            return super(SSHTransport, self).open(path, mode, chmod)
+
+        # The SFTP client is only used by one greenlet at a time, so the
+        # file keeps hold of it until it is closed
+        self.sftp_lock.acquire()
+        try:
+            return LockedFile(self._open(sftp, path, mode, chmod), self.sftp_lock)
+        except:
+            self.sftp_lock.release()
+            raise
+
+    def _open(self, sftp, path, mode, chmod):
+        if "r" in mode:
+            fp = sftp.open(path, "rb", self.chunk_size)
+            # Request the whole file at once rather than a chunk at a time
+            fp.prefetch()
+            return fp
+
+        try:
+            sftp.stat(path)
+            exists = True
+        except IOError:
+            exists = False
+
+        fp = sftp.open(path, "wb", self.chunk_size)
+        if not exists:
+            # Fix the mode before anything is written to a new file
+            fp.chmod(chmod)
+        # Don't wait for each write to be acknowledged
+        fp.set_pipelined(True)
+        return fp
+
+    def get(self, path):
+        if not self.sftp():
+            return super(SSHTransport, self).get(path)
+        contents = StringIO.StringIO()
+        with self.open(path, "rb") as fp:
+            shutil.copyfileobj(fp, contents, self.chunk_size)
+        return contents.getvalue()
+
+    def put(self, path, contents, chmod=0o644):
+        if not self.sftp():
+            return super(SSHTransport, self).put(path, contents, chmod)
+        if path in remote.identity_files:
+            self.invalidate_identities()
+        with self.open(path, "wb", chmod) as fp:
+            if hasattr(contents, "read"):
+                shutil.copyfileobj(contents, fp, self.chunk_size)
+            else:
+                fp.write(contents)
+
+    def append(self, path, contents):
+        if not self.sftp():
+            return super(SSHTransport, self).append(path, contents)
+        with self.sftp_lock:
+            fp = self.sftp().open(path, "ab")
+            try:
+                fp.write(contents)
+            finally:
+                fp.close()
@@ -18,12 +18,14 @@ from yaybu.tests import (  # noqa
     test_changesource,
     test_compute_part,
     test_core_arguments,
+    test_core_assets,
     test_core_command,
     test_core_config,
     test_core_main,
     test_dns,
     test_heroku,
     test_loadbalancer,
+    test_provisioner_changes_file,
     test_provisioner_event,
     test_provisioner_providers_apt,
     test_provisioner_providers_directory,
@@ -38,10 +40,15 @@ from yaybu.tests import (  # noqa
     test_provisioner_providers_service_upstart,
     test_provisioner_providers_subversion,
     test_provisioner_providers_user,
+    test_provisioner_fingerprint,
+    test_provisioner_pool,
     test_provisioner_resource,
+    test_provisioner_transports_agent,
+    test_provisioner_transports_delta,
     test_provisioner_transports_base,
     test_provisioner_transports_local,
     test_provisioner_transports_remote,
+    test_provisioner_transports_ssh,
     test_static,
     test_test_manifest,
     test_util_templates
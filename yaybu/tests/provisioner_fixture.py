@@ -36,6 +36,7 @@ from fakechroot import FakeChroot
 from yaybu import base
 from yaybu import error
 from yaybu.tests.base import TestCase as BaseTestCase
+from yaybu.provisioner.transports.base import probe_result, package_status
 from yaybu.provisioner.transports.remote import stat_result, \
     struct_group, struct_passwd, struct_spwd
 from yaybu.provisioner.transports.fakechroot import FakechrootTransport
@@ -109,6 +110,8 @@ class TransportPlayback(object):
             return {
                 "stat": lambda x: stat_result(*x),
                 "lstat": lambda x: stat_result(*x),
+                "probe": lambda x: [probe_result(
+                    p, s and stat_result(*s), l and stat_result(*l)) for p, s, l in x],
                 "getgrall": lambda x: [struct_group(*y) for y in x],
                 "getgrnam": lambda x: struct_group(*x),
                 "getgrgid": lambda x: struct_group(*x),
@@ -117,6 +120,8 @@ class TransportPlayback(object):
                 "getpwuid": lambda x: struct_passwd(*x),
                 "getspall": lambda x: [struct_spwd(*y) for y in x],
                 "getspnam": lambda x: struct_spwd(*x),
+                "packages": lambda x: dict(
+                    (k, package_status(*v)) for k, v in x.items()),
             }.get(f, lambda x: x)(results)
         return _
 
@@ -0,0 +1,197 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import hashlib
+import tempfile
+import StringIO
+
+import unittest2
+from yay.errors import NotFound, NotModified
+
+from yaybu.core.assets import AssetCache
+
+
+class Openers(object):
+
+    """ Opens assets from a dictionary, using a digest of their contents as
+    the etag like yay's file opener """
+
+    def __init__(self):
+        self.assets = {}
+        self.opened = []
+
+    def add(self, uri, data, labels=()):
+        self.assets[uri] = (data, labels)
+
+    def open(self, uri, etag=None):
+        self.opened.append((uri, etag))
+        if uri not in self.assets:
+            raise NotFound(uri)
+        data, labels = self.assets[uri]
+        new_etag = hashlib.sha1(data).hexdigest()
+        if etag == new_etag:
+            raise NotModified(uri)
+        fp = StringIO.StringIO(data)
+        fp.etag = new_etag
+        fp.labels = labels
+        return fp
+
+
+class TestAssetCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.openers = Openers()
+        self.openers.add("foo", "hello world")
+
+    def cache(self, **kwargs):
+        return AssetCache(self.directory, **kwargs)
+
+    def test_cached_in_run(self):
+        cache = self.cache()
+        self.assertEqual(cache.open(self.openers, "foo").read(), "hello world")
+        self.assertEqual(cache.open(self.openers, "foo").read(), "hello world")
+        self.assertEqual(self.openers.opened, [("foo", None)])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_revalidated(self):
+        self.new_run("foo")
+        cache = self.cache()
+        self.assertEqual(cache.open(self.openers, "foo").read(), "hello world")
+        etag = hashlib.sha1("hello world").hexdigest()
+        self.assertEqual(self.openers.opened, [("foo", None), ("foo", etag)])
+        self.assertEqual((cache.hits, cache.revalidated), (1, 1))
+
+    def test_changed(self):
+        self.new_run("foo")
+        self.openers.add("foo", "goodbye world")
+        cache = self.cache()
+        self.assertEqual(cache.open(self.openers, "foo").read(), "goodbye world")
+        self.assertEqual(len(self.openers.opened), 2)
+        self.assertEqual(cache.misses, 1)
+
+    def test_damaged(self):
+        cache = self.new_run("foo")
+        with open(cache.path(cache.index["foo"]["digest"]), "wb") as fp:
+            fp.write("hello wor")
+        self.assertEqual(self.cache().open(self.openers, "foo").read(), "hello world")
+        self.assertEqual(self.openers.opened, [("foo", None), ("foo", None)])
+
+    def test_damaged_same_size(self):
+        cache = self.new_run("foo")
+        path = cache.path(cache.index["foo"]["digest"])
+        with open(path, "wb") as fp:
+            fp.write("hello WORLD")
+        os.utime(path, (0, 0))
+        self.assertEqual(self.cache().open(self.openers, "foo").read(), "hello world")
+        self.assertEqual(self.openers.opened, [("foo", None), ("foo", None)])
+
+    def test_unchanged_copy_trusted(self):
+        cache = self.new_run("foo")
+        entry = cache.index["foo"]
+        path = cache.path(entry["digest"])
+        with open(path, "wb") as fp:
+            fp.write("hello WORLD")
+        os.utime(path, (entry["mtime"], entry["mtime"]))
+        # The copy isn't hashed again when its size and mtime are the same
+        self.assertEqual(self.cache().open(self.openers, "foo").read(), "hello WORLD")
+
+    def test_mtime_recorded(self):
+        cache = self.new_run("foo")
+        del cache.index["foo"]["mtime"]
+        cache.save()
+        cache = self.new_run("foo")
+        path = cache.path(cache.index["foo"]["digest"])
+        self.assertEqual(cache.index["foo"]["mtime"], int(os.stat(path).st_mtime))
+        self.assertEqual(cache.revalidated, 1)
+
+    def test_labels(self):
+        self.openers.add("foo", "hello world", ("public", ))
+        self.new_run("foo")
+        self.assertEqual(self.cache().open(self.openers, "foo").labels, ("public", ))
+
+    def test_not_modified(self):
+        cache = self.cache()
+        etag = cache.open(self.openers, "foo").etag
+        self.assertRaises(NotModified, cache.open, self.openers, "foo", etag)
+
+    def test_saved_once(self):
+        self.openers.add("bar", "goodbye world")
+        cache = self.cache()
+        cache.open(self.openers, "foo")
+        cache.open(self.openers, "bar")
+        self.assertFalse(os.path.exists(cache.index_file))
+        cache.save()
+        self.assertEqual(list(self.cache().index), ["foo", "bar"])
+
+    def test_missing(self):
+        self.assertRaises(NotFound, self.cache().open, self.openers, "bar")
+
+    def test_secret(self):
+        self.openers.add("foo", "hello world", ("secret", ))
+        cache = self.cache()
+        self.assertEqual(cache.open(self.openers, "foo").labels, ("secret", ))
+        self.assertEqual(cache.open(self.openers, "foo").read(), "hello world")
+        self.assertEqual(len(self.openers.opened), 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def new_run(self, *uris, **kwargs):
+        """ Open ``uris`` with a new cache, as a run would """
+        cache = self.cache(**kwargs)
+        for uri in uris:
+            cache.open(self.openers, uri)
+        cache.save()
+        return cache
+
+    def test_path(self):
+        fp = self.cache().open(self.openers, "foo")
+        with open(fp.path) as copy:
+            self.assertEqual(copy.read(), "hello world")
+
+    def test_evict(self):
+        self.openers.add("bar", "goodbye world")
+        self.openers.add("baz", "hello world")
+        self.new_run("foo", "baz")
+        cache = self.new_run("bar", size=20)
+        self.assertEqual(sorted(cache.index), ["bar"])
+        self.assertEqual(cache.evicted, 2)
+        self.assertFalse(os.path.exists(cache.path(hashlib.sha1("hello world").hexdigest())))
+
+    def test_evict_recently_used(self):
+        self.openers.add("bar", "goodbye world")
+        self.openers.add("baz", "hello")
+        self.new_run("foo")
+        self.new_run("bar")
+        self.new_run("foo")
+        cache = self.new_run("baz", size=25)
+        self.assertEqual(sorted(cache.index), ["baz", "foo"])
+
+    def test_evict_shared(self):
+        self.openers.add("bar", "goodbye world")
+        self.openers.add("baz", "hello world")
+        self.openers.add("qux", "hello")
+        self.new_run("foo", "bar", "baz")
+        cache = self.new_run("qux", size=25)
+        # foo and baz share a copy, so throwing away foo doesn't free any space
+        self.assertEqual(sorted(cache.index), ["baz", "qux"])
+        self.assertTrue(os.path.exists(cache.path(hashlib.sha1("hello world").hexdigest())))
+
+    def test_not_evicted_while_used(self):
+        self.openers.add("bar", "goodbye world")
+        cache = self.new_run("foo", "bar", size=20)
+        self.assertEqual(sorted(cache.index), ["bar", "foo"])
+        self.assertEqual(cache.open(self.openers, "foo").read(), "hello world")
@@ -0,0 +1,171 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+import hashlib
+import tempfile
+from random import Random
+
+import mock
+import unittest2
+
+from yaybu.provisioner.changes.file import binary_buffers, changed_lines, FileChangeTextRenderer
+from yaybu.provisioner.changes import EnsureFile, FileContents
+
+
+class TestBinaryBuffers(unittest2.TestCase):
+
+    def test_text(self):
+        self.assertEqual(binary_buffers("hello\n\tworld\r\n"), False)
+
+    def test_empty(self):
+        self.assertEqual(binary_buffers("", None), False)
+
+    def test_nul(self):
+        self.assertEqual(binary_buffers("hello", "wor\0ld"), True)
+
+    def test_unprintable(self):
+        self.assertEqual(binary_buffers("a" * 10000 + "\x01"), True)
+        self.assertEqual(binary_buffers("caf\xc3\xa9"), True)
+
+    def test_unicode(self):
+        self.assertEqual(binary_buffers(u"hello world"), False)
+        self.assertEqual(binary_buffers(u"caf\xe9"), True)
+
+
+class TestChangedLines(unittest2.TestCase):
+
+    def test_same(self):
+        self.assertEqual(changed_lines("a\nb\n", "a\nb\n"), 0)
+
+    def test_changed(self):
+        self.assertEqual(changed_lines("a\nb\nc\n", "a\nx\nc\n"), 2)
+
+    def test_inserted(self):
+        self.assertEqual(changed_lines("a\nc\n" * 1000, "a\nc\n" * 500 + "b\n" + "a\nc\n" * 500), 1)
+
+    def test_partial_line(self):
+        self.assertEqual(changed_lines("ab\nc", "abd\nc"), 2)
+
+
+class TestFileChangeTextRenderer(unittest2.TestCase):
+
+    def setUp(self):
+        self.logger = mock.Mock()
+        self.renderer = FileChangeTextRenderer(self.logger, True)
+
+    def test_diff(self):
+        self.renderer.diff("hello\nworld\n", "hello\nthere\n")
+        lines = [c[0][0] for c in self.logger.info.call_args_list]
+        self.assertTrue("    -world" in lines)
+        self.assertTrue("    +there" in lines)
+
+    def test_binary(self):
+        self.renderer.diff("hello\n", "\0\0\0")
+        self.logger.notice.assert_called_with("Binary contents; not showing delta")
+
+    def test_too_big(self):
+        self.renderer.diff_limit = 10
+        self.renderer.diff("hello\nworld\n", "hello\nthere\nagain\n")
+        self.assertEqual(self.logger.info.call_count, 0)
+        message = self.logger.notice.call_args[0][0]
+        self.assertTrue(message.startswith("3 lines changed, digest "))
+
+    def test_too_many_lines(self):
+        self.renderer.diff_lines = 1
+        self.renderer.diff("hello\nworld\n", "hello\nthere\n")
+        self.assertEqual(self.logger.info.call_count, 0)
+        message = self.logger.notice.call_args[0][0]
+        self.assertTrue(message.startswith("2 lines changed, digest "))
+
+    def test_worst_case_is_quick(self):
+        # Lines that repeat, but not often enough for difflib to treat them
+        # as junk, are the slowest to match
+        lines = ["line %d\n" % i for i in range(110)]
+        random = Random(1)
+        count = self.renderer.diff_lines
+        previous = "".join(random.choice(lines) for i in range(count))
+        replacement = "".join(random.choice(lines) for i in range(count))
+        started = time.time()
+        self.renderer.diff(previous, replacement)
+        self.assertTrue(self.logger.info.call_count > 0)
+        self.assertLess(time.time() - started, 5)
+
+
+class TestFileContents(unittest2.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, "hello world")
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+        self.contents = FileContents(self.path)
+
+        self.sent = []
+        self.context = mock.Mock()
+        self.context.simulate = False
+        self.context.verbose = 0
+        self.context.transport.put.side_effect = lambda path, fp, mode: self.sent.append(fp.read())
+
+    def apply(self):
+        change = EnsureFile("/etc/foo", self.contents, "root", "root", 0o644, False)
+        change.apply(self.context, mock.Mock())
+        return change.changed
+
+    def test_digest(self):
+        self.assertEqual(self.contents.size, 11)
+        self.assertEqual(
+            self.contents.hexdigest("sha256"), hashlib.sha256("hello world").hexdigest())
+
+    def test_new_file(self):
+        self.context.transport.exists.return_value = False
+        self.assertEqual(self.apply(), True)
+        self.assertEqual(self.sent, ["hello world"])
+
+    def test_changed_file(self):
+        self.context.transport.exists.return_value = True
+        self.context.transport.checksum.return_value = hashlib.sha256("hello").hexdigest()
+        self.assertEqual(self.apply(), True)
+        self.assertEqual(self.sent, ["hello world"])
+
+    def test_unchanged_file(self):
+        self.context.transport.exists.return_value = True
+        self.context.transport.checksum.return_value = hashlib.sha256("hello world").hexdigest()
+        self.context.change.return_value = mock.Mock(changed=False)
+        self.apply()
+        self.assertEqual(self.sent, [])
+
+    def test_existing_too_big_to_diff(self):
+        self.context.verbose = 2
+        self.context.transport.exists.return_value = True
+        self.context.transport.stat.return_value.st_size = FileChangeTextRenderer.diff_limit + 1
+        self.apply()
+        self.assertEqual(self.context.transport.get.called, False)
+        self.assertEqual(self.sent, ["hello world"])
+
+    def test_existing_diffed(self):
+        self.context.verbose = 2
+        self.context.transport.exists.return_value = True
+        self.context.transport.stat.return_value.st_size = 5
+        self.context.transport.get.return_value = "hello"
+        self.apply()
+        self.context.transport.get.assert_called_with("/etc/foo")
+
+    def test_summary(self):
+        logger = mock.Mock()
+        renderer = FileChangeTextRenderer(logger, True)
+        renderer.diff_limit = 5
+        renderer.diff("", self.contents)
+        self.assertTrue(logger.notice.call_args[0][0].startswith("11 bytes, digest "))
@@ -12,10 +12,133 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import unittest
+
+from mock import Mock
+
 from yaybu.tests.provisioner_fixture import TestCase
+from yaybu.provisioner.event import EventState
 from yaybu import error
 
 
+class Resource(object):
+
+    policies = {"apply": "ApplyPolicy", "restart": "RestartPolicy"}
+
+    def __init__(self, id):
+        self.id = id
+
+
+class TestEventState(unittest.TestCase):
+
+    def setUp(self):
+        self.files = {}
+
+        def append(path, contents):
+            self.files[path] = self.files.get(path, "") + contents
+
+        def put(path, contents):
+            self.files[path] = contents
+
+        def rename(source, destination):
+            self.files[destination] = self.files.pop(source)
+
+        self.transport = Mock()
+        self.transport.exists.side_effect = lambda path: path in self.files
+        self.transport.get.side_effect = lambda path: self.files[path]
+        self.transport.append.side_effect = append
+        self.transport.put.side_effect = put
+        self.transport.rename.side_effect = rename
+
+    def state(self):
+        state = EventState(load=True)
+        state.transport = self.transport
+        state.load()
+        return state
+
+    def test_journal(self):
+        state = self.state()
+        state.override(Resource("a"), "apply")
+        state.override(Resource("b"), "restart")
+        state.clear_override(Resource("a"))
+        self.assertEqual(self.transport.append.call_count, 3)
+        self.assertEqual(self.transport.put.call_count, 0)
+
+        self.assertEqual(self.state().overridden_policy(Resource("a")), None)
+        self.assertEqual(self.state().overridden_policy(Resource("b")), "RestartPolicy")
+
+    def test_snapshot(self):
+        self.files["events.saved"] = json.dumps({"a": "apply"})
+        state = self.state()
+        state.override(Resource("b"), "restart")
+        self.assertEqual(self.state().overrides, {"a": "apply", "b": "restart"})
+
+    def test_incomplete_entry(self):
+        self.files["events.saved"] = '{"a": "apply"}\n["b", "rest'
+        state = self.state()
+        self.assertEqual(state.overrides, {"a": "apply"})
+        state.override(Resource("c"), "restart")
+        self.assertEqual(self.state().overrides, {"a": "apply", "c": "restart"})
+
+    def test_compact(self):
+        state = self.state()
+        state.override(Resource("a"), "apply")
+        state.override(Resource("b"), "restart")
+        state.clear_override(Resource("b"))
+        state.compact()
+        self.assertEqual(self.files, {"events.saved": json.dumps({"a": "apply"})})
+        # Moving the journal mustn't throw away the transport's cached lookups
+        self.assertEqual(self.transport.execute.call_count, 0)
+
+    def test_checkpoint(self):
+        state = self.state()
+        state.checkpoint(Resource("a"), "1234")
+        self.assertEqual(self.transport.append.call_count, 0)
+        state.compact()
+        self.assertTrue(self.state().completed(Resource("a"), "1234"))
+        self.assertFalse(self.state().completed(Resource("a"), "5678"))
+        self.assertFalse(self.state().completed(Resource("b"), "1234"))
+
+    def test_checkpoint_interval(self):
+        state = self.state()
+        state.checkpoint_interval = 0
+        state.checkpoint(Resource("a"), "1234")
+        state.checkpoint(Resource("b"), "5678")
+        self.assertEqual(self.transport.append.call_count, 2)
+        self.assertEqual(self.state().checkpoints, {"a": "1234", "b": "5678"})
+
+    def test_checkpoint_with_override(self):
+        state = self.state()
+        state.checkpoint(Resource("a"), "1234")
+        state.override(Resource("b"), "restart")
+        self.assertEqual(self.transport.append.call_count, 1)
+        self.assertEqual(self.state().checkpoints, {"a": "1234"})
+        self.assertEqual(self.state().overrides, {"b": "restart"})
+
+    def test_compact_checkpoints(self):
+        state = self.state()
+        state.override(Resource("a"), "apply")
+        state.checkpoint(Resource("b"), "1234")
+        state.compact()
+        self.assertEqual(self.state().overrides, {"a": "apply"})
+        self.assertEqual(self.state().checkpoints, {"b": "1234"})
+
+    def test_saved_overrides(self):
+        self.files["events.saved"] = '{"a": "apply"}\n["checkpoint", "b", "1234"]'
+        state = EventState()
+        state.transport = self.transport
+        self.assertEqual(state.saved_overrides(), {"a": "apply"})
+        self.assertEqual(state.checkpoints, {})
+
+    def test_simulate(self):
+        state = self.state()
+        state.simulate = True
+        state.override(Resource("a"), "apply")
+        state.compact()
+        self.assertEqual(self.files, {})
+
+
 class TestEvents(TestCase):
 
     def test_nochange(self):
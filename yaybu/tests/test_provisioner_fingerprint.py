@@ -0,0 +1,126 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+
+import mock
+import unittest2
+
+from yaybu.provisioner.fingerprint import FingerprintState
+from yaybu.provisioner.transports.base import probe_result
+from yaybu.provisioner.transports.remote import stat_result
+
+
+class FakeResource(object):
+
+    def __init__(self, id, paths):
+        self.id = id
+        self.paths = paths
+
+    def get_paths(self):
+        return self.paths
+
+
+class TestFingerprintState(unittest2.TestCase):
+
+    def setUp(self):
+        self.files = {}
+        self.stats = {"/a": 1, "/b": 1}
+
+        self.transport = mock.Mock()
+        self.transport.exists.side_effect = lambda path: path in self.files
+        self.transport.get.side_effect = lambda path: self.files[path]
+        self.transport.put.side_effect = self.files.__setitem__
+        self.transport.probe.side_effect = lambda paths: [
+            probe_result(p, self.stat(p), self.stat(p)) for p in paths]
+
+        self.a = FakeResource("File[/a]", ["/a"])
+        self.b = FakeResource("File[/b]", ["/b"])
+
+    def stat(self, path):
+        return stat_result(0o100644, 0, 0, 0, 0, 0, self.stats[path], 0, self.stats[path], 0)
+
+    def provision(self, local=None):
+        state = FingerprintState(self.transport)
+        state.load()
+        state.start([self.a, self.b])
+        result = []
+        for resource in (self.a, self.b):
+            if state.unchanged(resource, (local or {}).get(resource.id, "x")):
+                result.append(resource.id)
+        state.finish([self.a, self.b])
+        return result
+
+    def test_first_run_is_full(self):
+        self.assertEqual(self.provision(), [])
+        self.assertIn("fingerprints.saved", self.files)
+
+    def test_unchanged_is_skipped(self):
+        self.provision()
+        self.assertEqual(self.provision(), ["File[/a]", "File[/b]"])
+
+    def test_remote_change(self):
+        self.provision()
+        self.stats["/a"] = 2
+        self.assertEqual(self.provision(), ["File[/b]"])
+        self.assertEqual(self.provision(), ["File[/a]", "File[/b]"])
+
+    def test_local_change(self):
+        self.provision()
+        self.assertEqual(self.provision(local={"File[/b]": "y"}), ["File[/a]"])
+
+    def test_verify_every(self):
+        self.provision()
+        data = json.loads(self.files["fingerprints.saved"])
+        data["verified"] = time.time() - 86400
+        self.files["fingerprints.saved"] = json.dumps(data)
+        self.assertEqual(self.provision(), [])
+        self.assertEqual(self.provision(), ["File[/a]", "File[/b]"])
+
+    def test_one_probe(self):
+        self.provision()
+        self.transport.probe.reset_mock()
+        self.provision()
+        # One before the resources are applied, and one to record them
+        self.assertEqual(self.transport.probe.call_count, 2)
+
+    def test_changed_during_run(self):
+        self.provision()
+        state = FingerprintState(self.transport)
+        state.load()
+        state.start([self.a, self.b])
+        self.assertEqual(state.unchanged(self.a, "x"), True)
+        # Something that could change anything runs and changes /b
+        state.applied(FakeResource("Execute[e]", None), True)
+        self.stats["/b"] = 2
+        self.assertEqual(state.unchanged(self.b, "x"), False)
+
+    def test_unchanged_during_run(self):
+        self.provision()
+        state = FingerprintState(self.transport)
+        state.load()
+        state.start([self.a, self.b])
+        state.applied(self.a, False)
+        self.stats["/b"] = 2
+        self.assertEqual(state.unchanged(self.b, "x"), True)
+
+    def test_simulate_doesnt_save(self):
+        state = FingerprintState(self.transport)
+        state.simulate = True
+        state.load()
+        state.start([self.a])
+        state.unchanged(self.a, "x")
+        state.finish([self.a])
+        self.assertEqual(self.files, {})
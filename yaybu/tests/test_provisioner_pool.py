@@ -0,0 +1,169 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import StringIO
+
+import gevent
+import unittest2
+from yay import ast
+
+from yaybu import base, error
+from yaybu.core.config import Config
+from yaybu.provisioner.pool import ProvisionerPool
+from yaybu.ui.widgets import TextFactory
+
+
+class TestProvisionerPool(unittest2.TestCase):
+
+    def setUp(self):
+        self.stdout = StringIO.StringIO()
+        self.ui = TextFactory(self.stdout)
+        self.events = []
+
+    def provision(self, host, changed=False, fail=False):
+        def _():
+            self.events.append("start " + host)
+            gevent.sleep(0.01)
+            if fail:
+                raise error.ExecutionError("%s failed" % host)
+            self.events.append("finish " + host)
+            return changed
+        return _
+
+    def test_concurrent(self):
+        pool = ProvisionerPool(self.ui, 2)
+        pool.spawn("a", self.provision("a"))
+        pool.spawn("b", self.provision("b"))
+        pool.spawn("c", self.provision("c"))
+        pool.join()
+        self.assertEqual(self.events[:2], ["start a", "start b"])
+        self.assertTrue(self.events.index("start c") > self.events.index("finish a"))
+
+    def test_summary(self):
+        pool = ProvisionerPool(self.ui, 2)
+        pool.spawn("a", self.provision("a", changed=True))
+        pool.spawn("b", self.provision("b"))
+        pool.join()
+        pool.summary()
+        self.ui._emit_started_and_finished()
+        output = self.stdout.getvalue()
+        self.assertIn("| a: changed", output)
+        self.assertIn("| b: no changes", output)
+
+    def test_failure(self):
+        pool = ProvisionerPool(self.ui, 2)
+        pool.spawn("a", self.provision("a", fail=True))
+        pool.spawn("b", self.provision("b"))
+        self.assertRaises(error.ExecutionError, pool.join)
+        self.assertEqual(self.events, ["start a", "start b", "finish b"])
+        self.assertEqual(
+            [str(r).split(" (")[0] for r in pool.results],
+            ["a: failed: a failed", "b: no changes"])
+
+    def test_no_more_after_failure(self):
+        pool = ProvisionerPool(self.ui, 2)
+        pool.spawn("a", self.provision("a", fail=True))
+        pool.wait()
+        self.assertRaises(error.ExecutionError, pool.spawn, "b", self.provision("b"))
+        self.assertEqual(self.events, ["start a"])
+
+    def test_kill_not_a_failure(self):
+        pool = ProvisionerPool(self.ui, 2)
+        pool.spawn("a", self.provision("a"))
+        gevent.sleep(0)
+        pool.pool.kill()
+        self.assertEqual(pool.results[0].exc_info, None)
+        pool.join()
+
+
+class Host(base.GraphExternalAction):
+
+    """ Provisions a pretend host in the background, like ``Provisioner`` """
+
+    waits_for_hosts = False
+    events = []
+
+    def apply(self):
+        name = self.params.name.as_string()
+        fail = self.params.fail.as_bool(default=False)
+
+        def provision():
+            self.events.append("start " + name)
+            gevent.sleep(0.01)
+            if fail:
+                raise error.ExecutionError("%s failed" % name)
+            self.events.append("finish " + name)
+
+        self.root.provisioners.spawn(name, provision)
+
+
+class After(base.GraphExternalAction):
+
+    def apply(self):
+        Host.events.append("after")
+
+
+class TestResolve(unittest2.TestCase):
+
+    def setUp(self):
+        Host.events = []
+        self.config = Config(ui=TextFactory(StringIO.StringIO()))
+        self.config.builtins["Host"] = ast.PythonClassFactory(Host)
+        self.config.builtins["After"] = ast.PythonClassFactory(After)
+
+    def resolve(self, yaybufile):
+        self.config.load(StringIO.StringIO(yaybufile))
+        self.config.resolve()
+
+    def test_batches(self):
+        self.resolve(
+            "new Host as a:\n    name: a\n"
+            "new Host as b:\n    name: b\n"
+            "new After as c:\n    x: 1\n"
+            "new Host as d:\n    name: d\n")
+        self.assertEqual(Host.events, [
+            "start a", "start b", "finish a", "finish b", "after", "start d", "finish d"])
+
+    def test_failure_stops_run(self):
+        self.assertRaises(
+            error.ExecutionError, self.resolve,
+            "new Host as a:\n    name: a\n    fail: 1\n"
+            "new Host as b:\n    name: b\n"
+            "new After as c:\n    x: 1\n")
+        self.assertEqual(Host.events, ["start a", "start b", "finish b"])
+
+
+
+class TestTextFactory(unittest2.TestCase):
+
+    def test_sections_dont_interleave(self):
+        stdout = StringIO.StringIO()
+        ui = TextFactory(stdout)
+        a = ui.throbber("a").__enter__()
+        b = ui.throbber("b").__enter__()
+        with a.section("a1") as s:
+            s.notice("one")
+        with b.section("b1") as s:
+            s.notice("two")
+        ui._emit_started_and_finished()
+        self.assertNotIn("two", stdout.getvalue())
+
+        with a.section("a2") as s:
+            s.notice("three")
+        a.__exit__(None, None, None)
+        b.__exit__(None, None, None)
+        ui._emit_started_and_finished()
+
+        lines = [l for l in stdout.getvalue().splitlines() if l.startswith("| ")]
+        self.assertEqual(lines, ["| one", "| three", "| two"])
@@ -12,7 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import unittest
+
+from mock import Mock
+
 from yaybu.tests.provisioner_fixture import TestCase
+from yaybu.provisioner import resource
+from yaybu.provisioner.providers.apt import AptInstall, is_installed
+from yaybu.provisioner.transports.base import package_status
 from yaybu import error
 
 
@@ -75,3 +82,52 @@ class TestPackageRemoval(TestCase):
                   name: zip
                   policy: uninstall
             """)
+
+
+class TestPackageBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.resources = resource.ResourceBundle.create_from_list([
+            {"Package": [{"name": "python"}, {"name": "hello"}, {"name": "zip"}]},
+        ]).values()
+        self.context = Mock()
+        self.context.state.overridden_policy.return_value = None
+        self.context.transport.packages.return_value = {
+            "python": package_status("python", "install ok installed", "2.7.3"),
+            "zip": package_status("zip", "deinstall ok config-files", "3.0-4"),
+        }
+
+    def apply_batch(self):
+        provider = AptInstall(self.resources[0])
+        return provider.apply_batch(self.context, None, self.resources)
+
+    def test_install_missing(self):
+        self.assertEqual(self.apply_batch(), {
+            "Package[python]": False,
+            "Package[hello]": True,
+            "Package[zip]": True,
+        })
+        self.assertEqual(self.context.change.call_count, 1)
+        command = self.context.change.call_args[0][0].command
+        self.assertEqual(command[-2:], ["hello", "zip"])
+
+    def test_nothing_missing(self):
+        self.context.transport.packages.return_value = dict(
+            (r.name.as_string(), package_status(r.name.as_string(), "install ok installed", "1"))
+            for r in self.resources)
+        self.assertEqual(set(self.apply_batch().values()), set([False]))
+        self.assertEqual(self.context.change.call_count, 0)
+
+    def test_install_failed(self):
+        self.context.change.side_effect = error.SystemError(1, "", "")
+        self.assertEqual(self.apply_batch(), {})
+
+    def test_other_architecture(self):
+        installed = package_status("libfoo", "install ok installed", "1")
+        self.context.transport.packages.return_value = {
+            "libfoo": installed,
+            "libfoo:amd64": installed,
+        }
+        self.assertTrue(is_installed(self.context, "libfoo"))
+        self.assertTrue(is_installed(self.context, "libfoo:amd64"))
+        self.assertFalse(is_installed(self.context, "libfoo:i386"))
@@ -14,10 +14,17 @@
 
 from yaybu.tests.provisioner_fixture import TestCase
 from yaybu import error
+from yaybu.core import argument
+from yaybu.provisioner import resource
+from yaybu.provisioner.render import RenderCache
+from yaybu.provisioner.providers.filesystem.files import File
 import os
 import stat
 import json
 import pkgutil
+import unittest
+
+import mock
 
 
 def sibpath(filename):
@@ -287,3 +294,40 @@ class TestFileRemove(TestCase):
                     name: /etc/qux
                     policy: remove
             """)
+
+
+class TestRenderCache(unittest.TestCase):
+
+    def setUp(self):
+        fp = mock.Mock()
+        fp.read.return_value = "hello"
+        fp.labels = ()
+        fp.path = None
+        self.context = mock.Mock()
+        self.context.get_file.return_value = fp
+        self.context.renders = RenderCache()
+
+    def provider(self, **kwargs):
+        bundle = resource.ResourceBundle.create_from_list([{"File": [kwargs]}])
+        return File(bundle.values()[0])
+
+    def test_shared(self):
+        for name in ("/a", "/b"):
+            rendered = self.provider(name=name, source="foo", renderer="static").render(self.context)
+            self.assertEqual(rendered, ("hello", False))
+        self.assertEqual(self.context.get_file.call_count, 1)
+        self.assertEqual((self.context.renders.hits, self.context.renders.misses), (1, 1))
+
+    def test_different_args(self):
+        a = self.provider(name="/a", renderer="json", args={"foo": 1})
+        b = self.provider(name="/a", renderer="json", args={"foo": 2})
+        self.assertNotEqual(a.render(self.context), b.render(self.context))
+        self.assertEqual(self.context.renders.misses, 2)
+
+    def test_secret_args(self):
+        a = self.provider(name="/a", renderer="json", args={"foo": 1})
+        b = self.provider(name="/a", renderer="json", args={"foo": 1})
+        with mock.patch.object(argument.Dict, "contains_secrets", return_value=True):
+            self.assertEqual(a.render(self.context)[1], True)
+        self.assertEqual(b.render(self.context)[1], False)
+        self.assertEqual(self.context.renders.misses, 2)
@@ -12,9 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import unittest
+import unittest2
 import datetime
-from mock import Mock
+import gevent
+import mock
+from mock import Mock, MagicMock
 
 from yay.config import Config
 
@@ -46,7 +48,7 @@ class H(resource.Resource):
     baz = argument.Property(argument.File)
 
 
-class TestResource(unittest.TestCase):
+class TestResource(unittest2.TestCase):
 
     def test_init(self):
         h = H(bind({
@@ -57,8 +59,23 @@ class TestResource(unittest.TestCase):
         self.assertEqual(h.foo.as_int(), 42)
         self.assertEqual(h.bar.resolve(), datetime.datetime(2010, 0o5, 0o1))
 
+    def test_schema(self):
+        self.assertEqual(
+            H.get_argument_names(), ["bar", "baz", "foo", "name", "policy", "watch"])
+        self.assertEqual(H.schema["foo"].klass, argument.Integer)
 
-class TestArgument(unittest.TestCase):
+    def test_slots(self):
+        h = H(bind({'name': 'test'}))
+        self.assertFalse(hasattr(h, "__dict__"))
+        self.assertRaises(AttributeError, setattr, h, "qux", 1)
+
+    def test_id(self):
+        h = H(bind({'name': 'test'}))
+        self.assertEqual(h.id, "H[test]")
+        self.assertTrue(h.id is h.id)
+
+
+class TestArgument(unittest2.TestCase):
 
     def test_storage(self):
         f1 = F(bind(dict(name="test", foo="a", bar="b")))
@@ -79,7 +96,7 @@ class TestArgument(unittest.TestCase):
         self.assertEqual(f.foo.as_string(), "42")
 
 
-class TestArgumentAssertion(unittest.TestCase):
+class TestArgumentAssertion(unittest2.TestCase):
 
     def test_present(self):
         class P(policy.Policy):
@@ -154,7 +171,61 @@ class Ev1Provider(provider.Provider):
         return True
 
 
-class TestResourceBundle(unittest.TestCase):
+class Par(resource.Resource):
+    path = argument.Property(argument.String)
+
+    def get_paths(self):
+        return [self.path.as_string()]
+
+
+class ParApplyPolicy(policy.Policy):
+    name = "apply"
+    default = True
+    resource = Par
+
+
+class ParProvider(provider.Provider):
+    policies = (ParApplyPolicy,)
+
+    events = []
+
+    def apply(self, context, output):
+        name = self.resource.name.as_string()
+        self.events.append("start " + name)
+        gevent.sleep(0.01)
+        if name == "fail":
+            raise error.ExecutionError("failed")
+        self.events.append("finish " + name)
+        return name == "changed"
+
+
+class Bat(resource.Resource):
+    pass
+
+
+class BatApplyPolicy(policy.Policy):
+    name = "apply"
+    default = True
+    resource = Bat
+
+
+class BatProvider(provider.Provider):
+    policies = (BatApplyPolicy,)
+
+    batched = True
+    events = []
+
+    def apply(self, context, output):
+        self.events.append("apply " + self.resource.name.as_string())
+        return True
+
+    def apply_batch(self, context, output, batch):
+        self.events.append("batch " + " ".join(
+            r.name.as_string() for r in batch))
+        return dict((r.id, False) for r in batch if r.name.as_string() != "x")
+
+
+class TestResourceBundle(unittest2.TestCase):
 
     def setUp(self):
         self.overrides = {}
@@ -173,9 +244,11 @@ class TestResourceBundle(unittest.TestCase):
                 del self.overrides[resource.id]
 
         self.context = Mock()
+        self.context.provider_cache = None
         self.context.state.override.side_effect = override
         self.context.state.overridden_policy.side_effect = overridden_policy
         self.context.state.clear_override.side_effect = clear_override
+        self.context.state.completed.return_value = False
 
     def test_creation(self):
         resources = resource.ResourceBundle.create_from_list([
@@ -271,6 +344,36 @@ class TestResourceBundle(unittest.TestCase):
             ]}])
         self.assertRaises(error.BindingError, resources.bind)
 
+    def bind_error(self, specification):
+        resources = resource.ResourceBundle.create_from_list(specification)
+        try:
+            resources.bind()
+        except error.BindingError as e:
+            return str(e)
+        self.fail("BindingError not raised")
+
+    def test_forwardreference_message(self):
+        message = self.bind_error([
+            {"Ev1": [
+                {"name": "e1", "policy": {"baz": [{"when": "baz", "on": "Ev1[e2]"}]}},
+                {"name": "e2", "policy": "foo"},
+            ]}])
+        self.assertEqual(
+            message,
+            "Attempt to bind forwards on Ev1[e1]: it is triggered by Ev1[e2], which is declared after it")
+
+    def test_cycle(self):
+        message = self.bind_error([
+            {"Ev1": [
+                {"name": "e1", "policy": {"baz": [{"when": "baz", "on": "Ev1[e3]"}]}},
+                {"name": "e2", "policy": {"baz": [{"when": "baz", "on": "Ev1[e1]"}]}},
+                {"name": "e3", "policy": {"baz": [{"when": "baz", "on": "Ev1[e2]"}]}},
+            ]}])
+        self.assertEqual(
+            message,
+            "Attempt to bind forwards on Ev1[e1]: triggers form a cycle: "
+            "Ev1[e1] is triggered by Ev1[e3] is triggered by Ev1[e2] is triggered by Ev1[e1]")
+
     def test_structure(self):
         e1 = Ev1(bind(dict(name="e1",
                            policy={
@@ -327,6 +430,356 @@ class TestResourceBundle(unittest.TestCase):
         self.assertRaises(error.BindingError, e1.bind, resources)
 
 
+class TestDependencies(unittest2.TestCase):
+
+    def dependencies(self, specification):
+        resources = resource.ResourceBundle.create_from_list(specification)
+        resources.bind()
+        return dict(
+            (k, [r.id for r in v]) for k, v in resources.dependencies().items())
+
+    def test_paths(self):
+        dependencies = self.dependencies([
+            {"Directory": [{"name": "/srv"}]},
+            {"File": [{"name": "/srv/a"}, {"name": "/srva"}, {"name": "/etc/b"}]},
+            {"Link": [{"name": "/etc/c", "to": "/srv/a"}]},
+        ])
+        self.assertEqual(dependencies["File[/srv/a]"], ["Directory[/srv]"])
+        self.assertEqual(dependencies["File[/srva]"], [])
+        self.assertEqual(dependencies["File[/etc/b]"], [])
+        self.assertEqual(
+            dependencies["Link[/etc/c]"], ["Directory[/srv]", "File[/srv/a]"])
+
+    def test_chain(self):
+        dependencies = self.dependencies([
+            {"Directory": [{"name": "/srv"}]},
+            {"File": [{"name": "/srv/a"}, {"name": "/srv/b"}]},
+            {"Link": [{"name": "/etc/d", "to": "/srv"}]},
+            {"File": [{"name": "/srv/c"}]},
+        ])
+        self.assertEqual(
+            dependencies["Link[/etc/d]"], ["Directory[/srv]", "File[/srv/a]", "File[/srv/b]"])
+        # The Link already waits for everything else in /srv
+        self.assertEqual(dependencies["File[/srv/c]"], ["Link[/etc/d]"])
+
+    def test_references(self):
+        dependencies = self.dependencies([
+            {"Group": [{"name": "web"}]},
+            {"User": [{"name": "www", "group": "web"}]},
+            {"File": [{"name": "/etc/a", "owner": "www"}, {"name": "/etc/b"}]},
+        ])
+        self.assertEqual(dependencies["User[www]"], ["Group[web]"])
+        self.assertEqual(dependencies["File[/etc/a]"], ["User[www]"])
+        self.assertEqual(dependencies["File[/etc/b]"], [])
+
+    def test_user_home(self):
+        dependencies = self.dependencies([
+            {"User": [{"name": "www"}, {"name": "app", "home": "/srv/app"}]},
+            {"File": [{"name": "/home/www/a"}, {"name": "/srv/app/b"}, {"name": "/srv/c"}]},
+        ])
+        self.assertEqual(dependencies["File[/home/www/a]"], ["User[www]"])
+        self.assertEqual(dependencies["File[/srv/app/b]"], ["User[app]"])
+        self.assertEqual(dependencies["File[/srv/c]"], [])
+
+    def test_directory_parents(self):
+        dependencies = self.dependencies([
+            {"Directory": [{"name": "/srv/a/b", "parents": True}, {"name": "/var/a/b"}]},
+            {"File": [{"name": "/srv/a/c"}, {"name": "/var/a/c"}, {"name": "/etc/d"}]},
+        ])
+        self.assertEqual(dependencies["File[/srv/a/c]"], ["Directory[/srv/a/b]"])
+        self.assertEqual(dependencies["File[/var/a/c]"], [])
+        self.assertEqual(dependencies["File[/etc/d]"], [])
+
+    def test_lock(self):
+        dependencies = self.dependencies([
+            {"User": [{"name": "a"}, {"name": "b"}]},
+        ])
+        self.assertEqual(dependencies["User[b]"], ["User[a]"])
+
+    def test_everything(self):
+        dependencies = self.dependencies([
+            {"File": [{"name": "/etc/a"}]},
+            {"Execute": [{"name": "e", "command": "true"}]},
+            {"File": [{"name": "/etc/b"}]},
+        ])
+        self.assertEqual(dependencies["Execute[e]"], ["File[/etc/a]"])
+        self.assertEqual(dependencies["File[/etc/b]"], ["Execute[e]"])
+
+    def test_watch(self):
+        dependencies = self.dependencies([
+            {"Execute": [{"name": "e", "command": "true", "watch": ["/etc/a"]}]},
+        ])
+        self.assertEqual(dependencies["File[/etc/a]"], ["Execute[e]"])
+
+    def test_triggers(self):
+        dependencies = self.dependencies([
+            {"File": [{"name": "/etc/a"}, {
+                "name": "/etc/b",
+                "policy": {"apply": [{"when": "apply", "on": "File[/etc/a]"}]},
+            }]},
+        ])
+        self.assertEqual(dependencies["File[/etc/b]"], ["File[/etc/a]"])
+
+
+class TestApplyParallel(unittest2.TestCase):
+
+    def setUp(self):
+        ParProvider.events = []
+        self.context = Mock()
+        self.context.provider_cache = None
+        self.context.parallel = 4
+        self.context.fingerprints = None
+        self.context.state.overridden_policy.return_value = None
+        self.context.state.completed.return_value = False
+        self.throbber = MagicMock()
+
+    def apply(self, *resources):
+        bundle = resource.ResourceBundle.create_from_list([
+            {"Par": [{"name": n, "path": p} for n, p in resources]},
+        ])
+        bundle.bind()
+        return bundle.apply(self.context, self.throbber)
+
+    def test_independent(self):
+        self.apply(("a", "/a"), ("b", "/b"))
+        self.assertEqual(
+            ParProvider.events, ["start a", "start b", "finish a", "finish b"])
+
+    def test_dependent(self):
+        self.apply(("a", "/a"), ("b", "/a/b"))
+        self.assertEqual(
+            ParProvider.events, ["start a", "finish a", "start b", "finish b"])
+
+    def test_limit(self):
+        self.context.parallel = 2
+        self.apply(("a", "/a"), ("b", "/b"), ("c", "/c"))
+        events = ParProvider.events
+        self.assertEqual(events[:2], ["start a", "start b"])
+        self.assertTrue(events.index("start c") > events.index("finish a"))
+
+    def test_changed(self):
+        self.assertEqual(self.apply(("a", "/a"), ("b", "/b")), False)
+        self.assertEqual(self.apply(("changed", "/a"), ("b", "/b")), True)
+
+    def test_sections_in_order(self):
+        self.apply(("a", "/a"), ("b", "/b"), ("c", "/a/c"))
+        self.assertEqual(
+            [c[1][0] for c in self.throbber.section.mock_calls if c[0] == ""],
+            ["Par[a]", "Par[b]", "Par[c]"])
+
+    def test_failure(self):
+        self.assertRaises(
+            error.ExecutionError,
+            self.apply, ("fail", "/a"), ("b", "/b"), ("c", "/a/c"))
+        self.assertEqual(
+            ParProvider.events, ["start fail", "start b", "finish b"])
+
+    def test_killed(self):
+        run = gevent.spawn(self.apply, ("a", "/a"), ("b", "/b"))
+        gevent.sleep(0.001)
+        run.kill()
+        self.assertIsInstance(run.value, gevent.GreenletExit)
+        # The resources that were running were stopped too
+        gevent.sleep(0.02)
+        self.assertEqual(ParProvider.events, ["start a", "start b"])
+
+
+class TestBatch(unittest2.TestCase):
+
+    def setUp(self):
+        BatProvider.events = []
+        ParProvider.events = []
+        self.context = Mock()
+        self.context.provider_cache = None
+        self.context.parallel = 1
+        self.context.fingerprints = None
+        self.context.state.overridden_policy.return_value = None
+        self.context.state.completed.return_value = False
+        self.throbber = MagicMock()
+
+    def bundle(self, specification):
+        bundle = resource.ResourceBundle.create_from_list(specification)
+        bundle.bind()
+        return bundle
+
+    def batches(self, bundle):
+        return [
+            r.batch and [b.id for b in r.batch.resources] for r in bundle.values()]
+
+    def test_consecutive(self):
+        bundle = self.bundle([
+            {"Bat": [{"name": "a"}, {"name": "b"}]},
+            {"Par": [{"name": "c", "path": "/c"}]},
+            {"Bat": [{"name": "d"}]},
+        ])
+        bundle.batch(self.context)
+        self.assertEqual(self.batches(bundle), [
+            ["Bat[a]", "Bat[b]"], ["Bat[a]", "Bat[b]"], None, None])
+
+    def test_triggers(self):
+        bundle = self.bundle([
+            {"Bat": [{"name": "a"}, {"name": "b"}, {
+                "name": "c",
+                "policy": {"apply": [{"when": "apply", "on": "Bat[a]"}]},
+            }]},
+        ])
+        bundle.batch(self.context)
+        self.assertEqual(self.batches(bundle), [
+            ["Bat[a]", "Bat[b]"], ["Bat[a]", "Bat[b]"], None])
+
+    def test_apply(self):
+        bundle = self.bundle([
+            {"Bat": [{"name": "a"}, {"name": "x"}, {"name": "b"}]},
+        ])
+        self.assertEqual(bundle.apply(self.context, self.throbber), True)
+        self.assertEqual(BatProvider.events, ["batch a x b", "apply x"])
+
+
+class TestFingerprints(unittest2.TestCase):
+
+    def setUp(self):
+        ParProvider.events = []
+        self.context = Mock()
+        self.context.provider_cache = None
+        self.context.state.overridden_policy.return_value = None
+        self.context.state.completed.return_value = False
+        self.resource = Par(bind(dict(name="a", path="/a")))
+
+        patcher = mock.patch.object(ParProvider, "fingerprinted", True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_skipped(self):
+        self.context.fingerprints.unchanged.return_value = True
+        self.assertEqual(self.resource.apply(self.context), False)
+        self.assertEqual(ParProvider.events, [])
+
+    def test_changed(self):
+        self.context.fingerprints.unchanged.return_value = False
+        self.resource.apply(self.context)
+        self.assertEqual(ParProvider.events, ["start a", "finish a"])
+
+    def test_overridden(self):
+        self.context.fingerprints.unchanged.return_value = True
+        self.context.state.overridden_policy.return_value = ParApplyPolicy
+        self.resource.apply(self.context)
+        self.assertEqual(ParProvider.events, ["start a", "finish a"])
+
+
+class TestCheckpoints(unittest2.TestCase):
+
+    def setUp(self):
+        ParProvider.events = []
+        self.context = Mock()
+        self.context.provider_cache = None
+        self.context.fingerprints = None
+        self.context.state.overridden_policy.return_value = None
+        self.resource = Par(bind(dict(name="a", path="/a")))
+
+    def test_completed(self):
+        self.context.state.completed.return_value = True
+        self.assertEqual(self.resource.apply(self.context), False)
+        self.assertEqual(ParProvider.events, [])
+        self.assertEqual(self.context.state.checkpoint.call_count, 0)
+
+    def test_checkpoint(self):
+        self.context.state.completed.return_value = False
+        self.resource.apply(self.context)
+        self.assertEqual(ParProvider.events, ["start a", "finish a"])
+        digest = self.context.state.completed.call_args[0][1]
+        self.context.state.checkpoint.assert_called_with(self.resource, digest)
+
+    def test_overridden(self):
+        self.context.state.completed.return_value = True
+        self.context.state.overridden_policy.return_value = ParApplyPolicy
+        self.resource.apply(self.context)
+        self.assertEqual(ParProvider.events, ["start a", "finish a"])
+
+
+class TestProviderCache(unittest2.TestCase):
+
+    def setUp(self):
+        self.context = Mock()
+        self.context.provider_cache = policy.ProviderCache()
+        self.resource = Par(bind(dict(name="a", path="/a")))
+
+        patcher = mock.patch.object(ParProvider, "isvalid", return_value=True)
+        self.isvalid = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_provider(self):
+        return ParApplyPolicy(self.resource).get_provider(self.context)
+
+    def test_cached(self):
+        self.assertEqual(self.get_provider(), ParProvider)
+        self.assertEqual(self.get_provider(), ParProvider)
+        self.assertEqual(self.isvalid.call_count, 1)
+        self.assertEqual(self.context.provider_cache.lookups, 2)
+        self.assertEqual(self.context.provider_cache.selections, 1)
+
+    def probe(self, path):
+        self.context.transport.exists.return_value = True
+
+        def isvalid(policy, resource, context):
+            return context.transport.exists(path)
+        self.isvalid.side_effect = isvalid
+
+    def test_invalidate(self):
+        self.probe("/etc/init.d/a")
+        self.get_provider()
+        self.context.provider_cache.invalidate()
+        self.get_provider()
+        self.assertEqual(self.isvalid.call_count, 2)
+
+    def test_invalidate_probed_path(self):
+        self.probe("/etc/init.d/a")
+        self.get_provider()
+        self.context.provider_cache.invalidate(["/etc/init.d/a"])
+        self.get_provider()
+        self.assertEqual(self.isvalid.call_count, 2)
+
+    def test_invalidate_parent_of_probed_path(self):
+        self.probe("/etc/init.d/a")
+        self.get_provider()
+        self.context.provider_cache.invalidate(["/etc/init.d/"])
+        self.get_provider()
+        self.assertEqual(self.isvalid.call_count, 2)
+
+    def test_other_path_kept(self):
+        self.probe("/etc/init.d/a")
+        self.get_provider()
+        self.context.provider_cache.invalidate(["/etc/init.d/b", "/srv"])
+        self.get_provider()
+        self.assertEqual(self.isvalid.call_count, 1)
+        self.assertEqual(self.context.provider_cache.probes, 1)
+        self.assertEqual(self.context.provider_cache.saved, 1)
+
+    def test_not_probing_kept(self):
+        self.get_provider()
+        self.context.provider_cache.invalidate()
+        self.get_provider()
+        self.assertEqual(self.isvalid.call_count, 1)
+        self.assertEqual(self.context.provider_cache.forgotten, 0)
+
+    def test_command_invalidated_by_any_path(self):
+        self.context.transport.execute.return_value = (0, "", "")
+
+        def isvalid(policy, resource, context):
+            return context.transport.execute(["which", "start"])[0] == 0
+        self.isvalid.side_effect = isvalid
+        self.get_provider()
+        self.context.provider_cache.invalidate(["/srv"])
+        self.get_provider()
+        self.assertEqual(self.isvalid.call_count, 2)
+        self.assertEqual(self.context.provider_cache.forgotten, 1)
+
+    def test_no_provider(self):
+        self.isvalid.return_value = False
+        self.assertRaises(error.NoSuitableProviders, self.get_provider)
+        self.assertRaises(error.NoSuitableProviders, self.get_provider)
+        self.assertEqual(self.isvalid.call_count, 2)
+
+
 class TestWatched(TestCase):
 
     def test_watched(self):
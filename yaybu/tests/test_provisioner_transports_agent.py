@@ -0,0 +1,185 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pwd
+import shutil
+import sys
+import tempfile
+import time
+import unittest2
+
+import gevent
+from gevent import subprocess
+import mock
+
+from yaybu import error
+from yaybu.provisioner.transports import agent, base, remote
+
+
+class AgentTestTransport(agent.AgentTransport, base.Transport, remote.RemoteTransport):
+
+    login = "root"
+
+    def whoami(self):
+        return self.login
+
+
+class TestAgentTransport(unittest2.TestCase):
+
+    def setUp(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-u", "-c", agent.BOOTSTRAP],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        self.addCleanup(self.process.wait)
+
+        self.transport = AgentTestTransport(mock.Mock(user="root"))
+        self.transport.start_agent(self.process.stdin, self.process.stdout)
+        self.addCleanup(self.transport._agent.close)
+
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def test_probe(self):
+        missing = os.path.join(self.tmp, "missing")
+        results = self.transport.probe([self.tmp, missing])
+        self.assertEqual(results[0].path, self.tmp)
+        self.assertEqual(results[0].isdir, True)
+        self.assertEqual(results[0].stat.st_ino, os.stat(self.tmp).st_ino)
+        self.assertEqual(results[1].exists, False)
+
+    def test_exists(self):
+        self.assertEqual(self.transport.exists(self.tmp), True)
+        self.assertEqual(self.transport.exists(os.path.join(self.tmp, "missing")), False)
+
+    def test_stat_missing(self):
+        self.assertRaises(OSError, self.transport.stat, os.path.join(self.tmp, "missing"))
+
+    def test_put_get(self):
+        path = os.path.join(self.tmp, "file")
+        self.transport.put(path, "hello\0world", 0o600)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        self.assertEqual(self.transport.get(path), "hello\0world")
+
+    def test_checksum(self):
+        path = os.path.join(self.tmp, "file")
+        self.transport.put(path, "hello")
+        self.assertEqual(
+            self.transport.checksum(path, "sha1"),
+            "aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d")
+
+    def test_put_delta(self):
+        path = os.path.join(self.tmp, "file")
+        self.transport.delta_block_size = 4
+        self.transport.delta_min_size = 0
+        self.transport.put(path, "aaaabbbbccccdddd", 0o600)
+        self.transport.put_delta(path, "aaaaXbbbbccccdd")
+        self.assertEqual(self.transport.get(path), "aaaaXbbbbccccdd")
+        # The existing file is patched in place
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+
+    def test_put_delta_stream(self):
+        path = os.path.join(self.tmp, "file")
+        source = os.path.join(self.tmp, "source")
+        with open(source, "wb") as fp:
+            fp.write("aaaaXbbbbccccdd")
+        self.transport.delta_block_size = 4
+        self.transport.delta_min_size = 0
+        self.transport.put(path, "aaaabbbbccccdddd")
+        with open(source, "rb") as fp:
+            self.transport.put_delta(path, fp)
+        self.assertEqual(self.transport.get(path), "aaaaXbbbbccccdd")
+
+    def test_put_delta_outside_limits(self):
+        path = os.path.join(self.tmp, "file")
+        self.transport.put(path, "aaaabbbbccccdddd")
+        self.transport.delta_max_size = 8
+        with mock.patch.object(self.transport._agent, "request", wraps=self.transport._agent.request) as request:
+            self.transport.put_delta(path, "aaaaXbbbbccccdd")
+        self.assertEqual([c[0][0] for c in request.call_args_list], ["put"])
+        self.assertEqual(self.transport.get(path), "aaaaXbbbbccccdd")
+
+    def test_put_delta_missing(self):
+        path = os.path.join(self.tmp, "file")
+        self.transport.put_delta(path, "hello")
+        self.assertEqual(self.transport.get(path), "hello")
+
+    def test_get_missing(self):
+        self.assertRaises(OSError, self.transport.get, os.path.join(self.tmp, "missing"))
+
+    def test_makedirs_unlink(self):
+        path = os.path.join(self.tmp, "a", "b")
+        self.transport.makedirs(path)
+        self.assertEqual(os.path.isdir(path), True)
+        self.transport.unlink(os.path.join(self.tmp, "missing"))
+
+    def test_rename(self):
+        path = os.path.join(self.tmp, "file")
+        self.transport.put(path + ".new", "hello")
+        self.transport.rename(path + ".new", path)
+        self.assertEqual(self.transport.get(path), "hello")
+        self.assertEqual(self.transport.exists(path + ".new"), False)
+
+    def test_getpwnam_missing(self):
+        self.assertRaises(KeyError, self.transport.getpwnam, "yaybu-no-such-user")
+
+    def test_getgrgid(self):
+        self.assertEqual(self.transport.getgrgid(os.getgid()).gr_gid, os.getgid())
+
+    def test_execute(self):
+        output = []
+        returncode, stdout, stderr = self.transport._execute_as(
+            pwd.getpwuid(os.getuid()).pw_name, None,
+            ["sh", "-c", "cat; echo oops >&2; exit 3"], "hello", output.append, None)
+        self.assertEqual(returncode, 3)
+        self.assertEqual(stdout, "hello")
+        self.assertEqual(stderr, "oops\n")
+        self.assertEqual("".join(output), "hello")
+
+    def test_execute_as_login_user(self):
+        # The agent runs as root, so it has to be told to drop to the user we
+        # logged in as even though sudo wouldn't be used for them
+        self.transport.login = "fred"
+        with mock.patch.object(self.transport._agent, "request") as request:
+            request.return_value = 0
+            self.transport._execute(["true"], user="fred")
+        self.assertEqual(request.call_args[1]["user"], "fred")
+        self.assertEqual(request.call_args[1]["command"][0], "env")
+
+    @unittest2.skipUnless(os.getuid() == 0, "needs to run as root")
+    def test_execute_drops_to_login_user(self):
+        self.transport.login = "nobody"
+        returncode, stdout, stderr = self.transport._execute(["id", "-u"], user="nobody")
+        self.assertEqual(int(stdout), pwd.getpwnam("nobody").pw_uid)
+
+    def test_concurrent_requests(self):
+        started = time.time()
+        slow = gevent.spawn(self.transport._execute_as, None, None, ["sleep", "1"], None, None, None)
+        gevent.sleep(0.1)
+        self.assertEqual(self.transport.exists(self.tmp), True)
+        self.assertLess(time.time() - started, 0.8)
+        slow.get()
+
+    def test_agent_exits(self):
+        self.transport._agent.close()
+        self.process.wait()
+        self.assertRaises(error.ConnectionError, self.transport.exists, self.tmp)
+
+    def test_no_agent(self):
+        self.transport._agent = None
+        with mock.patch.object(remote.RemoteTransport, "readlink") as readlink:
+            self.transport.readlink("/foo")
+            readlink.assert_called_with("/foo")
@@ -61,3 +61,62 @@ class TestBaseTransport(TestCase):
                 'SHELL=/bin/sh', 'LOGNAME=doug', 'sh', '-c', 'cd /; foo'],
             None, None, None
         )
+
+    def test_identity_command_invalidates(self):
+        self.transport._identities = {"passwd": None}
+        self.transport.execute(["/usr/sbin/useradd", "doug"])
+        self.assertEqual(self.transport._identities, None)
+
+    def test_unknown_command_invalidates(self):
+        self.transport._identities = {"passwd": None}
+        self.transport._packages = {}
+        self.transport.execute("adduser --system doug")
+        self.assertEqual(self.transport._identities, None)
+        self.assertEqual(self.transport._packages, None)
+
+    def test_shell_script_invalidates(self):
+        self.transport._identities = {"passwd": None}
+        self.transport.execute(["sh", "-c", "useradd doug"])
+        self.assertEqual(self.transport._identities, None)
+
+    def test_query_keeps_identities(self):
+        self.transport._identities = {"passwd": None}
+        self.transport._packages = {}
+        self.transport.execute(["/bin/chown", "doug", "/etc/foo"])
+        self.transport.execute(["test", "-e", "/etc/foo"])
+        self.assertEqual(self.transport._identities, {"passwd": None})
+        self.assertEqual(self.transport._packages, {})
+
+    def test_packages(self):
+        self.transport._execute_impl.return_value = (0, "\n".join([
+            "amd64",
+            "hello amd64 install ok installed 2.7-2",
+            "zip amd64 deinstall ok config-files 3.0-4",
+            "tzdata all install ok installed 2014a",
+            "libc6 i386 unknown ok not-installed ",
+            "libc6 amd64 install ok installed 2.15-0ubuntu10",
+            "libfoo amd64 install ok installed 1.0",
+            "libbar i386 install ok installed 1.0",
+        ]), "")
+        packages = self.transport.packages()
+        self.assertEqual(packages["hello"].version, "2.7-2")
+        self.assertTrue(packages["hello"].installed)
+        self.assertTrue(packages["hello:amd64"].installed)
+        self.assertFalse(packages["zip"].installed)
+        self.assertTrue(packages["tzdata"].installed)
+        self.assertTrue(packages["libc6"].installed)
+        self.assertFalse(packages["libc6:i386"].installed)
+        # Packages for other architectures are only listed with their
+        # architecture
+        self.assertNotIn("libfoo:i386", packages)
+        self.assertNotIn("libbar", packages)
+        self.assertTrue(packages["libbar:i386"].installed)
+
+        self.transport.packages()
+        self.assertEqual(self.transport._execute_impl.call_count, 1)
+
+    def test_package_command_invalidates(self):
+        self.transport._packages = {}
+        self.transport._execute_impl.return_value = (0, "", "")
+        self.transport.execute(["apt-get", "install", "-q", "-y", "hello"])
+        self.assertEqual(self.transport._packages, None)
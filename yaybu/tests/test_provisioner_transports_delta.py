@@ -0,0 +1,72 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import StringIO
+import hashlib
+import random
+import unittest2
+
+from yaybu.provisioner.transports.agent_server import weak_checksum, strong_checksum
+from yaybu.provisioner.transports.delta import compute_delta
+
+
+def signature(data, block_size):
+    blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)]
+    return [(weak_checksum(b), strong_checksum(b)) for b in blocks]
+
+
+def patch(old, ops, block_size):
+    return "".join(
+        old[op * block_size:(op + 1) * block_size] if isinstance(op, int) else op
+        for op in ops)
+
+
+class TestComputeDelta(unittest2.TestCase):
+
+    def setUp(self):
+        r = random.Random(0)
+        self.old = "".join(chr(r.randint(0, 255)) for i in range(64 * 160))
+
+    def check(self, new, block_size=64):
+        ops = compute_delta(signature(self.old, block_size), new, block_size)
+        self.assertEqual(patch(self.old, ops, block_size), new)
+        # Reading the same contents as a stream gives the same result
+        digest = hashlib.sha256()
+        streamed = compute_delta(
+            signature(self.old, block_size), StringIO.StringIO(new), block_size, digest, chunk_size=100)
+        self.assertEqual(patch(self.old, streamed, block_size), new)
+        self.assertEqual(digest.hexdigest(), hashlib.sha256(new).hexdigest())
+        return ops
+
+    def test_unchanged(self):
+        ops = self.check(self.old)
+        self.assertEqual(all(isinstance(op, int) for op in ops), True)
+
+    def test_insert(self):
+        ops = self.check(self.old[:5000] + "hello" + self.old[5000:])
+        literals = [op for op in ops if not isinstance(op, int)]
+        # Only the blocks around the insertion are resent
+        self.assertLess(sum(len(l) for l in literals), 64 * 2 + 5)
+
+    def test_delete(self):
+        self.check(self.old[:3000] + self.old[3100:])
+
+    def test_append(self):
+        self.check(self.old + "tail")
+
+    def test_shorter_than_block(self):
+        self.check("tiny")
+
+    def test_empty(self):
+        self.assertEqual(self.check(""), [])
@@ -12,6 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
+import StringIO
+
 import mock
 
 from yaybu.tests.provisioner_fixture import TestCase
@@ -97,6 +102,15 @@ class TestLocalTransport(TestCase):
         self.assertRaises(OSError, self.transport.lstat, "/")
         self.os.lstat.assert_called_with("/")
 
+    def test_probe(self):
+        self.os.stat.return_value = stat_result(
+            0o40755, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.os.lstat.side_effect = OSError
+        result, = self.transport.probe(["/"])
+        self.os.stat.assert_called_with("/")
+        self.assertEqual(result.isdir, True)
+        self.assertEqual(result.lexists, False)
+
     def test_lexists(self):
         self.os.path.lexists.return_value = True
         self.assertEqual(self.transport.lexists("/"), True)
@@ -196,3 +210,31 @@ class TestLocalTransport(TestCase):
     def test_getspnam_miss(self):
         self.spwd.getspnam.side_effect = KeyError
         self.assertRaises(KeyError, self.transport.getspnam, "sqlite")
+
+
+class TestLocalTransportFiles(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.transport = LocalTransport(None)
+
+    def test_put_shorter(self):
+        path = os.path.join(self.path, "foo")
+        self.transport.put(path, "hello world")
+        self.transport.put(path, "bye")
+        self.assertEqual(open(path).read(), "bye")
+
+    def test_put_shorter_stream(self):
+        path = os.path.join(self.path, "foo")
+        self.transport.put(path, "hello world")
+        self.transport.put(path, StringIO.StringIO("bye"))
+        self.assertEqual(open(path).read(), "bye")
+
+    def test_rename(self):
+        path = os.path.join(self.path, "foo")
+        self.transport.put(path, "hello world")
+        self.transport.put(path + ".new", "bye")
+        self.transport.rename(path + ".new", path)
+        self.assertEqual(open(path).read(), "bye")
+        self.assertEqual(os.path.exists(path + ".new"), False)
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import mock
+import StringIO
 
 from yaybu.tests.provisioner_fixture import TestCase
 from yaybu.provisioner.transports.remote import RemoteTransport
@@ -88,6 +89,28 @@ class TestRemoteTransport(TestCase):
         self.assertRaises(OSError, self.transport.lstat, "/")
         self.ex.assert_called_with(["stat", "-t", "/"])
 
+    def test_probe(self):
+        self.ex.return_value = [
+            0, "a1ff 2 801 1 0 0 4 1 2 3\n41ed 3 801 2 0 0 4096 1 2 3\n-\n-\n", ""]
+        link, missing = self.transport.probe(["/foo", "/bar"])
+        self.assertEqual(self.ex.call_args[0][0][-2:], ["/foo", "/bar"])
+        self.assertEqual(link.path, "/foo")
+        self.assertEqual(link.exists, True)
+        self.assertEqual(link.isdir, True)
+        self.assertEqual(link.islink, True)
+        self.assertEqual(link.stat.st_size, 4096)
+        self.assertEqual(missing.exists, False)
+        self.assertEqual(missing.lexists, False)
+        self.assertEqual(missing.isfile, False)
+
+    def test_probe_nothing(self):
+        self.assertEqual(self.transport.probe([]), [])
+        self.assertEqual(self.ex.called, False)
+
+    def test_probe_failed(self):
+        self.ex.return_value = [1, "", ""]
+        self.assertRaises(OSError, self.transport.probe, ["/"])
+
     def test_lexists(self):
         self.ex.return_value = [0, "", ""]
         self.assertEqual(self.transport.lexists("/"), True)
@@ -194,3 +217,49 @@ class TestRemoteTransport(TestCase):
     def test_getspnam_miss(self):
         self.ex.return_value = [0, "mysql:!:15958:0:99999:7:::", ""]
         self.assertRaises(KeyError, self.transport.getspnam, "sqlite")
+
+    def test_open_write(self):
+        self.ex.return_value = [0, "", ""]
+        fp = self.transport.open("/foo", "wb", 0o600)
+        fp.write("hello")
+        self.assertEqual(self.ex.called, False)
+        fp.close()
+        self.ex.assert_called_with(
+            "umask 177 && tee /foo > /dev/null", stdin="hello")
+
+    def test_put_fileobj(self):
+        self.ex.return_value = [0, "", ""]
+        self.transport.put("/foo", StringIO.StringIO("hello"))
+        self.ex.assert_called_with(
+            "umask 133 && tee /foo > /dev/null", stdin="hello")
+
+    def test_identities_cached(self):
+        self.ex.return_value = [
+            0, "mysql:x:129:144:MySQL Server,,,:/nonexistent:/bin/false", ""]
+        self.transport.getpwnam("mysql")
+        self.transport.getpwuid(129)
+        self.assertRaises(KeyError, self.transport.getpwnam, "sqlite")
+        self.assertEqual(self.ex.call_count, 1)
+
+    def test_put_identity_file_invalidates(self):
+        self.ex.return_value = [
+            0, "mysql:x:129:144:MySQL Server,,,:/nonexistent:/bin/false", ""]
+        self.transport.getpwnam("mysql")
+        self.transport.put("/etc/passwd", "")
+        self.ex.return_value = [0, "", ""]
+        self.assertRaises(KeyError, self.transport.getpwnam, "mysql")
+
+    def test_checksum(self):
+        self.ex.return_value = [
+            0, "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824  /foo\n", ""]
+        self.assertEqual(
+            self.transport.checksum("/foo"),
+            "2cf24dba5fb0a30e26e83b2ac5b9e29e1b161e5c1fa7425e73043362938b9824")
+        self.ex.assert_called_with(["sha256sum", "/foo"])
+
+    def test_checksum_missing(self):
+        self.ex.return_value = [1, "", "sha1sum: /foo: No such file or directory"]
+        self.assertRaises(OSError, self.transport.checksum, "/foo", "sha1")
+
+    def test_checksum_bad_algorithm(self):
+        self.assertRaises(ValueError, self.transport.checksum, "/foo", "rm -rf")
@@ -0,0 +1,393 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import StringIO
+import subprocess
+
+import gevent
+import gevent.os
+import mock
+import unittest2
+
+from yaybu import error
+from yaybu.provisioner.transports.ssh import SSHTransport, ChannelPool, ShellSession
+
+
+class FakeChannel(object):
+
+    """ Just enough of a paramiko channel to run a command that prints
+    ``output`` and exits with ``returncode`` """
+
+    eof_received = True
+
+    def __init__(self, output="", returncode=0, delay=0):
+        self.output = [output] if output else []
+        self.returncode = returncode
+        self.delay = delay
+        self.closed = False
+
+    def get_pty(self):
+        self.pty = True
+
+    def sendall(self, data):
+        self.sent = data
+
+    def shutdown_write(self):
+        self.write_closed = True
+
+    def exec_command(self, command):
+        self.command = command
+        gevent.sleep(self.delay)
+
+    def exit_status_ready(self):
+        return True
+
+    def recv_ready(self):
+        return bool(self.output)
+
+    def recv(self, size):
+        # Like paramiko, an empty string means the stream has closed
+        if not self.output:
+            return ""
+        return self.output.pop(0)
+
+    def recv_stderr_ready(self):
+        return False
+
+    def recv_stderr(self, size):
+        return ""
+
+    def recv_exit_status(self):
+        return self.returncode
+
+    def close(self):
+        self.closed = True
+
+
+class ShellChannel(object):
+
+    """ Enough of a paramiko channel to talk to a local shell """
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["sh"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        gevent.os.make_nonblocking(self.process.stdout.fileno())
+        gevent.os.make_nonblocking(self.process.stderr.fileno())
+
+    def sendall(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+    def recv(self, size):
+        return gevent.os.nb_read(self.process.stdout.fileno(), size)
+
+    def recv_stderr(self, size):
+        return gevent.os.nb_read(self.process.stderr.fileno(), size)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class TestChannelPool(unittest2.TestCase):
+
+    def test_bounded(self):
+        transport = mock.Mock()
+        transport.open_session.side_effect = lambda: FakeChannel()
+        pool = ChannelPool(transport, 2)
+
+        active = []
+        peak = []
+
+        def use():
+            with pool.channel():
+                active.append(1)
+                peak.append(len(active))
+                gevent.sleep(0.01)
+                active.pop()
+
+        gevent.joinall([gevent.spawn(use) for i in range(5)])
+
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(sum(s.commands for s in pool.stats), 5)
+
+    def test_channel_closed(self):
+        channel = FakeChannel()
+        transport = mock.Mock()
+        transport.open_session.return_value = channel
+        pool = ChannelPool(transport, 1)
+        with pool.channel():
+            pass
+        self.assertEqual(channel.closed, True)
+
+    def test_failure(self):
+        transport = mock.Mock()
+        transport.open_session.side_effect = EOFError
+        pool = ChannelPool(transport, 1)
+
+        def use():
+            with pool.channel():
+                pass
+
+        self.assertRaises(EOFError, use)
+        self.assertEqual(pool.stats[0].failures, 1)
+        # The slot must have been given back
+        self.assertRaises(EOFError, use)
+
+    def test_reserve(self):
+        transport = mock.Mock()
+        transport.open_session.side_effect = lambda: FakeChannel()
+        pool = ChannelPool(transport, 3)
+        first = pool.reserve()
+        self.assertNotEqual(pool.reserve(), None)
+        # The last slot is kept for other commands
+        self.assertEqual(pool.reserve(), None)
+        with pool.channel():
+            pass
+        pool.release(first[0])
+        self.assertNotEqual(pool.reserve(), None)
+
+
+class TestSSHTransport(unittest2.TestCase):
+
+    def setUp(self):
+        self.transport = SSHTransport(mock.Mock(user="root", channels=3))
+        self.paramiko_transport = mock.Mock()
+        self.transport._client = mock.Mock()
+        self.transport._client.get_transport.return_value = self.paramiko_transport
+        self.transport._pool = ChannelPool(self.paramiko_transport, 3)
+
+    def test_execute(self):
+        self.paramiko_transport.open_session.return_value = FakeChannel("hello")
+        returncode, stdout, stderr = self.transport._execute_impl(["echo", "hello"], None, None, None)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, "hello")
+        stats = self.transport.channel_stats()
+        self.assertEqual(sum(s.commands for s in stats), 1)
+        self.assertEqual(sum(s.bytes_received for s in stats), 5)
+
+    def test_execute_stdin(self):
+        channel = FakeChannel("hello")
+        self.paramiko_transport.open_session.return_value = channel
+        self.transport._execute_impl(["cat"], "hello", None, None)
+        self.assertEqual(channel.sent, "hello")
+        self.assertEqual(channel.write_closed, True)
+
+    def test_concurrent_commands(self):
+        self.paramiko_transport.open_session.side_effect = lambda: FakeChannel("x", delay=0.05)
+        commands = [
+            gevent.spawn(self.transport._execute_impl, ["true"], None, None, None)
+            for i in range(3)]
+        gevent.joinall(commands, raise_error=True)
+        self.assertEqual([c.value for c in commands], [(0, "x", "")] * 3)
+        # Each command got its own channel
+        self.assertEqual(set(s.commands for s in self.transport.channel_stats()), set([1]))
+
+    def handshake(self, output, returncode=3):
+        return FakeChannel(
+            "user=root\ntrue=0\nfalse=1\n" + output, returncode)
+
+    def test_session_started_once(self):
+        self.transport.whoami = lambda: "root"
+        self.paramiko_transport.open_session.side_effect = lambda: FakeChannel(delay=0.01)
+        sessions = [gevent.spawn(self.transport._session, "root", None) for i in range(2)]
+        gevent.joinall(sessions, raise_error=True)
+        self.assertIs(sessions[0].value, sessions[1].value)
+        self.assertEqual(self.paramiko_transport.open_session.call_count, 1)
+        self.assertEqual(self.transport._pool.reserved, 1)
+
+    def test_session_discarded_on_any_error(self):
+        session = mock.Mock()
+        session.run.side_effect = gevent.Timeout()
+        self.transport._sessions = {("root", None): session}
+        self.transport._pool.release = mock.Mock()
+        self.assertRaises(
+            gevent.Timeout, self.transport._execute_as, "root", None, ["true"], None, None, None)
+        self.assertEqual(self.transport._sessions, {})
+        session.close.assert_called_with()
+        self.transport._pool.release.assert_called_with(session.stats)
+
+    def test_sessions_bounded(self):
+        self.transport.whoami = lambda: "root"
+        self.paramiko_transport.open_session.side_effect = lambda: FakeChannel()
+        self.assertNotEqual(self.transport._session("root", None), None)
+        self.assertNotEqual(self.transport._session("www", None), None)
+        self.assertEqual(self.transport._session("doug", None), None)
+
+    def test_verify_transport(self):
+        self.paramiko_transport.open_session.return_value = self.handshake(
+            "sudo_user=root\ndistro=ubuntu\ninit=upstart\n")
+        self.transport.verify_transport(self.paramiko_transport)
+        self.assertEqual(self.transport.facts["distro"], "ubuntu")
+        self.assertEqual(self.transport.facts["init"], "upstart")
+        self.assertEqual(self.transport.facts["sudo"], "nopasswd")
+        self.assertEqual(self.transport._allocate_pty, False)
+        # Everything was checked with a single command
+        self.assertEqual(self.paramiko_transport.open_session.call_count, 1)
+
+    def test_verify_transport_sudo_tty(self):
+        self.paramiko_transport.open_session.side_effect = [
+            self.handshake("sudo_user=\n"),
+            FakeChannel("root"),
+        ]
+        self.transport.verify_transport(self.paramiko_transport)
+        self.assertEqual(self.transport.facts["sudo"], "tty")
+        self.assertEqual(self.transport._allocate_pty, True)
+
+    def test_verify_transport_wrong_user(self):
+        self.transport.context.user = "fred"
+        self.paramiko_transport.open_session.return_value = self.handshake("sudo_user=root\n")
+        self.assertRaises(error.ConnectionError, self.transport.verify_transport, self.paramiko_transport)
+
+    def test_verify_transport_exit_codes_lost(self):
+        self.paramiko_transport.open_session.return_value = self.handshake("sudo_user=root\n", 0)
+        self.assertRaises(error.ConnectionError, self.transport.verify_transport, self.paramiko_transport)
+
+
+class TestShellSession(unittest2.TestCase):
+
+    def setUp(self):
+        self.session = ShellSession(ShellChannel(), read_size=3)
+        self.addCleanup(self.session.close)
+
+    def test_run(self):
+        output = []
+        returncode, stdout, stderr = self.session.run(
+            ["sh", "-c", "echo hello; echo oops >&2; exit 3"], output.append)
+        self.assertEqual(returncode, 3)
+        self.assertEqual(stdout, "hello\n")
+        self.assertEqual(stderr, "oops\n")
+        self.assertEqual("".join(output), "hello\n")
+
+    def test_no_trailing_newline(self):
+        self.assertEqual(self.session.run(["printf", "a"]), (0, "a", ""))
+
+    def test_several_commands(self):
+        self.session.run(["true"])
+        self.assertEqual(self.session.run(["echo", "again"]), (0, "again\n", ""))
+
+    def test_stdin_is_not_the_shell(self):
+        self.assertEqual(self.session.run(["cat"]), (0, "", ""))
+        self.assertEqual(self.session.run(["echo", "still here"])[1], "still here\n")
+
+    def test_shell_exits(self):
+        self.assertRaises(error.ConnectionError, self.session.run, ["exit", "1"])
+
+    def test_token_per_command(self):
+        self.session.run(["true"])
+        tokens = set()
+        self.session.channel.sendall = lambda data: tokens.add(data.split()[-2])
+        self.session.read = lambda recv, callback, marker: ("", "0")
+        self.session.run(["true"])
+        self.session.run(["true"])
+        self.assertEqual(len(tokens), 2)
+
+    def test_interrupted(self):
+        with gevent.Timeout(0.05, False):
+            self.session.run(["sh", "-c", "echo started; sleep 0.2; echo late"])
+        # Whatever the command prints later mustn't be taken as the output of
+        # the next one
+        self.assertEqual(self.session.closed, True)
+        self.assertRaises(error.ConnectionError, self.session.run, ["echo", "next"])
+
+
+class TestSSHTransportSFTP(unittest2.TestCase):
+
+    def setUp(self):
+        self.transport = SSHTransport(mock.Mock(user="root", channels=3))
+        self.transport._client = mock.Mock()
+        self.sftp = self.transport._sftp = mock.Mock()
+
+    def test_get(self):
+        self.sftp.open.return_value.read.side_effect = ["hel", "lo", ""]
+        self.assertEqual(self.transport.get("/foo"), "hello")
+        self.sftp.open.assert_called_with("/foo", "rb", SSHTransport.chunk_size)
+        self.sftp.open.return_value.read.assert_called_with(SSHTransport.chunk_size)
+        self.sftp.open.return_value.prefetch.assert_called_with()
+        self.sftp.open.return_value.close.assert_called_with()
+
+    def test_put_new_file(self):
+        self.sftp.stat.side_effect = IOError
+        fp = self.sftp.open.return_value
+        self.transport.put("/foo", "hello", 0o600)
+        fp.chmod.assert_called_with(0o600)
+        fp.set_pipelined.assert_called_with(True)
+        fp.write.assert_called_with("hello")
+        fp.close.assert_called_with()
+
+    def test_put_existing_file(self):
+        fp = self.sftp.open.return_value
+        self.transport.put("/foo", "hello", 0o600)
+        self.assertEqual(fp.chmod.called, False)
+
+    def test_put_streams(self):
+        fp = self.sftp.open.return_value
+        self.transport.chunk_size = 2
+        self.transport.put("/foo", StringIO.StringIO("hello"))
+        self.assertEqual(
+            [c[0][0] for c in fp.write.call_args_list], ["he", "ll", "o"])
+
+    def test_one_at_a_time(self):
+        events = []
+
+        def write(data):
+            events.append(("start", data))
+            gevent.sleep(0.01)
+            events.append(("end", data))
+        self.sftp.open.return_value.write.side_effect = write
+
+        gevent.joinall([
+            gevent.spawn(self.transport.put, "/foo", "foo"),
+            gevent.spawn(self.transport.put, "/bar", "bar"),
+        ], raise_error=True)
+        self.assertEqual(events, [
+            ("start", "foo"), ("end", "foo"), ("start", "bar"), ("end", "bar")])
+
+    def assertUnlocked(self):
+        lock = self.transport.sftp_lock
+        self.assertEqual(gevent.spawn(lock.acquire, blocking=False).get(), True)
+
+    def test_open_holds_lock(self):
+        events = []
+
+        def reader():
+            fp = self.transport.open("/foo", "rb")
+            events.append("opened")
+            gevent.sleep(0.01)
+            events.append("closed")
+            fp.close()
+
+        def writer():
+            gevent.sleep(0)
+            self.transport.put("/bar", "bar")
+            events.append("put")
+
+        gevent.joinall([gevent.spawn(reader), gevent.spawn(writer)], raise_error=True)
+        self.assertEqual(events, ["opened", "closed", "put"])
+        self.assertUnlocked()
+
+    def test_open_fails(self):
+        self.sftp.open.side_effect = IOError
+        self.assertRaises(IOError, self.transport.open, "/foo", "rb")
+        self.assertUnlocked()
+
+    def test_no_sftp(self):
+        self.transport._sftp = False
+        self.transport._execute = mock.Mock(return_value=(0, "hello", ""))
+        self.assertEqual(self.transport.get("/foo"), "hello")
+        self.transport._execute.assert_called_with(["cat", "/foo"])
@@ -12,17 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import shutil
+import tempfile
+
 from yaybu.tests.base import TestCase
 import mock
 
 from yaybu import error
-from yaybu.util import render_string
+from yaybu.util import render_string, render_template
+from yaybu.util.templates import get_template_environment
 
 
 class TestTemplate(TestCase):
 
     def setUp(self):
         self.context = mock.Mock()
+        self.context.templates = None
         self.paths = {}
 
         def _get_file(path):
@@ -153,3 +159,53 @@ class TestTemplate(TestCase):
         """
         self.assertRaises(
             error.TemplateError, render_string, self.context, contents, {})
+
+
+class TestSharedEnvironment(TestTemplate):
+
+    def setUp(self):
+        super(TestSharedEnvironment, self).setUp()
+        self.cachedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cachedir)
+        self.context.templates = get_template_environment(self.cachedir)
+
+    def test_fetched_once(self):
+        self.add_path("test1", "hello {{ name }}")
+        for name in ("world", "again"):
+            self.assertEqual(
+                render_template(self.context, "test1", {"name": name})[0].strip(),
+                "hello " + name)
+        self.assertEqual(self.context.get_file.call_count, 1)
+
+    def test_strings_compiled_once(self):
+        render_string(self.context, "{{ hello }}", {"hello": "world"})
+        self.assertEqual(
+            render_string(self.context, "{{ hello }}", {"hello": "again"})[0].strip(),
+            "again")
+        self.assertEqual(len(self.context.templates.strings), 1)
+
+    def test_tainted_when_cached(self):
+        self.add_path("test1", "hello: world\n", ['secret'])
+        contents = """
+        {% include "test1" %}
+        """
+        self.assertEqual(render_string(self.context, contents, {})[1], True)
+        self.assertEqual(render_string(self.context, contents, {})[1], True)
+        self.assertEqual(render_string(self.context, "hello", {})[1], False)
+
+    def test_bytecode_cache(self):
+        self.add_path("test1", "hello world")
+        render_template(self.context, "test1", {})
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+        # A new run loads the compiled template instead of compiling it
+        self.context.templates = get_template_environment(self.cachedir)
+        with mock.patch.object(self.context.templates, "compile") as compile:
+            self.assertEqual(
+                render_template(self.context, "test1", {})[0].strip(), "hello world")
+        self.assertEqual(compile.call_count, 0)
+
+    def test_secrets_not_cached_on_disk(self):
+        self.add_path("test1", "hello world", ['secret'])
+        render_template(self.context, "test1", {})
+        self.assertEqual(os.listdir(self.cachedir), [])
@@ -154,16 +154,27 @@ class TextFactory(object):
     def _emit_started_and_finished(self):
         need_starting = len([p for p in self.tasks if not p.finished]) > 1
 
-        for p in self.tasks:
+        # Only one task at a time prints its sections, so the output of tasks
+        # that are running at the same time doesn't interleave
+        printing = None
+
+        for p in list(self.tasks):
             if not p.started and not p.finished and (need_starting or p.sections):
                 self.print("[*] Started '%s'" % p.text())
                 p.started = True
 
+            if p.sections:
+                if printing:
+                    continue
+                printing = p
+
             for section in p.sections:
                 if section.visited:
                     continue
+                # Sections can finish out of order, but are printed in the
+                # order they were started
                 if not section.finished:
-                    continue
+                    break
                 for line in section.output:
                     self.print(line)
                 section.visited = True
@@ -174,6 +185,8 @@ class TextFactory(object):
                 else:
                     self.print("[*] Finished '%s'" % (p.text(), ))
                 self.tasks.remove(p)
+                if printing is p:
+                    printing = None
 
     def _emit_waiting(self, glyphs):
         num_tasks = len(self.tasks)
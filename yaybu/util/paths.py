@@ -0,0 +1,34 @@
+# Copyright 2014 Isotoma Limited
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import posixpath
+
+
+def paths_overlap(a, b):
+    """ True if ``a`` and ``b`` are the same path or one contains the other """
+    if a == b:
+        return True
+    if a.startswith(b.rstrip("/") + "/"):
+        return True
+    return b.startswith(a.rstrip("/") + "/")
+
+
+def parent_paths(path):
+    """ The paths that contain ``path``, nearest first """
+    while True:
+        parent = posixpath.dirname(path.rstrip("/"))
+        if not parent or parent == path:
+            return
+        yield parent
+        path = parent
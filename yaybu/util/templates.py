@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import sys
+import contextlib
 
-from jinja2 import Environment, BaseLoader, StrictUndefined
+import gevent.local
+from jinja2 import Environment, BaseLoader, StrictUndefined, FileSystemBytecodeCache
 from jinja2.exceptions import UndefinedError, TemplateSyntaxError
 
 from yay import errors
@@ -84,22 +87,115 @@ class TemplateLoader(BaseLoader):
     This means that templates can be fetched over http and can even be
     encrypted with GPG.
 
-    It tracks whether it has been used to open any encrypted templates and sets
-    a taint flag if it has.
+    One loader is shared by every render in a run. A template is fetched with
+    the context of the render that first needs it, and is only fetched once.
+    The loader remembers which templates were encrypted so that
+    ``TemplateEnvironment`` can taint every render that uses one.
     """
 
-    def __init__(self, ctx):
-        self.ctx = ctx
-        self.secret = False
+    def __init__(self):
+        self.sources = {}
+        self.secrets = set()
+        self.local = gevent.local.local()
 
     def get_source(self, environment, template):
-        f = self.ctx.get_file(template)
-        source = f.read()
-        self.secret = self.secret or "secret" in f.labels
-        return source, template, lambda: False
+        if template not in self.sources:
+            f = self.local.render.context.get_file(template)
+            self.sources[template] = f.read()
+            if "secret" in f.labels:
+                self.secrets.add(template)
+        return self.sources[template], template, lambda: True
+
 
+class TemplateBytecodeCache(FileSystemBytecodeCache):
 
-def get_template_environment(context):
+    """
+    Keeps compiled templates in ``directory`` between runs. Jinja2 keys them by
+    template name and a digest of the source, so a template that has changed
+    is compiled again. Encrypted templates are never written to disk, and a
+    cache that can't be read or written is ignored.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        super(TemplateBytecodeCache, self).__init__(directory)
+
+    def get_bucket(self, environment, name, filename, source):
+        bucket = super(TemplateBytecodeCache, self).get_bucket(
+            environment, name, filename, source)
+        bucket.secret = name in environment.loader.secrets
+        return bucket
+
+    def load_bytecode(self, bucket):
+        try:
+            super(TemplateBytecodeCache, self).load_bytecode(bucket)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        if bucket.secret:
+            return
+        try:
+            super(TemplateBytecodeCache, self).dump_bytecode(bucket)
+        except (IOError, OSError):
+            pass
+
+
+class Render(object):
+
+    """ A single call to ``render_string`` or ``render_template``. ``secret``
+    is set if it used an encrypted template. """
+
+    def __init__(self, context):
+        self.context = context
+        self.secret = False
+
+
+class TemplateEnvironment(Environment):
+
+    """
+    A Jinja2 environment that can be shared by every resource and host in a
+    run. Templates (and strings) are compiled once and kept for the rest of
+    the run, so they are not fetched again when they change part way through.
+    """
+
+    def __init__(self, **kwargs):
+        super(TemplateEnvironment, self).__init__(**kwargs)
+        self.strings = {}
+
+    @contextlib.contextmanager
+    def rendering(self, context):
+        """ Load templates with ``context`` in this greenlet until the block
+        ends. Yields a ``Render``. """
+        local = self.loader.local
+        previous = getattr(local, "render", None)
+        local.render = Render(context)
+        try:
+            yield local.render
+        finally:
+            local.render = previous
+
+    def _load_template(self, name, globals):
+        # Every get_template, include, import and extends ends up here, even
+        # when the template is already cached
+        template = super(TemplateEnvironment, self)._load_template(name, globals)
+        if name in self.loader.secrets:
+            self.loader.local.render.secret = True
+        return template
+
+    def from_cached_string(self, source):
+        """ Like ``from_string``, but a source that has been seen before isn't
+        compiled again. """
+        if source not in self.strings:
+            self.strings[source] = self.from_string(source)
+        return self.strings[source]
+
+
+def get_template_environment(cachedir=None):
     """
     Sets up a standard Yaybu template rendering environment
 
@@ -109,16 +205,25 @@ def get_template_environment(context):
       * The use of a custom template loader that respects the yaybu search path
       * The use of stricter undefined error handling than provided by Jinja by default
 
+    If ``cachedir`` is given compiled templates are kept there between runs.
     """
-    loader = TemplateLoader(context)
-    env = Environment(
-        loader=loader,
+    env = TemplateEnvironment(
+        loader=TemplateLoader(),
         line_statement_prefix='%',
         undefined=LessStrictUndefined,
+        cache_size=-1,
+        auto_reload=False,
+        bytecode_cache=TemplateBytecodeCache(cachedir) if cachedir else None,
     )
     return env
 
 
+def get_context_environment(context):
+    """ The environment shared by everything rendered with ``context``, or a
+    new one if it doesn't have one. """
+    return getattr(context, "templates", None) or get_template_environment()
+
+
 def _call_get(callable, *args, **kwargs):
     try:
         return callable(*args, **kwargs)
@@ -145,31 +250,33 @@ def _call_render(template, *args, **kwargs):
 
 def render_string(context, contents, arguments):
     """
-    Set up a template environment that searches for referenced templates on the
-    Yaybu search path and use it to render a string.
+    Use the template environment of ``context``, which searches for referenced
+    templates on the Yaybu search path, to render a string.
 
     Returns the rendered template and a boolean that is True if a template used
     directly or indirectly was encrypted.
 
     Template exceptions will be mapped to Yaybu expections.
     """
-    env = get_template_environment(context)
-    template = _call_get(env.from_string, contents)
-    rendered = _call_render(template, arguments) + "\n"
-    return rendered, env.loader.secret
+    env = get_context_environment(context)
+    with env.rendering(context) as render:
+        template = _call_get(env.from_cached_string, contents)
+        rendered = _call_render(template, arguments) + "\n"
+    return rendered, render.secret
 
 
 def render_template(context, template, arguments):
     """
-    Set up a template environment that searches for templates on the Yaybu
-    search path and use it to render the specified template.
+    Use the template environment of ``context``, which searches for templates
+    on the Yaybu search path, to render the specified template.
 
     Returns the rendered template and a boolean that is True if a template used
     directly or indirectly was encrypted.
 
     Template exceptions will be mapped to Yaybu exceptions.
     """
-    env = get_template_environment(context)
-    template = _call_get(env.get_template, template)
-    rendered = _call_render(template, arguments) + "\n"
-    return rendered, env.loader.secret
+    env = get_context_environment(context)
+    with env.rendering(context) as render:
+        template = _call_get(env.get_template, template)
+        rendered = _call_render(template, arguments) + "\n"
+    return rendered, render.secret